@@ -6,6 +6,23 @@ const SendIcon = () => (
     <svg width="24" height="24" viewBox="0 0 24 24" fill="currentColor"><path d="M3.478 2.405a.75.75 0 00-.926.94l2.432 7.905H13.5a.75.75 0 010 1.5H4.984l-2.432 7.905a.75.75 0 00.926.94 60.519 60.519 0 0018.445-8.986.75.75 0 000-1.218A60.517 60.517 0 003.478 2.405z" /></svg>
 );
 
+// Mỗi trình duyệt một session_id ngẫu nhiên (không đoán được) để lịch sử hội thoại không dùng chung giữa người dùng
+const SESSION_KEY = 'chat-session-id';
+
+const getSessionId = () => {
+  let sessionId = localStorage.getItem(SESSION_KEY);
+  if (!sessionId) {
+    if (crypto.randomUUID) {
+      sessionId = crypto.randomUUID();
+    } else {
+      const bytes = crypto.getRandomValues(new Uint8Array(16));
+      sessionId = Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+    }
+    localStorage.setItem(SESSION_KEY, sessionId);
+  }
+  return sessionId;
+};
+
 const ChatPage = () => {
   const [messages, setMessages] = useState([
     { sender: 'bot', text: 'Xin chào! Tôi có thể giúp gì cho bạn về các vấn đề pháp lý y tế?' }
@@ -54,7 +71,7 @@ const ChatPage = () => {
         },
         body: JSON.stringify({ 
             query: queryText,
-            session_id: "user-default" 
+            session_id: getSessionId()
         })
       });
 
@@ -1,18 +1,36 @@
 import os
+import math
 import uvicorn
 import logging
-from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import Optional, List
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic import BaseModel, Field
+import json
+import hmac
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
 # --- Import các Module Agents ---
 from src.agents.intent_classifier import IntentClassifier 
-from src.agents.database_retriever import DatabaseRetriever
 from src.agents.specialized_generator import SpecificGenerator
 from src.agents.general_generator import GeneralGenerator
-from src.utils import load_env
+from src.agents.extractive_answerer import EXTRACTIVE_HEADER, ExtractiveAnswer, ExtractiveAnswerer
+from src.agents.session_manager import SessionStore, QueryCondenser, Turn
+from src.agents.query_preprocessor import QueryPreprocessor
+from src.agents.llm_gateway import LLMGateway
+from src.agents.local_backend import build_local_backends
+from src.utils import load_env, extract_config
+from src.serving.observability import REGISTRY, FALLBACKS, ERRORS, span, trace_request
+from src.serving.admission import AdmissionController, AdmissionRejected, RateLimiter, SingleFlight
+from src.serving.index_manager import IndexManager
+from src.serving.deadline import (
+    DISCONNECT_POLL_SECONDS, ClientDisconnected, DeadlinePolicy, current_deadline, deadline_scope,
+    record_degradation, run_until_disconnected,
+)
+from src.serving.profiling import PROFILE_MODES, Profiler, ProfilerBusy
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse, JSONResponse
 
 # --- Cấu hình Logging ---
 logging.basicConfig(level=logging.INFO)
@@ -22,14 +40,80 @@ logger = logging.getLogger(__name__)
 class ChatRequest(BaseModel):
     query: str
     session_id: Optional[str] = None
+    # generate: LLM tổng hợp | extractive: trích nguyên văn Khoản/câu khớp nhất, không gọi LLM
+    # auto: trích xuất nếu đủ chắc chắn (extractive.min_score), ngược lại gọi LLM
+    mode: str = "generate"
 
 class ChatResponse(BaseModel):
     response: str
     intent: str
     source_documents: Optional[List[str]] = None
+    citations: Optional[List[str]] = None  # Vị trí các đoạn trích nguyên văn (câu trả lời trích xuất)
+
+RESPONSE_MODES = ("generate", "extractive", "auto")
+
+MAX_BATCH_SIZE = 1024
+MAX_BATCH_CONCURRENCY = 64
+MAX_BATCH_K = 50
+
+class BatchChatRequest(BaseModel):
+    queries: List[str]
+    k: int = Field(5, ge=1, le=MAX_BATCH_K)
+    concurrency: int = 8          # Số lời gọi sinh câu trả lời chạy song song tối đa
+    classify: bool = False        # False: coi mọi câu là "specific" (giống các job RAG offline)
+    include_context: bool = True  # Trả kèm nội dung các chunk đã dùng làm context
+
+class BatchChatItem(BaseModel):
+    index: int
+    query: str
+    response: str
+    intent: str
+    source_documents: List[str] = []
+    context: Optional[List[Dict[str, Any]]] = None
 
 # --- Global State ---
 agents = {}
+# Trạng thái nạp retriever: not_started | loading | ready | failed | disabled
+readiness = {"retriever": "not_started", "error": None, "load_seconds": None}
+
+async def _warm_up_retriever(manager: IndexManager):
+    """ Nạp embedding model, Chroma và BM25 index trong thread riêng, rồi chạy warm-up. """
+    readiness["retriever"] = "loading"
+    t0 = time.perf_counter()
+    try:
+        await manager.reload()
+        manager.start_watching()
+        readiness["retriever"] = "ready"
+        readiness["load_seconds"] = round(time.perf_counter() - t0, 2)
+        logger.info(f"Database Retriever sẵn sàng sau {readiness['load_seconds']}s.")
+    except Exception as e:
+        readiness["retriever"] = "failed"
+        readiness["error"] = str(e)
+        logger.error(f"Lỗi khởi tạo Database Retriever: {e}")
+
+async def _purge_sessions(store: SessionStore, interval_seconds: float):
+    """ Định kỳ xóa session hết hạn để bộ nhớ và backing store SQLite không phình mãi. """
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            purged = await asyncio.to_thread(store.purge_expired)
+            if purged:
+                logger.info(f"Đã xóa {purged} session hết hạn.")
+        except Exception as e:
+            logger.warning(f"Lỗi dọn session hết hạn: {e}")
+
+def _on_index_swap(retriever):
+    """ Bản index mới bắt đầu phục vụ: cập nhật tham chiếu và gắn tải hiện tại cho chính sách truy vấn thích ứng. """
+    agents["retriever"] = retriever
+    if retriever.policy is not None:
+        retriever.policy.load_fn = _current_load
+
+def _current_load() -> float:
+    """ Tải /chat (0..1+): số pipeline đang chạy + đang chờ so với giới hạn đồng thời. """
+    admission = agents.get("admission")
+    if admission is None:
+        return 0.0
+    return (admission.in_flight + admission.waiting) / admission.max_in_flight
 
 # --- Lifespan Manager ---
 @asynccontextmanager
@@ -38,6 +122,8 @@ async def lifespan(app: FastAPI):
     
     # 1. Load Config từ biến môi trường
     groq_api_key = load_env("GROQ_API_KEY")
+    # Cho phép trỏ Classifier/General Generator sang server tương thích OpenAI khác (vd: mock server)
+    groq_base_url = os.getenv("GROQ_BASE_URL")
     
     # Config cho Model trả lời chính
     llm_api_key = load_env("LLM_API_KEY")
@@ -53,34 +139,91 @@ async def lifespan(app: FastAPI):
             llm_model_name = "llama-3.1-8b-instant"
 
     try:
+        serving_cfg = extract_config("configs/serving.yml")
+
+        # LLM gateway (tùy chọn): nhiều endpoint theo thứ tự, circuit breaker, hedging
+        gateway = None
+        gateway_cfg = serving_cfg.get("llm_gateway", {})
+        if gateway_cfg.get("enabled", False):
+            logger.info("Initializing LLM Gateway...")
+            gateway = LLMGateway.from_config(gateway_cfg)
+            agents["llm_gateway"] = gateway
+
         # 2. Khởi tạo Intent Classifier
         logger.info("Initializing Intent Classifier...")
-        agents["classifier"] = IntentClassifier(api_key=groq_api_key)
+        agents["classifier"] = IntentClassifier(api_key=groq_api_key, base_url=groq_base_url, gateway=gateway)
 
         # 3. Khởi tạo General Generator
         logger.info("Initializing General Generator...")
-        agents["general_gen"] = GeneralGenerator(api_key=groq_api_key)
+        # Lời chào / thông báo không tìm thấy có thể sinh tại chỗ (template hoặc model nhỏ trên CPU)
+        local_cfg = serving_cfg.get("local_generation", {})
+        agents["general_gen"] = GeneralGenerator(
+            api_key=groq_api_key,
+            base_url=groq_base_url,
+            gateway=gateway,
+            local_backends=build_local_backends(local_cfg),
+            local_fallback_to_remote=local_cfg.get("fallback_to_remote", True),
+        )
 
-        # 4. Khởi tạo Specialized Generator
+        # 4. Khởi tạo Specialized Generator (+ câu trả lời trích xuất: chế độ nhanh / dự phòng khi LLM lỗi)
         logger.info(f"Initializing Specialized Generator pointing to: {llm_api_url} | Model: {llm_model_name}")
+        extractive_cfg = serving_cfg.get("extractive", {})
+        agents["extractive"] = ExtractiveAnswerer.from_config(extractive_cfg)
         
         agents["specific_gen"] = SpecificGenerator(
             api_key=llm_api_key,       
             api_url=llm_api_url,       
             model_id=llm_model_name,      
-            max_output_tokens=1024
+            max_output_tokens=1024,
+            gateway=gateway,
+            extractive=agents["extractive"] if extractive_cfg.get("fallback_on_llm_error", True) else None,
         )
 
-        # 5. Khởi tạo Database Retriever
+        # 5. Khởi tạo Database Retriever: nạp ở background để API (general chat, health) phục vụ ngay
         config_path = "configs/indexing_pipeline.yml" 
         if os.path.exists(config_path):
-            logger.info(f"Initializing Database Retriever from {config_path}...")
-            agents["retriever"] = DatabaseRetriever.from_config(config_path=config_path)
+            logger.info(f"Initializing Database Retriever from {config_path} (background)...")
+            # Index manager giữ bản index đang phục vụ và hot swap khi có snapshot mới
+            agents["index_manager"] = IndexManager.from_config(config_path, on_swap=_on_index_swap)
+            readiness["warmup_task"] = asyncio.create_task(_warm_up_retriever(agents["index_manager"]))
+            if not serving_cfg.get("startup", {}).get("background_warmup", True):
+                await readiness["warmup_task"]
         else:
             logger.warning(f"Warning: Không tìm thấy {config_path}. Chế độ Specific có thể bị lỗi.")
             agents["retriever"] = None
+            readiness["retriever"] = "disabled"
+
+        # 6. Session Manager (lịch sử hội thoại + viết lại câu hỏi nối tiếp)
+        session_cfg = serving_cfg.get("session", {})
+        if session_cfg.get("enabled", False):
+            logger.info("Initializing Session Manager...")
+            agents["sessions"] = SessionStore.from_config(session_cfg)
+            agents["condenser"] = QueryCondenser.from_config(groq_api_key, session_cfg, base_url=groq_base_url, gateway=gateway)
+            agents["session_purge_task"] = asyncio.create_task(
+                _purge_sessions(agents["sessions"], session_cfg.get("purge_interval_seconds", 300))
+            )
+
+        # 7. Admission control cho /chat: giới hạn đồng thời + hàng đợi, gộp câu hỏi trùng, rate limit
+        admission_cfg = serving_cfg.get("admission", {})
+        if admission_cfg.get("enabled", True):
+            agents["admission"] = AdmissionController.from_config(admission_cfg)
+            if admission_cfg.get("coalesce", True):
+                agents["single_flight"] = SingleFlight()
+            rate_cfg = admission_cfg.get("rate_limit", {})
+            if rate_cfg.get("enabled", False):
+                agents["rate_limiter"] = RateLimiter.from_config(rate_cfg)
+
+        # 8. Deadline cho mỗi request /chat: các bước xuống cấp dần thay vì để client chờ tới timeout
+        deadline_cfg = serving_cfg.get("deadline", {})
+        if deadline_cfg.get("enabled", True):
+            agents["deadline_policy"] = DeadlinePolicy.from_config(deadline_cfg)
+
+        # 9. Profiling theo yêu cầu (header X-Profile của /chat, POST /admin/profile); tắt -> không tạo gì
+        profiling_cfg = serving_cfg.get("profiling", {})
+        if profiling_cfg.get("enabled", False):
+            agents["profiler"] = Profiler.from_config(profiling_cfg)
             
-        logger.info("--- HỆ THỐNG ĐÃ SẴN SÀNG ---")
+        logger.info("--- HỆ THỐNG ĐÃ SẴN SÀNG (retriever: %s) ---", readiness["retriever"])
         
     except Exception as e:
         logger.error(f"Lỗi khởi tạo hệ thống: {e}")
@@ -89,6 +232,17 @@ async def lifespan(app: FastAPI):
     yield 
 
     logger.info("Shutting down system...")
+    warmup_task = readiness.pop("warmup_task", None)
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+    if agents.get("index_manager") is not None:
+        await agents["index_manager"].close()
+    if agents.get("session_purge_task") is not None:
+        agents["session_purge_task"].cancel()
+    if agents.get("sessions") is not None:
+        agents["sessions"].close()
+    if agents.get("llm_gateway") is not None:
+        await agents["llm_gateway"].aclose()
     agents.clear()
 
 # --- Khởi tạo App FastAPI ---
@@ -103,57 +257,425 @@ app.add_middleware(
 )
 
 # --- API Endpoints ---
+def _component_state(name: str) -> str:
+    if name == "retriever" and readiness["retriever"] != "ready":
+        return readiness["retriever"]
+    if name not in agents:
+        return "not_loaded"
+    return "ready" if agents[name] is not None else "unavailable"
+
+@app.get("/health/live")
+async def liveness():
+    """ Liveness: process còn sống và event loop còn phản hồi. """
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness_check():
+    """ Readiness: 200 khi retriever đã nạp xong, 503 khi đang warm-up hoặc lỗi. """
+    state = readiness["retriever"]
+    body = {"status": state, "load_seconds": readiness["load_seconds"], "error": readiness["error"]}
+    if state != "ready":
+        return JSONResponse(status_code=503, content=body, headers={"Retry-After": "5"})
+    return body
+
 @app.get("/health")
 async def health_check():
+    retriever = agents.get("retriever")
+    components = {name: _component_state(name) for name in ("classifier", "general_gen", "specific_gen", "retriever")}
     return {
-        "status": "ok", 
-        "components": list(agents.keys()),
+        "status": "ok" if all(state == "ready" for state in components.values()) else "degraded", 
+        "components": components,
+        "readiness": {k: v for k, v in readiness.items() if k != "warmup_task"},
+        "retriever": retriever.status() if retriever is not None else None,
+        "admission": agents["admission"].status() if agents.get("admission") is not None else None,
+        "llm_endpoints": agents["llm_gateway"].status() if agents.get("llm_gateway") is not None else None,
+        "index": agents["index_manager"].status() if agents.get("index_manager") is not None else None,
         # Chỉ hiển thị tên Model đang dùng trên Cloud
         "current_model": os.getenv("LLM_MODEL_NAME", "Unknown Cloud Model") 
     }
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """ Metrics theo text format của Prometheus. """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+class IndexReloadRequest(BaseModel):
+    version: Optional[str] = None  # Mặc định: bản CURRENT trong thư mục snapshots
+    force: bool = False
+
+def _check_admin(http_request: Request):
+    """
+    Endpoint quản trị (và header X-Profile) yêu cầu header X-Admin-Token khớp biến môi trường ADMIN_TOKEN.
+    Không đặt ADMIN_TOKEN -> tắt hẳn (404), không bao giờ mở cho mọi người.
+    """
+    token = os.getenv("ADMIN_TOKEN")
+    if not token:
+        raise HTTPException(status_code=404, detail="Endpoint quản trị bị tắt (chưa đặt ADMIN_TOKEN).")
+    if not hmac.compare_digest(http_request.headers.get("X-Admin-Token", ""), token):
+        raise HTTPException(status_code=403, detail="Sai hoặc thiếu X-Admin-Token.")
+
+@app.get("/admin/index")
+async def index_status(http_request: Request):
+    _check_admin(http_request)
+    manager = agents.get("index_manager")
+    if manager is None:
+        raise HTTPException(status_code=404, detail="Index manager chưa được bật.")
+    return manager.status()
+
+@app.post("/admin/index/reload")
+async def index_reload(request: IndexReloadRequest, http_request: Request):
+    """ Nạp snapshot index mới ở background rồi hoán đổi; request đang chạy hoàn tất trên bản cũ. """
+    _check_admin(http_request)
+    manager = agents.get("index_manager")
+    if manager is None or readiness["retriever"] != "ready":
+        raise HTTPException(status_code=503, detail="Retriever chưa sẵn sàng.")
+    try:
+        return await manager.reload(request.version, force=request.force)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Lỗi nạp index mới: {e}")
+        raise HTTPException(status_code=500, detail=f"Không nạp được index mới, vẫn giữ bản cũ: {e}")
+
+class ProfileRequest(BaseModel):
+    seconds: float = 10.0
+    include_idle: Optional[bool] = None  # Giữ cả stack của thread đang chờ (I/O, khóa); mặc định theo cấu hình
+
+@app.post("/admin/profile", response_class=PlainTextResponse)
+async def profile_process(request: ProfileRequest, http_request: Request):
+    """ Lấy mẫu stack toàn process trong N giây; trả về collapsed stacks (đầu vào flamegraph.pl / speedscope). """
+    _check_admin(http_request)
+    profiler = agents.get("profiler")
+    if profiler is None:
+        raise HTTPException(status_code=404, detail="Profiling chưa được bật (profiling.enabled).")
+    try:
+        result = await profiler.sample_for(request.seconds, request.include_idle)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    with open(result.path, encoding="utf-8") as f:
+        body = f.read()
+    return PlainTextResponse(body, headers={"X-Profile-Path": result.path, "X-Profile-Samples": str(result.samples)})
+
+@contextmanager
+def _profile_scope(http_request: Request, response: Response, name: str):
+    """ Header X-Profile: sample|cprofile (cần X-Admin-Token, xem _check_admin) -> profile riêng request này. """
+    profiler = agents.get("profiler")
+    mode = http_request.headers.get("X-Profile") if profiler is not None else None
+    if not mode:
+        yield
+        return
+    _check_admin(http_request)
+    if mode not in PROFILE_MODES:
+        raise HTTPException(status_code=400, detail=f"X-Profile phải là một trong {PROFILE_MODES}.")
+    try:
+        with profiler.capture(name, mode) as result:
+            response.headers["X-Profile-Path"] = result.path
+            yield
+    except ProfilerBusy:
+        # Đang có phiên profiling khác: vẫn phục vụ request, chỉ không profile
+        response.headers["X-Profile-Path"] = "busy"
+        yield
+
+@asynccontextmanager
+async def _use_retriever():
+    """ Retriever hiện tại, được giữ (refcount) tới hết khối để hot swap không đóng nó giữa chừng. """
+    manager = agents.get("index_manager")
+    if manager is None:
+        yield agents.get("retriever")
+        return
+    async with manager.acquire() as retriever:
+        yield retriever
+
 @app.post("/chat", response_model=ChatResponse)
-async def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(request: ChatRequest, response: Response, http_request: Request):
+    query = _validate_chat_request(request)
+    policy = agents.get("deadline_policy")
+    with trace_request("chat") as trace, _budget_scope(http_request), \
+            _profile_scope(http_request, response, f"chat-{trace.request_id}"):
+        client = http_request.client.host if http_request.client else "unknown"
+        try:
+            # Client ngắt kết nối -> hủy pipeline (kể cả lời gọi LLM đang chờ)
+            result = await run_until_disconnected(
+                _admit_and_run(query, trace, request.session_id, client, request.mode),
+                http_request.is_disconnected,
+                poll_interval=policy.disconnect_poll if policy else DISCONNECT_POLL_SECONDS,
+            )
+        except ClientDisconnected:
+            trace.attributes["intent"] = "cancelled"
+            raise HTTPException(status_code=499, detail="Client đã ngắt kết nối.")
+        except AdmissionRejected as e:
+            # Trả lỗi nhanh thay vì để client chờ tới timeout
+            trace.attributes["intent"] = "rejected"
+            trace.attributes["rejected"] = e.reason
+            detail = "Bạn gửi câu hỏi quá nhanh, vui lòng thử lại sau." if e.status_code == 429 else "Hệ thống đang quá tải, vui lòng thử lại sau."
+            raise HTTPException(
+                status_code=e.status_code,
+                detail=detail,
+                headers={"Retry-After": str(max(1, math.ceil(e.retry_after))), "X-Request-ID": trace.request_id},
+            )
+        response.headers["Server-Timing"] = trace.server_timing()
+        response.headers["X-Request-ID"] = trace.request_id
+        return result
+
+def _validate_chat_request(request: ChatRequest) -> str:
     query = request.query.strip()
     if not query:
         raise HTTPException(status_code=400, detail="Câu hỏi không được để trống.")
+    if request.mode not in RESPONSE_MODES:
+        raise HTTPException(status_code=400, detail=f"mode phải là một trong {RESPONSE_MODES}.")
+    return query
+
+def _budget_scope(http_request: Request):
+    """ Deadline của request (header X-Request-Budget-Ms hoặc mặc định), hoặc không có nếu tắt. """
+    policy = agents.get("deadline_policy")
+    if policy is None:
+        return nullcontext()
+    return deadline_scope(policy.budget_for(http_request.headers.get("X-Request-Budget-Ms")))
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest, http_request: Request):
+    """
+    Như /chat nhưng trả về NDJSON: ngay sau bước truy vấn là một dòng {"type": "passage"} chứa đoạn
+    trích nguyên văn khớp nhất (kèm trích dẫn), rồi dòng {"type": "answer"} là câu trả lời đầy đủ
+    (hoặc {"type": "error"}). Client ngắt kết nối -> hủy pipeline.
+    """
+    query = _validate_chat_request(request)
+    client = http_request.client.host if http_request.client else "unknown"
+    return StreamingResponse(
+        _stream_chat(query, request.session_id, request.mode, client, _budget_scope(http_request)),
+        media_type="application/x-ndjson",
+    )
+
+async def _stream_chat(query: str, session_id: Optional[str], mode: str, client: str, budget):
+    events: asyncio.Queue = asyncio.Queue()
+
+    async def on_passage(extractive: ExtractiveAnswer):
+        await events.put({"type": "passage", **extractive.to_dict()})
+
+    async def run(trace):
+        try:
+            result = await _admit_and_run(query, trace, session_id, client, mode, on_passage)
+            await events.put({"type": "answer", "request_id": trace.request_id, **result.model_dump()})
+        except AdmissionRejected as e:
+            trace.attributes["intent"] = "rejected"
+            await events.put({"type": "error", "status": e.status_code, "detail": e.reason, "retry_after": e.retry_after})
+        except Exception as e:
+            logger.error(f"Stream chat error: {e}")
+            ERRORS.inc(stage="chat_stream")
+            await events.put({"type": "error", "status": 500, "detail": str(e)})
+        finally:
+            await events.put(None)
+
+    with trace_request("chat_stream") as trace, budget:
+        task = asyncio.create_task(run(trace))
+        try:
+            while (event := await events.get()) is not None:
+                yield json.dumps(event, ensure_ascii=False) + "\n"
+        finally:
+            # Client ngắt kết nối giữa chừng -> hủy pipeline (kể cả lời gọi LLM đang chờ)
+            task.cancel()
+
+async def _admit_and_run(
+    query: str,
+    trace,
+    session_id: Optional[str],
+    client: str,
+    mode: str = "generate",
+    on_passage: Optional[Callable[[ExtractiveAnswer], Awaitable[None]]] = None,
+) -> ChatResponse:
+    """ Rate limit theo địa chỉ client -> gộp câu hỏi trùng đang chạy -> chờ chỗ trong admission controller. """
+    rate_limiter = agents.get("rate_limiter")
+    if rate_limiter is not None:
+        # Khóa theo địa chỉ client, không theo session_id (client tự chọn được nên đổi session_id là lách được)
+        rate_limiter.check(client)
+
+    admission = agents.get("admission")
+    if admission is None:
+        return await _run_chat_pipeline(query, trace, session_id, mode, on_passage)
+
+    async def run() -> ChatResponse:
+        async with admission.slot():
+            return await _run_chat_pipeline(query, trace, session_id, mode, on_passage)
+
+    single_flight = agents.get("single_flight")
+    # Câu hỏi có session phụ thuộc lịch sử hội thoại nên không gộp với request khác;
+    # request stream nhận đoạn trích qua callback riêng nên cũng không gộp
+    if single_flight is None or session_id or on_passage is not None:
+        return await run()
+    result, shared = await single_flight.do((mode, _normalize_query(query)), run)
+    if shared:
+        trace.attributes["coalesced"] = True
+        trace.attributes["intent"] = result.intent
+    return result
+
+def _remember(session, query: str, answer: str, intent: str, standalone_query: str, documents=None, query_vector=None):
+    """ Ghi lượt hội thoại vào session (nếu request có session_id). """
+    if session is None:
+        return
+    agents["sessions"].append_turn(
+        session,
+        Turn(query=query, answer=answer, intent=intent, standalone_query=standalone_query),
+        retrieval_query=standalone_query,
+        documents=documents,
+        query_vector=query_vector,
+    )
+
+# Dùng khi retriever chưa nạp xong: chỉ NFC + teencode (bảng số hiệu / khôi phục dấu đi kèm index)
+BASIC_PREPROCESSOR = QueryPreprocessor()
+
+
+async def _within_deadline(coro, cap: Optional[str] = None):
+    """ Chờ một bước tối đa phần deadline còn lại (và trần `cap` của DeadlinePolicy); quá hạn -> asyncio.TimeoutError. """
+    deadline = current_deadline()
+    if deadline is None:
+        return await coro
+    policy = agents.get("deadline_policy")
+    return await asyncio.wait_for(coro, timeout=deadline.timeout(getattr(policy, cap) if cap else None))
+
+
+def _normalize_query(query: str) -> str:
+    retriever = agents.get("retriever")
+    preprocessor = getattr(retriever, "preprocessor", None) or BASIC_PREPROCESSOR
+    return preprocessor.process(query).text
+
+
+async def _run_chat_pipeline(
+    query: str,
+    trace,
+    session_id: Optional[str] = None,
+    mode: str = "generate",
+    on_passage: Optional[Callable[[ExtractiveAnswer], Awaitable[None]]] = None,
+) -> ChatResponse:
+    # 0. Chuẩn hóa (NFC, teencode, khôi phục dấu) trước khi phát hiện câu nối tiếp / phân loại / truy vấn
+    with span("preprocess"):
+        query = _normalize_query(query)
+
+    # Session: viết lại câu hỏi nối tiếp thành câu hỏi độc lập
+    store = agents.get("sessions")
+    condenser = agents.get("condenser")
+    session = store.get_or_create(session_id) if (session_id and store is not None) else None
+    standalone_query = query
+    follow_up = condenser is not None and condenser.is_follow_up(query, session)
+    if follow_up:
+        try:
+            with span("condense"):
+                standalone_query = await _within_deadline(condenser.condense(query, session), "condense_timeout")
+        except asyncio.TimeoutError:
+            FALLBACKS.inc(kind="condense_timeout")
+            record_degradation("condense", "timeout")
+        trace.attributes["standalone_query"] = standalone_query
+        logger.info(f"Follow-up: '{query}' -> '{standalone_query}'")
 
     # 1. Phân loại
     try:
-        intent = await agents["classifier"].classify(query)
+        with span("classify"):
+            intent = await _within_deadline(agents["classifier"].classify(standalone_query), "classify_timeout")
+    except asyncio.TimeoutError:
+        FALLBACKS.inc(kind="classifier_timeout")
+        record_degradation("classify", "timeout")
+        intent = "specific"
     except Exception as e:
         logger.error(f"Classifier Error: {e}")
+        FALLBACKS.inc(kind="classifier_error")
         intent = "specific"
     
+    trace.attributes["intent"] = intent
     logger.info(f"Input: '{query}' | Intent: {intent}")
 
     # 2. General Chat
     if intent == "general":
         try:
-            response_text = agents["general_gen"].generate_general(query)
-            return ChatResponse(response=response_text, intent="general", source_documents=[])
+            with span("general"):
+                # Chạy trong thread: remote (sync) hoặc model local đều không được chặn event loop
+                # (quá hạn: thread vẫn chạy nốt ở nền nhưng request trả lời ngay bằng câu mẫu)
+                response_text = await _within_deadline(
+                    asyncio.to_thread(agents["general_gen"].generate_general, query), "general_timeout"
+                )
+        except asyncio.TimeoutError:
+            record_degradation("general", "timeout")
+            response_text = GeneralGenerator.DEFAULT_GENERAL
         except Exception:
+            FALLBACKS.inc(kind="general_to_specific")
             intent = "specific"
+            trace.attributes["intent"] = intent
+        if intent == "general":
+            _remember(session, query, response_text, "general", standalone_query)
+            return ChatResponse(response=response_text, intent="general", source_documents=[])
 
     # 3. RAG Chat
     if intent == "specific":
-        retriever = agents.get("retriever")
-        
-        if not retriever:
-            return ChatResponse(response="DB chưa sẵn sàng.", intent="error")
+        async with _use_retriever() as retriever:
+            if not retriever:
+                trace.attributes["intent"] = "error"
+                if readiness["retriever"] == "loading":
+                    FALLBACKS.inc(kind="retriever_warming")
+                    return ChatResponse(response="Hệ thống tra cứu đang khởi động, bạn vui lòng thử lại sau ít giây.", intent="error")
+                return ChatResponse(response="DB chưa sẵn sàng.", intent="error")
 
-        # 3a. Retrieve
-        retrieved_docs = await retriever.retrieve(query, k=5)
+            # 3a. Retrieve: câu hỏi nối tiếp cùng chủ đề dùng lại kết quả của lượt trước
+            retrieved_docs = None
+            query_vector = None
+            embed_documents = retriever.embedding_model.embed_documents
+            if session is not None:
+                with span("embed"):
+                    query_vector = await retriever.aembed_query(standalone_query)
+                if follow_up:
+                    retrieved_docs = condenser.reusable_documents(session, query_vector)
+                    trace.attributes["reused_retrieval"] = retrieved_docs is not None
+            if retrieved_docs is None:
+                # Deadline: còn ít thời gian -> bỏ reranker / giảm k
+                deadline, policy = current_deadline(), agents.get("deadline_policy")
+                k, rerank = policy.retrieval_plan(deadline, 5) if deadline is not None else (5, None)
+                try:
+                    # (các bước con bm25/embed/vector/fusion/rerank được span bên trong retriever)
+                    with span("retrieve"):
+                        retrieved_docs = await _within_deadline(retriever.retrieve(standalone_query, k=k, rerank=rerank))
+                except asyncio.TimeoutError:
+                    record_degradation("retrieve", "timeout")
+                    retrieved_docs = []
+            # Vector câu hỏi retriever đã tính (nếu có) được dùng lại để chấm điểm đoạn trích
+            query_vector = query_vector or retriever.cached_query_vector(standalone_query)
         
         # 3b. Fallback
         if not retrieved_docs:
-            fallback_text = agents["general_gen"].generate_fallback(query)
+            FALLBACKS.inc(kind="no_documents")
+            trace.attributes["intent"] = "specific_fallback"
+            try:
+                with span("fallback"):
+                    fallback_text = await _within_deadline(
+                        asyncio.to_thread(agents["general_gen"].generate_fallback, standalone_query), "general_timeout"
+                    )
+            except asyncio.TimeoutError:
+                record_degradation("fallback", "timeout")
+                fallback_text = GeneralGenerator.DEFAULT_FALLBACK
+            _remember(session, query, fallback_text, "specific_fallback", standalone_query)
             return ChatResponse(response=fallback_text, intent="specific_fallback", source_documents=[])
 
-        # 3c. Generate (API Call)
-        answer = await agents["specific_gen"].generate_response(query, retrieved_docs)
-        
         sources = [doc.metadata.get("source", "Unknown") for doc in retrieved_docs]
+
+        # 3c. Trích xuất: trả lời ngay (mode extractive / auto đủ chắc chắn) hoặc stream trước câu trả lời LLM
+        extractive = None
+        if mode != "generate" or on_passage is not None:
+            with span("extractive"):
+                extractive = await asyncio.to_thread(
+                    agents["extractive"].answer, standalone_query, retrieved_docs, query_vector, embed_documents
+                )
+            trace.attributes["extractive_score"] = round(extractive.score, 4)
+            if on_passage is not None and extractive.passages:
+                await on_passage(extractive)
+            confident = mode == "auto" and extractive.score >= agents["extractive"].min_score
+            if extractive.passages and (mode == "extractive" or confident):
+                return _extractive_response(extractive, None, session, query, standalone_query, retrieved_docs, query_vector, sources, trace)
+
+        # 3d. Generate (API Call): max_tokens theo deadline còn lại; không kịp -> trích xuất từ top chunk
+        answer = await _generate_within_deadline(standalone_query, retrieved_docs)
+        if answer is None:
+            if extractive is None:
+                # Sắp hết deadline: chỉ chấm điểm từ vựng (không embed thêm)
+                with span("extractive"):
+                    extractive = agents["extractive"].answer(standalone_query, retrieved_docs)
+            return _extractive_response(extractive, EXTRACTIVE_HEADER, session, query, standalone_query, retrieved_docs, query_vector, sources, trace)
+        _remember(session, query, answer, "specific", standalone_query, retrieved_docs, query_vector)
         
         return ChatResponse(
             response=answer,
@@ -161,6 +683,170 @@ async def chat_endpoint(request: ChatRequest):
             source_documents=list(set(sources))
         )
 
+def _extractive_response(extractive: ExtractiveAnswer, header: Optional[str], session, query: str, standalone_query: str,
+                         documents, query_vector, sources: List[str], trace) -> ChatResponse:
+    """ Câu trả lời gồm các đoạn trích nguyên văn kèm trích dẫn (không qua LLM). """
+    intent = "specific_extractive"
+    trace.attributes["intent"] = intent
+    answer = extractive.format(header) if extractive.passages else GeneralGenerator.DEFAULT_FALLBACK
+    _remember(session, query, answer, intent, standalone_query, documents, query_vector)
+    return ChatResponse(
+        response=answer,
+        intent=intent,
+        source_documents=list(set(sources)),
+        citations=[p.citation() for p in extractive.passages],
+    )
+
+async def _generate_within_deadline(query: str, documents) -> Optional[str]:
+    """ Câu trả lời của LLM, hoặc None nếu deadline không đủ / lời gọi quá hạn (-> câu trả lời trích xuất). """
+    generator = agents["specific_gen"]
+    deadline = current_deadline()
+    if deadline is None:
+        with span("generate"):
+            return await generator.generate_response(query, documents)
+    plan = agents["deadline_policy"].generation_plan(deadline, generator.max_output_tokens)
+    if plan is None:
+        return None
+    max_tokens, timeout = plan
+    try:
+        with span("generate"):
+            # Hủy khi quá hạn: LLMGateway / httpx dừng các lời gọi đang chờ
+            return await asyncio.wait_for(
+                generator.generate_response(query, documents, max_tokens=max_tokens, timeout=timeout), timeout=timeout
+            )
+    except asyncio.TimeoutError:
+        record_degradation("generate", "timeout")
+        return None
+
+@app.post("/chat/batch")
+async def chat_batch_endpoint(request: BatchChatRequest, http_request: Request):
+    """
+    Trả lời nhiều câu hỏi trong một request. Kết quả được stream về dạng NDJSON
+    (mỗi dòng một BatchChatItem) theo đúng thứ tự câu hỏi đầu vào.
+    Chịu chung rate limit (theo địa chỉ client) và admission controller với /chat:
+    mỗi lời gọi phân loại / sinh câu trả lời giữ một chỗ trong admission controller.
+    """
+    queries = [q.strip() for q in request.queries]
+    if not queries:
+        raise HTTPException(status_code=400, detail="Danh sách câu hỏi không được để trống.")
+    if len(queries) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Tối đa {MAX_BATCH_SIZE} câu hỏi mỗi batch.")
+    if any(not q for q in queries):
+        raise HTTPException(status_code=400, detail="Câu hỏi không được để trống.")
+    if not agents.get("retriever"):
+        raise HTTPException(status_code=503, detail="DB chưa sẵn sàng.")
+
+    rate_limiter = agents.get("rate_limiter")
+    if rate_limiter is not None:
+        client = http_request.client.host if http_request.client else "unknown"
+        try:
+            # Một batch tốn số token bằng số câu hỏi, nhưng không quá burst (batch lớn vẫn qua được khi bucket đầy)
+            rate_limiter.check(client, cost=min(len(queries), rate_limiter.burst))
+        except AdmissionRejected as e:
+            raise HTTPException(
+                status_code=e.status_code,
+                detail="Bạn gửi câu hỏi quá nhanh, vui lòng thử lại sau.",
+                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+            )
+
+    concurrency = max(1, min(request.concurrency, MAX_BATCH_CONCURRENCY))
+    return StreamingResponse(
+        _stream_batch(queries, request.k, concurrency, request.classify, request.include_context),
+        media_type="application/x-ndjson",
+    )
+
+def _admission_slot():
+    admission = agents.get("admission")
+    return admission.slot() if admission is not None else nullcontext()
+
+def _rejected_item(i: int, query: str) -> BatchChatItem:
+    return BatchChatItem(index=i, query=query, response="Hệ thống đang quá tải, vui lòng thử lại sau.", intent="rejected")
+
+async def _stream_batch(queries: List[str], k: int, concurrency: int, classify: bool, include_context: bool):
+    # semaphore giới hạn số lời gọi của riêng batch này; bên trong, mỗi lời gọi LLM còn phải giữ một chỗ
+    # trong admission controller chung với /chat (quá tải -> câu đó bị từ chối, intent "rejected")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # 1. Phân loại (tùy chọn), cũng bị giới hạn bởi semaphore
+    intents = ["specific"] * len(queries)
+    if classify:
+        async def _classify(query: str) -> str:
+            async with semaphore:
+                try:
+                    async with _admission_slot():
+                        return await agents["classifier"].classify(query)
+                except AdmissionRejected:
+                    return "rejected"
+                except Exception:
+                    FALLBACKS.inc(kind="classifier_error")
+                    return "specific"
+        with span("classify_batch"):
+            intents = await asyncio.gather(*(_classify(q) for q in queries))
+
+    # 2. Truy vấn cả batch: embed một lần, BM25 cho cả batch
+    specific_idx = [i for i, intent in enumerate(intents) if intent not in ("general", "rejected")]
+    documents: Dict[int, list] = {}
+    retrieve_error: Optional[Exception] = None
+    if specific_idx:
+        try:
+            with span("retrieve_batch"):
+                async with _use_retriever() as retriever:
+                    results = await retriever.retrieve_batch([queries[i] for i in specific_idx], k=k)
+            documents = dict(zip(specific_idx, results))
+        except Exception as e:
+            # Không kết thúc stream im lặng: mỗi câu "specific" nhận một dòng lỗi, câu "general" vẫn được trả lời
+            logger.error(f"Batch retrieval error: {e}")
+            ERRORS.inc(stage="retrieve_batch")
+            retrieve_error = e
+
+    # 3. Sinh câu trả lời song song (giới hạn bởi semaphore)
+    async def _answer(i: int) -> BatchChatItem:
+        query = queries[i]
+        if intents[i] == "rejected":
+            return _rejected_item(i, query)
+        if intents[i] != "general" and retrieve_error is not None:
+            return BatchChatItem(
+                index=i, query=query, response=f"Xin lỗi, không truy vấn được văn bản luật: {retrieve_error}", intent="error"
+            )
+        docs = documents.get(i) or []
+        async with semaphore:
+            try:
+                async with _admission_slot():
+                    if intents[i] == "general":
+                        text = await asyncio.to_thread(agents["general_gen"].generate_general, query)
+                        return BatchChatItem(index=i, query=query, response=text, intent="general")
+                    if not docs:
+                        FALLBACKS.inc(kind="no_documents")
+                        text = await asyncio.to_thread(agents["general_gen"].generate_fallback, query)
+                        return BatchChatItem(index=i, query=query, response=text, intent="specific_fallback")
+                    answer = await agents["specific_gen"].generate_response(query, docs)
+            except AdmissionRejected:
+                return _rejected_item(i, query)
+        return BatchChatItem(
+            index=i,
+            query=query,
+            response=answer,
+            intent="specific",
+            source_documents=list(dict.fromkeys(doc.metadata.get("source", "Unknown") for doc in docs)),
+            context=[{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs] if include_context else None,
+        )
+
+    tasks = [asyncio.create_task(_answer(i)) for i in range(len(queries))]
+    try:
+        # Trả về theo thứ tự đầu vào: chờ lần lượt từng task (các task sau vẫn chạy song song)
+        for i, task in enumerate(tasks):
+            try:
+                item = await task
+            except Exception as e:
+                logger.error(f"Batch item error: {e}")
+                ERRORS.inc(stage="batch_item")
+                item = BatchChatItem(index=i, query=queries[i], response=f"Xin lỗi, có lỗi kỹ thuật: {e}", intent="error")
+            yield json.dumps(item.model_dump(), ensure_ascii=False) + "\n"
+    finally:
+        # Client ngắt kết nối giữa chừng -> hủy các lời gọi chưa xong
+        for task in tasks:
+            task.cancel()
+
 if __name__ == "__main__":
     print("🚀 Starting RAG API Server...")
     # Port này là port của cái code Python này (nó phải chạy thì mới có API mà gọi)
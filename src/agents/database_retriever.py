@@ -1,100 +1,258 @@
 import yaml
 import time
-from typing import List, Dict, Any, Optional
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
+import numpy as np
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Sequence, Tuple, TYPE_CHECKING
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 
-# IMPORT CÁC THƯ VIỆN CẦN THIẾT
-from langchain_community.retrievers import BM25Retriever
 import asyncio
-# ĐÃ BỎ IMPORT EnsembleRetriever
+
+# langchain_huggingface (torch) và langchain_chroma được import trễ trong from_config
+# để việc import module này (vd: từ main_api) không tốn vài giây.
+if TYPE_CHECKING:
+    from langchain_chroma import Chroma
+
+from src.agents.reranker import CrossEncoderReranker
+from src.agents.inference_backend import model_kwargs_for, check_parity_on_load
+from src.indexing.bm25_index import SparseBM25Index
+from src.indexing.chunk_store import ChunkStore
+from src.indexing.snapshot import resolve_config
+from src.indexing.sharding import ShardedIndex
+from src.indexing.projection import projected_collection_name, with_projection
+from src.indexing.chunk_table import ChunkTable, metadata_column, page_contents
+from src.agents.query_preprocessor import QueryPreprocessor, ProcessedQuery
+from src.agents.retrieval_policy import AdaptiveRetrievalPolicy, RetrievalPlan
+from src.serving.observability import span, CACHE_HITS, CACHE_MISSES
+from src.serving.batching import MicroBatcher
+
+logger = logging.getLogger(__name__)
+
+FUSION_METHODS = ("concat", "rrf")
 
 class DatabaseRetriever:
     """
     Công cụ truy vấn tài liệu sử dụng BM25 và Vector Search, 
-    kết quả được hợp nhất thủ công và áp dụng MMR sau cùng (nếu có).
+    kết quả được hợp nhất (concat hoặc RRF) và rerank bằng Cross-Encoder (nếu bật).
     """
     
     def __init__(
         self,
-        vector_db: Chroma,
+        vector_db: "Chroma", # hoặc MmapVectorStore (src/indexing/artifacts.py)
         embedding_model: Embeddings,
-        all_documents: List[Document], # Danh sách TẤT CẢ Documents cho BM25
+        all_documents: Sequence[Document], # TẤT CẢ chunk cho BM25 (ChunkTable / MmapDocumentList / list)
         mmr_lambda_mult: float = 0.7,
         k: int = 5, # Số lượng tài liệu top-k cuối cùng
         bm25_k: int = 10, # k cho BM25
         vector_k: int = 10, # k cho Vector Search
+        fusion: str = "concat", # "concat" (nối BM25 rồi Vector) hoặc "rrf" (Reciprocal Rank Fusion)
+        rrf_k: int = 60,
+        reranker: Optional[CrossEncoderReranker] = None,
+        use_reranker: bool = False,
+        query_cache_size: int = 1024, # Số query embedding được giữ trong LRU cache
+        bm25_k1: float = 1.5,
+        bm25_b: float = 0.75,
+        bm25_index: Optional[SparseBM25Index] = None, # Index đã build sẵn (vd: mmap từ artifacts)
+        micro_batching: Optional[Dict[str, Any]] = None, # Gom embed/rerank của các request đồng thời
+        chunk_store: Optional[ChunkStore] = None, # Mở rộng hit về Điều luật đầy đủ (parent expansion)
+        expansion_max_chars_per_doc: int = 4000,
+        expansion_max_total_chars: int = 12000,
+        preprocessor: Optional[QueryPreprocessor] = None, # Chuẩn hóa câu hỏi + tra cứu số hiệu văn bản
+        citation_boost: bool = False, # Ưu tiên chunk được trích dẫn trong câu hỏi khi hợp nhất
+        citation_boost_weight: float = 2.0, # Trọng số danh sách trích dẫn trong RRF
+        citation_boost_max_docs: int = 5, # Số chunk của Điều được trích dẫn đưa thêm vào ứng viên
+        index_version: Optional[str] = None, # Phiên bản snapshot index đang phục vụ (src/indexing/snapshot.py)
+        shards: Optional[ShardedIndex] = None, # Index chia shard theo chủ đề + router (src/indexing/sharding.py)
+        policy: Optional[AdaptiveRetrievalPolicy] = None, # Early exit / độ sâu ứng viên / rerank theo từng câu hỏi
     ):
+        if fusion not in FUSION_METHODS:
+            raise ValueError(f"fusion phải là một trong {FUSION_METHODS}, nhận được: '{fusion}'")
+
         self.vector_db = vector_db
         self.embedding_model = embedding_model
+        self.index_version = index_version
+        self.shards = shards
+        self.policy = policy
+        self.shard_top_m: Optional[int] = None # None: theo config; 0: tìm mọi shard (exhaustive, đo recall)
+        # Config model đã nạp: bản index mới cùng config dùng lại model thay vì tải lại
+        self.model_cfg: Dict[str, Any] = {}
         self.mmr_lambda_mult = mmr_lambda_mult
         self.k = k
         self.vector_k = vector_k # Giữ lại để dùng trong retrieve
         self.bm25_k = bm25_k # Giữ lại để dùng trong retrieve
+        self.fusion = fusion
+        self.rrf_k = rrf_k
+        self.reranker = reranker
+        self.use_reranker = use_reranker and reranker is not None
+        self.query_cache_size = query_cache_size
+        self._query_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._cache_lock = threading.Lock()  # retrieve_batch chạy trong thread riêng
+
+        self.chunk_store = chunk_store
+        self.preprocessor = preprocessor
+        # chunk_id -> vị trí trong self.documents (để trả kết quả tra cứu số hiệu mà không cần search)
+        self._chunk_positions: Dict[str, int] = {}
+        if preprocessor is not None:
+            self._chunk_positions = {
+                chunk_id or f"#{i}": i for i, chunk_id in enumerate(metadata_column(all_documents, "chunk_id"))
+            }
+        self.expansion_max_chars_per_doc = expansion_max_chars_per_doc
+        self.citation_boost = citation_boost and preprocessor is not None
+        self.citation_boost_weight = citation_boost_weight
+        self.citation_boost_max_docs = citation_boost_max_docs
+        self.expansion_max_total_chars = expansion_max_total_chars
+
+        # --- Micro-batching: các request /chat đồng thời dùng chung một lần forward ---
+        batch_cfg = micro_batching or {}
+        self.embed_batcher: Optional[MicroBatcher] = None
+        self.rerank_batcher: Optional[MicroBatcher] = None
+        if batch_cfg.get('enabled', False):
+            self.embed_batcher = MicroBatcher.from_config(
+                self.embedding_model.embed_documents, "query_embedding", batch_cfg
+            )
+            if reranker is not None:
+                self.rerank_batcher = MicroBatcher.from_config(
+                    reranker.score_many, "rerank", batch_cfg.get('rerank', batch_cfg)
+                )
         
-        # --- 1. Khởi tạo BM25 Retriever (Lexical Search) ---
-        self.bm25_retriever = BM25Retriever.from_documents(all_documents)
-        self.bm25_retriever.k = bm25_k
-        print(f"-> Khởi tạo BM25Retriever thành công ({len(all_documents)} docs).")
-
-        # --- 2. Khởi tạo Vector Retriever (Semantic Search) ---
-        # Vẫn dùng Similarity Search để có thể hợp nhất kết quả
-        self.vector_retriever = vector_db.as_retriever(
-            search_type="similarity",
-            search_kwargs={"k": vector_k}
+        # --- 1. Khởi tạo BM25 Index (Lexical Search, ma trận thưa tính sẵn trọng số) ---
+        self.documents = all_documents
+        t0 = time.perf_counter()
+        if bm25_index is None:
+            bm25_index = SparseBM25Index.from_texts(
+                list(page_contents(all_documents)), k1=bm25_k1, b=bm25_b
+            )
+        self.bm25_index = bm25_index
+        print(
+            f"-> SparseBM25Index sẵn sàng ({len(all_documents)} docs, "
+            f"{len(self.bm25_index.vocab)} terms, {self.bm25_index.nbytes / 1e6:.1f} MB) "
+            f"trong {time.perf_counter() - t0:.2f}s."
         )
 
-        # --- 3. ĐÃ BỎ EnsembleRetriever ---
-        # Lưu ý: Hybrid Search (RRF) đã bị loại bỏ
-        print("-> Đã loại bỏ EnsembleRetriever (RRF).")
-        print("-> DatabaseRetriever đã được khởi tạo thành công (Chế độ BM25 + Vector Riêng biệt).")
+        # --- 2. Vector Search (Semantic Search) ---
+        # Query được embed riêng rồi tìm bằng similarity_search_by_vector để đo được từng bước
+        print(f"-> DatabaseRetriever đã được khởi tạo thành công (BM25 + Vector, fusion='{fusion}', reranker={'on' if self.use_reranker else 'off'}).")
 
     @classmethod
-    def from_config(cls, config_path: str = "configs/indexing_pipeline.yml") -> 'DatabaseRetriever':
+    def from_config(
+        cls,
+        config_path: str = "configs/indexing_pipeline.yml",
+        version: Optional[str] = None,
+        reuse: Optional['DatabaseRetriever'] = None,
+    ) -> 'DatabaseRetriever':
+        """
+        - version: snapshot cần nạp khi bật `snapshots` (mặc định: bản CURRENT).
+        - reuse: retriever đang phục vụ; embedding model / reranker cùng config được dùng lại
+          (hot swap index không phải tải lại model).
+        """
         print(f"-> Loading config từ {config_path}...")
-        cfg = cls._load_config(config_path)
+        cfg, index_version = resolve_config(cls._load_config(config_path), version)
+        if index_version is not None:
+            print(f"-> Snapshot index: {index_version}")
 
-        # --- Khởi tạo Embedding Model ---
-        model_name = cfg['embedding']['model_name']
-        device = cfg['embedding'].get('device', 'cpu')
-        print(f"-> Khôi phục lại Embedding Model: {model_name} trên {device}...")
-        
-        embedding_model = HuggingFaceEmbeddings(
-            model_name=model_name,
-            model_kwargs={'device': device},
-            encode_kwargs={'normalize_embeddings': True} 
-        )
+        # --- Khởi tạo Embedding Model (chạy song song với việc đọc DB bên dưới) ---
+        pool = ThreadPoolExecutor(max_workers=1)
+        if reuse is not None and reuse.model_cfg.get('embedding') == cls._model_key(cfg['embedding']):
+            model_future = pool.submit(lambda: reuse.embedding_model)
+        else:
+            model_future = pool.submit(cls._load_embedding_model, cfg['embedding'])
+
+        # --- Chế độ multi-worker: mở artifacts mmap dùng chung thay vì Chroma ---
+        art_cfg = cfg.get('artifacts', {})
+        if art_cfg.get('use_mmap', False):
+            from src.indexing.artifacts import load_artifacts
+
+            art_dir = art_cfg.get('directory', "./data/legal_documents/artifacts")
+            print(f"-> Mở index artifacts (mmap, read-only) tại: {art_dir}")
+            try:
+                vector_db, all_documents, bm25_index, _ = load_artifacts(art_dir)
+            except Exception:
+                pool.shutdown(wait=False)
+                raise
+            embedding_model = model_future.result()
+            pool.shutdown()
+            return cls._from_parts(
+                cfg, vector_db, embedding_model, all_documents, bm25_index, index_version, reuse, vector_db.vectors
+            )
 
         # --- Kết nối vào DB ---
+        from langchain_chroma import Chroma
+
         persist_dir = cfg['data']['persist_directory']
-        collection = cfg['data']['collection_name']
+        # Bật embedding.projection: đọc collection chứa vector đã giảm chiều
+        collection = projected_collection_name(cfg)
         print(f"-> Kết nối vào Vector DB tại: {persist_dir} (Collection: {collection})")
         
+        # Không cần embedding_function: query luôn được embed riêng rồi tìm bằng vector
         vector_db = Chroma(
             persist_directory=persist_dir,
-            embedding_function=embedding_model,
             collection_name=collection
         )
         
-        # --- Tải TẤT CẢ documents cho BM25 Index ---
+        # --- Tải TẤT CẢ documents cho BM25 Index (+ embeddings nếu chia shard) ---
+        sharding = cfg.get('sharding', {}).get('enabled', False)
+        vectors = None
         try:
-            db_client = vector_db.get() 
-            all_documents = []
-            if db_client['documents']:
-                for content, metadata in zip(db_client['documents'], db_client['metadatas']):
-                    all_documents.append(Document(page_content=content, metadata=metadata))
+            db_client = vector_db.get(include=["documents", "metadatas", "embeddings"] if sharding else ["documents", "metadatas"])
+            # Bảng cột (text liền một buffer + metadata mã hóa số), Document chỉ tạo khi cần
+            all_documents = ChunkTable.from_records(db_client['documents'] or [], db_client['metadatas'] or [])
             
-            if not all_documents:
+            if not len(all_documents):
                 raise ValueError("ChromaDB không chứa Documents nào để xây dựng BM25 index.")
+            if sharding:
+                vectors = np.asarray(db_client['embeddings'], dtype=np.float32)
             
         except Exception as e:
+            pool.shutdown(wait=False)
             raise RuntimeError(f"Lỗi khi tải Documents cho BM25: {e}")
         
+        embedding_model = model_future.result()
+        pool.shutdown()
+        return cls._from_parts(cfg, vector_db, embedding_model, all_documents, None, index_version, reuse, vectors)
+
+    @classmethod
+    def _from_parts(
+        cls,
+        cfg: Dict[str, Any],
+        vector_db: Any,
+        embedding_model: Embeddings,
+        all_documents: Sequence[Document],
+        bm25_index: Optional[SparseBM25Index] = None,
+        index_version: Optional[str] = None,
+        reuse: Optional['DatabaseRetriever'] = None,
+        vectors: Optional[np.ndarray] = None,
+    ) -> 'DatabaseRetriever':
         mmr_cfg = cfg.get('retrieval', {})
+        boost_cfg = mmr_cfg.get('citation_boost', {})
+        adaptive_cfg = mmr_cfg.get('adaptive', {})
+        # Query phải được chiếu cùng phép chiếu với vector đã lưu (nếu có)
+        embedding_model = with_projection(embedding_model, cfg)
+
+        # --- Parent expansion (tùy chọn): cần chunk store do DocumentIndexer tạo ra ---
+        expansion_cfg = mmr_cfg.get('parent_expansion', {})
+        chunk_store = None
+        if expansion_cfg.get('enabled', False):
+            chunk_store = ChunkStore(cfg.get('chunk_store', {}).get('path', "./data/legal_documents/chunk_store.sqlite"))
+
+        # --- Query preprocessing: bảng số hiệu văn bản + khôi phục dấu (build lúc index) ---
+        qp_cfg = cfg.get('query_preprocessing', {})
+        preprocessor = None
+        if qp_cfg.get('enabled', True):
+            preprocessor = QueryPreprocessor.from_config(qp_cfg, all_documents)
+
+        # --- Reranker (tùy chọn, chỉ tải model khi được bật trong config) ---
+        rerank_cfg = cfg.get('reranking', {})
+        reranker = None
+        if rerank_cfg.get('enabled', False):
+            if reuse is not None and reuse.reranker is not None and reuse.model_cfg.get('reranking') == rerank_cfg:
+                reranker = reuse.reranker
+            else:
+                reranker = CrossEncoderReranker.from_config(rerank_cfg)
         
-        return cls(
+        retriever = cls(
             vector_db=vector_db,
             embedding_model=embedding_model,
             all_documents=all_documents, 
@@ -102,53 +260,461 @@ class DatabaseRetriever:
             k=mmr_cfg.get('k_final', 5), 
             bm25_k=mmr_cfg.get('bm25_k', 10),
             vector_k=mmr_cfg.get('vector_k', 10),
+            fusion=mmr_cfg.get('fusion', 'concat'),
+            rrf_k=mmr_cfg.get('rrf_k', 60),
+            reranker=reranker,
+            use_reranker=reranker is not None,
+            query_cache_size=mmr_cfg.get('query_cache_size', 1024),
+            bm25_k1=mmr_cfg.get('bm25_k1', 1.5),
+            bm25_b=mmr_cfg.get('bm25_b', 0.75),
+            bm25_index=bm25_index,
+            micro_batching=cfg.get('micro_batching'),
+            chunk_store=chunk_store,
+            expansion_max_chars_per_doc=expansion_cfg.get('max_chars_per_doc', 4000),
+            expansion_max_total_chars=expansion_cfg.get('max_total_chars', 12000),
+            preprocessor=preprocessor,
+            citation_boost=boost_cfg.get('enabled', False),
+            citation_boost_weight=boost_cfg.get('weight', 2.0),
+            citation_boost_max_docs=boost_cfg.get('max_docs', 5),
+            index_version=index_version,
+            policy=AdaptiveRetrievalPolicy.from_config(adaptive_cfg) if adaptive_cfg.get('enabled', False) else None,
         )
+        retriever.model_cfg = {'embedding': cls._model_key(cfg['embedding']), 'reranking': rerank_cfg}
+
+        # --- Sharding (tùy chọn): cắt BM25 + vector thành các shard, router chọn top-m shard mỗi query ---
+        shard_cfg = cfg.get('sharding', {})
+        if shard_cfg.get('enabled', False) and vectors is not None:
+            retriever.shards = ShardedIndex.build(
+                retriever.documents,
+                vectors,
+                retriever.bm25_index,
+                by=shard_cfg.get('by', "keywords"),
+                num_shards=shard_cfg.get('num_shards', 16),
+                max_shard_size=shard_cfg.get('max_shard_size'),
+                top_m=shard_cfg.get('top_m', 3),
+                max_workers=shard_cfg.get('max_workers', 4),
+            )
+        return retriever
 
-    async def retrieve(self, query: str, k: int = 5, filters: Optional[Dict[str, Any]] = None) -> List[Document]:
+    async def retrieve(
+        self,
+        query: str,
+        k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+        timings: Optional[Dict[str, float]] = None,
+        rerank: Optional[bool] = None,
+    ) -> List[Document]:
         """
-        Hàm đi săn tìm tài liệu, sử dụng BM25 và Vector Search, sau đó hợp nhất thủ công.
+        Hàm đi săn tìm tài liệu, sử dụng BM25 và Vector Search, sau đó hợp nhất (concat/RRF)
+        và rerank (nếu bật).
+        - timings: nếu truyền vào một dict, thời gian (ms) của từng bước sẽ được ghi vào đó
+          (bm25, embed, vector, fusion, rerank, total).
+        - rerank: False để bỏ reranker cho riêng lần gọi này (vd: sắp hết deadline); None theo cấu hình.
         """
-        print(f"\n[QUERY]: {query}")
+        logger.debug(f"[QUERY]: {query}")
+        t_start = time.perf_counter()
+
+        # --- BƯỚC 0: Chuẩn hóa câu hỏi; câu hỏi chỉ gồm trích dẫn được trả thẳng từ bảng tra cứu ---
+        processed: Optional[ProcessedQuery] = None
+        if self.preprocessor is not None:
+            with span("preprocess", timings):
+                processed = self.preprocessor.process(query)
+                direct_docs = self._lookup_documents(processed, k)
+            if direct_docs:
+                if timings is not None:
+                    timings['total'] = (time.perf_counter() - t_start) * 1000
+                return self._expand(direct_docs, timings)
+            query = processed.text
         
         # --- BƯỚC 1: Thực hiện BM25 (Lexical) và Vector Search (Semantic) riêng biệt ---
         
-        # LƯU Ý: Nếu dùng filters, bạn cần áp dụng filters cho cả hai retriever nếu chúng hỗ trợ.
-        # Hiện tại BM25Retriever trong LangChain không hỗ trợ filter dễ dàng như Vector Retriever.
-        
-        bm25_docs = self.bm25_retriever.invoke(query)
-        print(f"-> BM25 Search tìm thấy {len(bm25_docs)} đoạn.")
+        # LƯU Ý: filters hiện chỉ áp dụng cho Vector Search.
+        if self.shards is not None and not filters:
+            # Sharding: cần vector query trước để router chọn shard
+            with span("embed", timings):
+                query_vector = await self.aembed_query(query)
+            with span("shard_search", timings):
+                bm25_docs, vector_docs, plan = self._shard_search(query, query_vector)
+            if plan is not None:
+                self.policy.log(query, plan, bm25_hits=len(bm25_docs), vector_hits=len(vector_docs))
+        else:
+            # Chính sách thích ứng (nếu bật) quyết định dựa trên điểm BM25: bỏ nhánh Vector / đào sâu
+            with span("bm25", timings):
+                bm25_docs, plan = self._lexical_search([query])[0]
 
-        # Vector Retriever: Vẫn dùng Similarity Search như ban đầu
-        vector_docs = self.vector_retriever.invoke(query)
-        print(f"-> Vector Search tìm thấy {len(vector_docs)} đoạn.")
+            if plan is not None and plan.skip_vector:
+                vector_docs = []
+            else:
+                with span("embed", timings):
+                    query_vector = await self.aembed_query(query)
 
-        # --- BƯỚC 2: Hợp nhất Thủ công và Loại bỏ Trùng lặp ---
-        
-        # Tạo set chứa nội dung/source để kiểm tra trùng lặp
-        combined_docs = {}
-        for doc in bm25_docs + vector_docs:
-            # Dùng page_content làm key để loại bỏ trùng lặp
-            if doc.page_content not in combined_docs:
-                combined_docs[doc.page_content] = doc
+                with span("vector", timings):
+                    vector_k = plan.vector_k if plan is not None else self.vector_k
+                    vector_docs = self.vector_db.similarity_search_by_vector(query_vector, k=vector_k, filter=filters)
+            if plan is not None:
+                self.policy.log(query, plan, bm25_hits=len(bm25_docs), vector_hits=len(vector_docs))
+        logger.debug(f"-> BM25 Search tìm thấy {len(bm25_docs)} đoạn, Vector Search tìm thấy {len(vector_docs)} đoạn.")
 
-        # Chuyển đổi về List[Document]
-        initial_docs = list(combined_docs.values())
-        print(f"-> Hợp nhất thủ công (Loại trùng lặp) còn {len(initial_docs)} đoạn.")
-
-        # --- BƯỚC 3: Lọc kết quả cuối cùng ---
-        # Vì đã bỏ MMR và RRF, ta chỉ lấy top k đầu tiên của tập hợp nhất
-        
-        final_docs = initial_docs[:k] 
+        # --- BƯỚC 2 + 3: Hợp nhất, loại trùng lặp, rerank (nếu bật) và lấy top-k cuối cùng ---
+        boosted_docs = self._citation_documents(processed, bm25_docs + vector_docs)
+        use_reranker = self.use_reranker and rerank is not False
+        if use_reranker and self.rerank_batcher is not None:
+            initial_docs = self._fuse(bm25_docs, vector_docs, timings, boosted_docs)[: self._rerank_depth()]
+            with span("rerank", timings):
+                scores = await self.rerank_batcher.submit((query, initial_docs))
+            final_docs = self.reranker.order_by_scores(initial_docs, scores, top_n=k)
+        else:
+            final_docs = self._fuse_and_rank(query, bm25_docs, vector_docs, k, timings, boosted_docs, use_reranker)
+        final_docs = self._expand(final_docs, timings)
+        if timings is not None:
+            timings['total'] = (time.perf_counter() - t_start) * 1000
         
-        print(f"-> Trả về {len(final_docs)} đoạn cuối cùng (top-k của tập hợp nhất).")
-        
-        for i, doc in enumerate(final_docs):
-            source = doc.metadata.get('source', 'Unknown')
-            content_preview = doc.page_content.replace('\n', ' ')
-            print(f"   {i+1}. [{source}]: {content_preview[:80]}...")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"-> Trả về {len(final_docs)} đoạn cuối cùng (top-k của tập hợp nhất).")
+            for i, doc in enumerate(final_docs):
+                source = doc.metadata.get('source', 'Unknown')
+                content_preview = doc.page_content.replace('\n', ' ')
+                logger.debug(f"   {i+1}. [{source}]: {content_preview[:80]}...")
             
         return final_docs
 
+    async def retrieve_batch(
+        self,
+        queries: List[str],
+        k: int = 5,
+        filters: Optional[Dict[str, Any]] = None,
+    ) -> List[List[Document]]:
+        """
+        Truy vấn nhiều câu hỏi cùng lúc: embed tất cả query trong MỘT lần forward theo batch,
+        chấm BM25 cho cả batch, sau đó hợp nhất/rerank từng câu. Chạy trong thread riêng để
+        không chặn event loop khi batch lớn.
+        """
+        return await asyncio.to_thread(self._retrieve_batch_sync, queries, k, filters)
+
+    def _retrieve_batch_sync(self, queries: List[str], k: int, filters: Optional[Dict[str, Any]]) -> List[List[Document]]:
+        if not queries:
+            return []
+        direct: Dict[int, List[Document]] = {}
+        processed: List[Optional[ProcessedQuery]] = [None] * len(queries)
+        if self.preprocessor is not None:
+            with span("preprocess_batch"):
+                processed = [self.preprocessor.process(q) for q in queries]
+                for i, p in enumerate(processed):
+                    docs = self._lookup_documents(p, k)
+                    if docs:
+                        direct[i] = docs
+            if direct:
+                rest = [i for i in range(len(queries)) if i not in direct]
+                results = self._retrieve_batch_sync([processed[i].text for i in rest], k, filters) if rest else []
+                merged = dict(zip(rest, results))
+                merged.update({i: self._expand(docs) for i, docs in direct.items()})
+                return [merged[i] for i in range(len(queries))]
+            queries = [p.text for p in processed]
+        if self.shards is not None and not filters:
+            with span("embed_batch"):
+                query_vectors = self.embed_queries(queries)
+            with span("shard_search_batch"):
+                bm25_results, vector_results = [], []
+                for query, vec in zip(queries, query_vectors):
+                    bm25_docs, vector_docs, plan = self._shard_search(query, vec)
+                    bm25_results.append(bm25_docs)
+                    vector_results.append(vector_docs)
+                    if plan is not None:
+                        self.policy.log(query, plan, bm25_hits=len(bm25_docs), vector_hits=len(vector_docs))
+        else:
+            with span("bm25_batch"):
+                lexical = self._lexical_search(queries)
+                bm25_results = [docs for docs, _ in lexical]
+                plans = [plan for _, plan in lexical]
+
+            # Câu hỏi được early exit không cần embed / quét vector
+            need_vector = [i for i, plan in enumerate(plans) if plan is None or not plan.skip_vector]
+            with span("embed_batch"):
+                query_vectors = self.embed_queries([queries[i] for i in need_vector])
+
+            with span("vector_batch"):
+                vector_results: List[List[Document]] = [[] for _ in queries]
+                for i, vec in zip(need_vector, query_vectors):
+                    vector_k = plans[i].vector_k if plans[i] is not None else self.vector_k
+                    vector_results[i] = self.vector_db.similarity_search_by_vector(vec, k=vector_k, filter=filters)
+            for query, plan, bm25_docs, vector_docs in zip(queries, plans, bm25_results, vector_results):
+                if plan is not None:
+                    self.policy.log(query, plan, bm25_hits=len(bm25_docs), vector_hits=len(vector_docs))
+
+        return [
+            self._expand(self._fuse_and_rank(
+                query, bm25_docs, vector_docs, k, boosted_docs=self._citation_documents(p, bm25_docs + vector_docs)
+            ))
+            for query, p, bm25_docs, vector_docs in zip(queries, processed, bm25_results, vector_results)
+        ]
+
+    def _shard_search(self, query: str, query_vector: List[float]) -> Tuple[List[Document], List[Document], Optional[RetrievalPlan]]:
+        """
+        BM25 + vector trên các shard được router chọn; trả về (bm25_docs, vector_docs, plan).
+        Có chính sách thích ứng: BM25 trước (tới probe_depth), kế hoạch tính trên điểm BM25 đã gộp giữa
+        các shard (điểm so sánh được vì IDF toàn cục), rồi mới quét vector với plan.vector_k (hoặc bỏ qua).
+        Vector câu hỏi vẫn phải tính trước vì router cần nó để chọn shard.
+        """
+        if self.policy is None:
+            bm25_ids, vector_ids, shard_names = self.shards.search(
+                query, query_vector, self.bm25_k, self.vector_k, top_m=self.shard_top_m
+            )
+            logger.debug(f"-> Router chọn shard: {shard_names}")
+            return [self.documents[i] for i in bm25_ids], [self.documents[i] for i in vector_ids], None
+
+        depth = self.policy.probe_depth(self.bm25_k)
+        bm25_ids, bm25_scores, selected = self.shards.search_bm25(query, query_vector, depth, top_m=self.shard_top_m)
+        plan = self.policy.plan(bm25_scores, self.bm25_k, self.vector_k)
+        vector_ids = [] if plan.skip_vector else self.shards.search_vectors(query_vector, plan.vector_k, selected)
+        logger.debug(f"-> Router chọn shard: {[self.shards.shards[s].name for s in selected]}")
+        return [self.documents[i] for i in bm25_ids[: plan.bm25_k]], [self.documents[i] for i in vector_ids], plan
+
+    def _lexical_search(self, queries: List[str]) -> List[Tuple[List[Document], Optional[RetrievalPlan]]]:
+        """ BM25 cho cả batch (một phép nhân sparse) + kế hoạch của chính sách thích ứng cho từng câu. """
+        depth = self.policy.probe_depth(self.bm25_k) if self.policy is not None else self.bm25_k
+        results = []
+        for doc_ids, scores in self.bm25_index.search_batch(queries, k=depth):
+            plan = self.policy.plan(scores, self.bm25_k, self.vector_k) if self.policy is not None else None
+            keep = plan.bm25_k if plan is not None else self.bm25_k
+            results.append(([self.documents[i] for i in doc_ids[:keep]], plan))
+        return results
+
+    def _rerank_depth(self) -> Optional[int]:
+        """ Số ứng viên tối đa đưa vào reranker (giảm khi tải cao, nếu bật chính sách thích ứng). """
+        return self.policy.rerank_depth() if self.policy is not None else None
+
+    def _fuse_and_rank(
+        self,
+        query: str,
+        bm25_docs: List[Document],
+        vector_docs: List[Document],
+        k: int,
+        timings: Optional[Dict[str, float]] = None,
+        boosted_docs: Optional[List[Document]] = None,
+        use_reranker: Optional[bool] = None,
+    ) -> List[Document]:
+        initial_docs = self._fuse(bm25_docs, vector_docs, timings, boosted_docs)
+
+        if self.use_reranker if use_reranker is None else use_reranker:
+            with span("rerank", timings):
+                return self.reranker.rerank(query, initial_docs[: self._rerank_depth()], top_n=k)
+        return initial_docs[:k]
+
+    def _fuse(
+        self,
+        bm25_docs: List[Document],
+        vector_docs: List[Document],
+        timings: Optional[Dict[str, float]] = None,
+        boosted_docs: Optional[List[Document]] = None,
+    ) -> List[Document]:
+        # Chunk được trích dẫn là một danh sách xếp hạng riêng: đứng đầu (concat) hoặc có trọng số cao hơn (RRF)
+        ranked_lists, weights = [bm25_docs, vector_docs], [1.0, 1.0]
+        if boosted_docs:
+            ranked_lists.insert(0, boosted_docs)
+            weights.insert(0, self.citation_boost_weight)
+        with span("fusion", timings):
+            if self.fusion == "rrf":
+                initial_docs = self._rrf_fuse(ranked_lists, weights)
+            else:
+                initial_docs = self._concat_fuse(ranked_lists)
+        logger.debug(f"-> Hợp nhất ({self.fusion}, loại trùng lặp) còn {len(initial_docs)} đoạn.")
+        return initial_docs
+
+    def _lookup_documents(self, processed: ProcessedQuery, k: int) -> List[Document]:
+        """ Câu hỏi chỉ nêu số hiệu văn bản: trả k chunk đầu của văn bản đó (theo thứ tự trong văn bản). """
+        if not processed.is_lookup:
+            return []
+        positions = [self._chunk_positions[key] for key in processed.chunk_keys if key in self._chunk_positions]
+        return [self.documents[i] for i in positions[:k]]
+
+    def _citation_documents(self, processed: Optional[ProcessedQuery], candidates: List[Document]) -> List[Document]:
+        """
+        Chunk cần ưu tiên khi câu hỏi có trích dẫn nhưng không chỉ là tra cứu: các chunk của Điều
+        được nêu rõ (tối đa citation_boost_max_docs), rồi các ứng viên BM25/vector thuộc văn bản được trích dẫn.
+        """
+        if not self.citation_boost or processed is None or not processed.chunk_keys:
+            return []
+        docs = [
+            self.documents[self._chunk_positions[key]]
+            for key in processed.article_keys[: self.citation_boost_max_docs]
+            if key in self._chunk_positions
+        ]
+        cited = set(processed.chunk_keys)
+        docs.extend(doc for doc in candidates if doc.metadata.get("chunk_id") in cited)
+        return docs
+
+    def _expand(self, docs: List[Document], timings: Optional[Dict[str, float]] = None) -> List[Document]:
+        """ Thay các hit bằng Điều luật chứa nó (hoặc cửa sổ chunk lân cận) trong ngân sách ký tự. """
+        if self.chunk_store is None:
+            return docs
+        with span("expand", timings):
+            return self.chunk_store.expand(
+                docs,
+                max_chars_per_doc=self.expansion_max_chars_per_doc,
+                max_total_chars=self.expansion_max_total_chars,
+            )
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """ Embed nhiều query trong một lần forward theo batch (chỉ những query chưa có trong cache). """
+        with self._cache_lock:
+            vectors: List[Optional[List[float]]] = [self._query_cache.get(q) for q in queries]
+        missing = sorted({q for q, v in zip(queries, vectors) if v is None})
+        CACHE_HITS.inc(len(queries) - sum(v is None for v in vectors), cache="query_embedding")
+        if missing:
+            CACHE_MISSES.inc(len(missing), cache="query_embedding")
+            fresh = dict(zip(missing, self.embedding_model.embed_documents(missing)))
+            for q, vec in fresh.items():
+                self._cache_query_vector(q, vec)
+            vectors = [v if v is not None else fresh[q] for q, v in zip(queries, vectors)]
+        return vectors
+
+    def _cache_query_vector(self, query: str, vector: List[float]):
+        if self.query_cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._query_cache[query] = vector
+            if len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+
+    def clear_caches(self):
+        """ Xóa cache vector câu truy vấn và cache của QueryPreprocessor (benchmark đo từng cấu hình từ trạng thái lạnh). """
+        with self._cache_lock:
+            self._query_cache.clear()
+        if self.preprocessor is not None:
+            self.preprocessor.clear_cache()
+
+    def cached_query_vector(self, query: str) -> Optional[List[float]]:
+        """ Vector đã tính của câu truy vấn (trong LRU cache, theo câu gốc hoặc câu đã chuẩn hóa); không chạy model. """
+        keys = [query]
+        if self.preprocessor is not None:
+            keys.append(self.preprocessor.process(query).text)
+        with self._cache_lock:
+            for key in keys:
+                vector = self._query_cache.get(key)
+                if vector is not None:
+                    return vector
+        return None
+
+    def embed_query(self, query: str) -> List[float]:
+        """ Embed câu truy vấn, có LRU cache để câu hỏi lặp lại không phải chạy lại model. """
+        with self._cache_lock:
+            vector = self._query_cache.get(query)
+            if vector is not None:
+                self._query_cache.move_to_end(query)
+        if vector is not None:
+            CACHE_HITS.inc(cache="query_embedding")
+            return vector
+        CACHE_MISSES.inc(cache="query_embedding")
+        vector = self.embedding_model.embed_query(query)
+        self._cache_query_vector(query, vector)
+        return vector
+
+    async def aembed_query(self, query: str) -> List[float]:
+        """
+        Như embed_query nhưng khi micro-batching bật, cache miss được gửi vào MicroBatcher
+        để gộp chung một lần forward với các request đồng thời khác (và không chặn event loop).
+        """
+        if self.embed_batcher is None:
+            return self.embed_query(query)
+        with self._cache_lock:
+            vector = self._query_cache.get(query)
+            if vector is not None:
+                self._query_cache.move_to_end(query)
+        if vector is not None:
+            CACHE_HITS.inc(cache="query_embedding")
+            return vector
+        CACHE_MISSES.inc(cache="query_embedding")
+        vector = await self.embed_batcher.submit(query)
+        self._cache_query_vector(query, vector)
+        return vector
+
+    def status(self) -> Dict[str, Any]:
+        """ Trạng thái các thành phần đã nạp (dùng cho /health). """
+        return {
+            "embedding_model": getattr(self.embedding_model, "model_name", type(self.embedding_model).__name__),
+            "num_documents": len(self.documents),
+            "chunk_table_mb": round(self.documents.nbytes / 1e6, 1) if hasattr(self.documents, "nbytes") else None,
+            "reranker": self.reranker.model_name if self.reranker is not None else None,
+            "use_reranker": self.use_reranker,
+            "fusion": self.fusion,
+            "query_cache_entries": len(self._query_cache),
+            "micro_batching": self.embed_batcher is not None,
+            "parent_expansion": self.chunk_store is not None,
+            "query_preprocessing": self.preprocessor is not None,
+            "citation_boost": self.citation_boost,
+            "index_version": self.index_version,
+            "sharding": self.shards.status() if self.shards is not None else None,
+            "adaptive": dict(self.policy.stats) if self.policy is not None else None,
+        }
+
+    @staticmethod
+    def _concat_fuse(ranked_lists: List[List[Document]]) -> List[Document]:
+        """ Nối các danh sách theo thứ tự, dùng page_content làm key để loại trùng lặp. """
+        combined_docs = {}
+        for docs in ranked_lists:
+            for doc in docs:
+                if doc.page_content not in combined_docs:
+                    combined_docs[doc.page_content] = doc
+        return list(combined_docs.values())
+
+    def _rrf_fuse(self, ranked_lists: List[List[Document]], weights: Optional[List[float]] = None) -> List[Document]:
+        """ Reciprocal Rank Fusion: score(d) = sum w_list / (rrf_k + rank). """
+        scores: Dict[str, float] = {}
+        by_content: Dict[str, Document] = {}
+        for docs, weight in zip(ranked_lists, weights or [1.0] * len(ranked_lists)):
+            for rank, doc in enumerate(docs, start=1):
+                key = doc.page_content
+                by_content.setdefault(key, doc)
+                scores[key] = scores.get(key, 0.0) + weight / (self.rrf_k + rank)
+        ordered = sorted(scores, key=scores.get, reverse=True)
+        return [by_content[key] for key in ordered]
+
+    @staticmethod
+    def _model_key(emb_cfg: Dict[str, Any]) -> Dict[str, Any]:
+        # Phép chiếu thuộc về index (mỗi snapshot một file), không thuộc model
+        return {key: value for key, value in emb_cfg.items() if key != 'projection'}
+
+    @staticmethod
+    def _load_embedding_model(emb_cfg: Dict[str, Any]) -> Embeddings:
+        # Dùng chung một embedding worker (src/serving/embedding_service.py) nếu được cấu hình
+        if emb_cfg.get('service_address'):
+            from src.serving.embedding_service import RemoteEmbeddings
+            return RemoteEmbeddings(emb_cfg['service_address'], connect_timeout=emb_cfg.get('service_connect_timeout', 30.0))
+
+        from langchain_huggingface import HuggingFaceEmbeddings
+        from sentence_transformers import SentenceTransformer
+
+        # backend torch | onnx | onnx_int8, tự chuyển về CPU nếu không có CUDA
+        model_path, model_kwargs = model_kwargs_for(emb_cfg, SentenceTransformer)
+        print(f"-> Khôi phục lại Embedding Model: {emb_cfg['model_name']} trên {model_kwargs['device']} (backend: {emb_cfg.get('backend', 'torch')})...")
+        embedding_model = HuggingFaceEmbeddings(
+            model_name=model_path,
+            model_kwargs=model_kwargs,
+            encode_kwargs={'normalize_embeddings': True} 
+        )
+        if emb_cfg.get('backend', 'torch') != 'torch' and (emb_cfg.get('onnx') or {}).get('parity_check_on_load', False):
+            check_parity_on_load(emb_cfg, embedding_model)
+        return embedding_model
+
+    def warm_up(self):
+        """ Chạy thử một lượt forward (embedding + reranker) để request đầu tiên không phải chịu chi phí khởi động. """
+        t0 = time.perf_counter()
+        self.embedding_model.embed_query("khởi động hệ thống")
+        if self.reranker is not None:
+            self.reranker.score("khởi động", [Document(page_content="hệ thống")])
+        self.bm25_index.search("khởi động hệ thống", k=1)
+        print(f"-> Warm-up DatabaseRetriever xong trong {time.perf_counter() - t0:.2f}s.")
+
+    async def aclose(self):
+        """ Giải phóng tài nguyên riêng của bản index này (worker micro-batching, kết nối chunk store). """
+        for batcher in (self.embed_batcher, self.rerank_batcher):
+            if batcher is not None:
+                await batcher.close()
+        if self.chunk_store is not None:
+            self.chunk_store.close()
+        if self.shards is not None:
+            self.shards.close()
+
     @staticmethod
     def _load_config(path: str) -> Dict[str, Any]:
         """ Tải nội dung từ file cấu hình YAML. """
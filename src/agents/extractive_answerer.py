@@ -0,0 +1,214 @@
+"""
+Câu trả lời trích xuất: chọn nguyên văn Khoản / điểm / câu trong các chunk đã truy vấn khớp nhất
+với câu hỏi và trả kèm trích dẫn ("Khoản 2 Điều 5, Luật Khám bệnh, chữa bệnh"), không gọi LLM.
+
+- Tách đơn vị: mỗi chunk (một Điều hoặc một phần của Điều) được tách theo Khoản ("1.", "2."...),
+  điểm ("a)", "b)"...) và câu; Khoản ngắn được giữ nguyên làm một đơn vị.
+- Chấm điểm: độ phủ từ / cặp từ (âm tiết ghép) của câu hỏi, có trọng số IDF trong tập ứng viên;
+  nếu có vector câu hỏi ĐÃ TÍNH (cache của retriever) thì `max_candidates` ứng viên tốt nhất
+  được embed và trộn thêm cosine (semantic_weight). Câu hỏi không bị embed lại.
+- Thứ hạng chunk của retriever (reranker) được dùng làm ưu tiên nhẹ (rank_decay).
+
+Dùng cho: chế độ trả lời nhanh (mode="extractive" / "auto"), đoạn stream đầu tiên của /chat/stream,
+và phương án dự phòng khi hết deadline hoặc LLM không khả dụng.
+"""
+import re
+import math
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.indexing.bm25_index import default_tokenize
+
+logger = logging.getLogger(__name__)
+
+EXTRACTIVE_HEADER = "Hệ thống đang bận nên chưa thể tổng hợp câu trả lời đầy đủ. Dưới đây là trích dẫn liên quan nhất:"
+UNAVAILABLE_HEADER = "Mô hình ngôn ngữ tạm thời không khả dụng. Dưới đây là trích dẫn liên quan nhất trong văn bản luật:"
+
+_ARTICLE_HEADING = re.compile(r"^\s*(Điều\s+\d+[a-zđ]?)\.?\s*(.*)$")
+_CLAUSE = re.compile(r"^\s*(?:Khoản\s+)?(\d{1,3})\.\s+")
+_POINT = re.compile(r"^\s*([a-zđ])\)\s+")
+_SENTENCE_END = re.compile(r"(?<=[.;!?])\s+(?=[A-ZĐÀ-Ỹ0-9\"“(])")
+# Từ hỏi / hư từ không mang nội dung khi so khớp
+STOPWORDS = {
+    "là", "gì", "của", "và", "có", "được", "không", "cho", "thì", "như", "thế", "nào", "bao", "nhiêu",
+    "những", "các", "một", "này", "đó", "với", "về", "theo", "khi", "nếu", "tôi", "ai", "ở", "đâu", "sao",
+}
+
+
+@dataclass
+class Passage:
+    text: str
+    source: str
+    article: Optional[str] = None
+    clause: Optional[str] = None
+    point: Optional[str] = None
+    chunk_rank: int = 0
+    score: float = 0.0
+
+    def citation(self) -> str:
+        parts = []
+        if self.point:
+            parts.append(f"Điểm {self.point}")
+        if self.clause:
+            parts.append(f"Khoản {self.clause}")
+        if self.article and self.article != "Phần mở đầu":
+            parts.append(self.article)
+        location = " ".join(parts)
+        return f"{location}, {self.source}" if location else self.source
+
+
+@dataclass
+class ExtractiveAnswer:
+    passages: List[Passage] = field(default_factory=list)
+
+    @property
+    def score(self) -> float:
+        return self.passages[0].score if self.passages else 0.0
+
+    def format(self, header: Optional[str] = None) -> str:
+        blocks = [f"> {p.text}\n\n(Trích {p.citation()})" for p in self.passages]
+        return "\n\n".join([header, *blocks] if header else blocks)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "score": round(self.score, 4),
+            "passages": [
+                {"text": p.text, "citation": p.citation(), "score": round(p.score, 4)} for p in self.passages
+            ],
+        }
+
+
+def split_units(document: Document, chunk_rank: int = 0, max_chars: int = 600) -> List[Passage]:
+    """ Tách một chunk thành các đơn vị Khoản / điểm / câu (giữ số Khoản, ký hiệu điểm để trích dẫn). """
+    source = document.metadata.get("source", "Văn bản Luật")
+    article = document.metadata.get("article")
+    units: List[Passage] = []
+    clause: Optional[str] = None
+    block: List[Tuple[Optional[str], str]] = []  # các dòng (điểm, nội dung) của Khoản hiện tại
+
+    def flush():
+        if not block:
+            return
+        whole = " ".join(text for _, text in block)
+        if len(whole) <= max_chars:
+            units.append(Passage(whole, source, article, clause, None, chunk_rank))
+        else:
+            for point, text in block:
+                for sentence in _SENTENCE_END.split(text):
+                    if len(sentence) > 15:
+                        units.append(Passage(sentence[:max_chars], source, article, clause, point, chunk_rank))
+        block.clear()
+
+    for line in document.page_content.splitlines():
+        line = " ".join(line.split())
+        if not line:
+            continue
+        heading = _ARTICLE_HEADING.match(line)
+        if heading and not units and not block:
+            # Dòng tiêu đề "Điều 5. Quyền của người bệnh" chỉ dùng cho trích dẫn,
+            # trừ khi nội dung Điều nằm ngay trên cùng dòng (kết thúc bằng dấu câu)
+            article = article or heading.group(1)
+            line = heading.group(2)
+            if not line or line[-1] not in ".;:!?":
+                continue
+        clause_match = _CLAUSE.match(line)
+        if clause_match:
+            flush()
+            clause = clause_match.group(1)
+            block.append((None, line))
+            continue
+        point_match = _POINT.match(line)
+        block.append((point_match.group(1) if point_match else None, line))
+    flush()
+    if not units and document.page_content.strip():
+        # Không tách được (vd: chỉ có tiêu đề): dùng cả chunk làm một đơn vị
+        units.append(Passage(" ".join(document.page_content.split())[:max_chars], source, article, None, None, chunk_rank))
+    return units
+
+
+def _terms(text: str) -> List[str]:
+    """ Âm tiết (bỏ hư từ) + cặp âm tiết liền nhau (từ ghép tiếng Việt: "bảo hiểm", "người bệnh"). """
+    tokens = default_tokenize(text)
+    bigrams = [f"{a}_{b}" for a, b in zip(tokens, tokens[1:])]
+    return [t for t in tokens if t not in STOPWORDS] + bigrams
+
+
+class ExtractiveAnswerer:
+    def __init__(
+        self,
+        max_passages: int = 1,
+        max_chars: int = 600,
+        max_candidates: int = 16,
+        semantic_weight: float = 0.6,
+        rank_decay: float = 0.05,
+        min_score: float = 0.35,
+    ):
+        self.max_passages = max_passages
+        self.max_chars = max_chars
+        self.max_candidates = max_candidates
+        self.semantic_weight = semantic_weight
+        self.rank_decay = rank_decay
+        self.min_score = min_score  # mode "auto": điểm tối thiểu để trả lời trích xuất thay vì gọi LLM
+
+    @classmethod
+    def from_config(cls, extractive_cfg: Dict[str, Any]) -> 'ExtractiveAnswerer':
+        return cls(
+            max_passages=extractive_cfg.get('max_passages', 1),
+            max_chars=extractive_cfg.get('max_chars', 600),
+            max_candidates=extractive_cfg.get('max_candidates', 16),
+            semantic_weight=extractive_cfg.get('semantic_weight', 0.6),
+            rank_decay=extractive_cfg.get('rank_decay', 0.05),
+            min_score=extractive_cfg.get('min_score', 0.35),
+        )
+
+    def answer(
+        self,
+        query: str,
+        documents: Sequence[Document],
+        query_vector: Optional[Sequence[float]] = None,
+        embed_documents: Optional[Callable[[List[str]], List[List[float]]]] = None,
+    ) -> ExtractiveAnswer:
+        """
+        Các đoạn khớp nhất (giảm dần theo điểm 0..1).
+        - query_vector / embed_documents: vector câu hỏi đã có sẵn và hàm embed của retriever;
+          thiếu một trong hai -> chỉ chấm điểm từ vựng.
+        """
+        units = [u for rank, doc in enumerate(documents) for u in split_units(doc, rank, self.max_chars)]
+        if not units:
+            return ExtractiveAnswer()
+
+        lexical = self._lexical_scores(query, units)
+        scores = lexical - self.rank_decay * np.array([u.chunk_rank for u in units], dtype=np.float32)
+        if query_vector is not None and embed_documents is not None and self.semantic_weight > 0:
+            candidates = np.argsort(-scores, kind="stable")[: self.max_candidates]
+            vectors = np.asarray(embed_documents([units[i].text for i in candidates]), dtype=np.float32)
+            q = np.asarray(query_vector, dtype=np.float32)
+            cosine = vectors @ q / np.maximum(np.linalg.norm(vectors, axis=1) * np.linalg.norm(q), 1e-12)
+            # Chỉ các ứng viên đã embed mới có thể được chọn
+            blended = np.full_like(scores, -np.inf)
+            blended[candidates] = (1 - self.semantic_weight) * scores[candidates] + self.semantic_weight * cosine
+            scores = blended
+
+        order = np.argsort(-scores, kind="stable")[: self.max_passages]
+        passages = []
+        for i in order:
+            units[i].score = float(scores[i])
+            passages.append(units[i])
+        logger.debug(f"[EXTRACTIVE] {len(units)} đơn vị, điểm cao nhất {passages[0].score:.3f} cho '{query[:60]}'")
+        return ExtractiveAnswer(passages)
+
+    @staticmethod
+    def _lexical_scores(query: str, units: List[Passage]) -> np.ndarray:
+        """ Tỉ lệ trọng số IDF (trong tập đơn vị ứng viên) của các term câu hỏi xuất hiện trong đơn vị. """
+        query_terms = set(_terms(query))
+        unit_terms = [set(_terms(u.text)) & query_terms for u in units]
+        if not query_terms:
+            return np.zeros(len(units), dtype=np.float32)
+        n = len(units)
+        weights = {t: math.log(1 + n / (1 + sum(t in terms for terms in unit_terms))) for t in query_terms}
+        total = sum(weights.values())
+        return np.array([sum(weights[t] for t in terms) / total for terms in unit_terms], dtype=np.float32)
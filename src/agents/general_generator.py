@@ -1,8 +1,14 @@
 import os
+import logging
 from groq import Groq
-from typing import Optional
+from typing import Dict, Optional
 
 from src.utils import load_env
+from src.serving.observability import ERRORS
+from src.agents.llm_gateway import LLMGateway
+from src.agents.local_backend import LocalBackend, LOCAL_GENERATIONS
+
+logger = logging.getLogger(__name__)
 
 
 class GeneralGenerator:
@@ -11,18 +17,30 @@ class GeneralGenerator:
     khi hệ thống RAG không tìm được câu trả lời cụ thể, có giới hạn độ dài.
     (Đã chuyển sang dùng Groq API - Đồng bộ)
     """
+    # Câu trả lời cố định khi model lỗi hoặc hết thời gian (deadline của request)
+    DEFAULT_GENERAL = "Tôi rất sẵn lòng giúp đỡ bạn!"
+    DEFAULT_FALLBACK = "Xin lỗi, hiện tại tôi chưa thể tìm thấy thông tin phù hợp với yêu cầu này. Bạn vui lòng thử lại bằng cách diễn đạt khác hoặc đặt câu hỏi về một chủ đề khác nhé."
+
     def __init__(
         self, 
         api_key: str, 
         model_id: str = "llama-3.1-8b-instant",
-        max_output_tokens: int = 100
+        max_output_tokens: int = 100,
+        base_url: Optional[str] = None,
+        gateway: Optional[LLMGateway] = None,
+        local_backends: Optional[Dict[str, Optional[LocalBackend]]] = None, # {"general"|"fallback": backend}, None = remote
+        local_fallback_to_remote: bool = True, # Backend local không xử lý được -> gọi remote
     ):
-        self.client = Groq(api_key=api_key) 
+        self.client = Groq(api_key=api_key, base_url=base_url) if gateway is None else None
+        self.gateway = gateway
         self.model_id = model_id
         self.max_output_tokens = max_output_tokens 
         self.general_temperature = 0.7 
         self.fallback_temperature = 0.3 
-        print(f"-> GeneralGenerator (Groq) ready. Model: {self.model_id}. Max output: {self.max_output_tokens} tokens.")
+        self.local_backends = local_backends or {}
+        self.local_fallback_to_remote = local_fallback_to_remote
+        local = {kind: b.name for kind, b in self.local_backends.items() if b is not None}
+        print(f"-> GeneralGenerator (Groq) ready. Model: {self.model_id}. Max output: {self.max_output_tokens} tokens. Local: {local or 'none'}.")
 
     def generate_general(self, user_input: str) -> str:
         prompt = f"""Bạn là một trợ lý ảo thân thiện và lịch sự trong lĩnh vực thủ tục hành chính trong y tế công.
@@ -31,11 +49,12 @@ class GeneralGenerator:
                     Input: "{user_input}"
                     Response:"""
         try:
-            response = self._call_model(prompt, self.general_temperature) 
+            response = self._respond("general", user_input, prompt, self.general_temperature)
             return response
         except Exception as e:
-            print(f"Error in general generation: {e}")
-            return "Tôi rất sẵn lòng giúp đỡ bạn!"
+            logger.warning(f"Error in general generation: {e}")
+            ERRORS.inc(stage="general")
+            return self.DEFAULT_GENERAL
 
     def generate_fallback(self, query: str) -> str:
         prompt = f"""Bạn là Trợ lý ảo Hỗ trợ thủ tục hành chính trong Y tế Công.
@@ -46,13 +65,36 @@ class GeneralGenerator:
                     Câu hỏi chưa tìm được đáp án: "{query}"
                     Phản hồi dự phòng:"""
         try:
-            response = self._call_model(prompt, self.fallback_temperature)
+            response = self._respond("fallback", query, prompt, self.fallback_temperature)
             return response
         except Exception as e:
-            print(f"Error in fallback generation: {e}")
-            return "Xin lỗi, hiện tại tôi chưa thể tìm thấy thông tin phù hợp với yêu cầu này. Bạn vui lòng thử lại bằng cách diễn đạt khác hoặc đặt câu hỏi về một chủ đề khác nhé."
+            logger.warning(f"Error in fallback generation: {e}")
+            ERRORS.inc(stage="fallback")
+            return self.DEFAULT_FALLBACK
             
+    def _respond(self, kind: str, text: str, prompt: str, temperature: float) -> str:
+        """ Thử backend local của loại phản hồi này trước; chỉ gọi remote khi local không trả lời được. """
+        backend = self.local_backends.get(kind)
+        if backend is not None:
+            try:
+                answer = backend.generate(kind, text, prompt, self.max_output_tokens, temperature)
+            except Exception as e:
+                logger.warning(f"Local {backend.name} backend failed ({kind}): {e}")
+                ERRORS.inc(stage=f"local_{kind}")
+                answer = None
+            if answer:
+                LOCAL_GENERATIONS.inc(kind=kind, backend=backend.name)
+                return answer
+            if not self.local_fallback_to_remote:
+                raise LookupError(f"Backend {backend.name} không có câu trả lời cho '{text}'.")
+        return self._call_model(prompt, temperature)
+
     def _call_model(self, prompt: str, temperature: float) -> str:
+        if self.gateway is not None:
+            content = self.gateway.chat_sync(
+                [{"role": "user", "content": prompt}], max_tokens=self.max_output_tokens, temperature=temperature, role="general"
+            )
+            return content.strip()
         response = self.client.chat.completions.create(
             model=self.model_id,
             messages=[
@@ -0,0 +1,228 @@
+"""
+Chọn backend suy luận cho bi-encoder và reranker (mục `backend` trong `embedding` / `reranking`):
+
+- "torch"     : PyTorch như cũ (mặc định).
+- "onnx"      : ONNX Runtime, model được export một lần vào `onnx.export_dir`.
+- "onnx_int8" : ONNX Runtime + lượng tử hóa động int8 (nhanh và nhẹ nhất trên CPU).
+
+Nếu config ghi `device: cuda` mà máy không có GPU, thiết bị tự chuyển về CPU.
+
+Export + kiểm tra độ khớp (cosine) với embedding PyTorch, kèm so sánh latency/bộ nhớ:
+    python -m src.agents.inference_backend --config configs/indexing_pipeline.yml
+"""
+import os
+import time
+import logging
+import argparse
+from typing import List, Dict, Any, Callable, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("torch", "onnx", "onnx_int8")
+PARITY_TEXTS = [
+    "Bảo hiểm y tế là gì?",
+    "Trường hợp nào được hưởng 100% chi phí khi đi khám bảo hiểm?",
+    "Quy định về trách nhiệm của bệnh viện trong việc tiếp nhận người bệnh",
+    "Điều 22. Mức hưởng bảo hiểm y tế khi khám bệnh, chữa bệnh đúng tuyến",
+    "Thông tư 36/2021/TT-BYT hướng dẫn về khám bệnh, chữa bệnh và thanh toán chi phí",
+]
+
+
+def resolve_device(device: str) -> str:
+    """ Trả về 'cpu' nếu config yêu cầu CUDA nhưng máy không có GPU (hoặc không có torch CUDA). """
+    if not device or not device.startswith("cuda"):
+        return device or "cpu"
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return device
+    except ImportError:
+        pass
+    print(f"-> CUDA không khả dụng, chuyển thiết bị '{device}' -> 'cpu'.")
+    return "cpu"
+
+
+def _onnx_cfg(cfg: Dict[str, Any]) -> Dict[str, Any]:
+    onnx_cfg = dict(cfg.get('onnx') or {})
+    safe_name = cfg['model_name'].replace("/", "__")
+    onnx_cfg.setdefault('export_dir', os.path.join("./data/models/onnx", safe_name))
+    onnx_cfg.setdefault('quantization', "avx2")  # "arm64" | "avx2" | "avx512" | "avx512_vnni"
+    return onnx_cfg
+
+
+def _onnx_file_name(backend: str, onnx_cfg: Dict[str, Any]) -> str:
+    if backend == "onnx_int8":
+        return f"onnx/model_qint8_{onnx_cfg['quantization']}.onnx"
+    return "onnx/model.onnx"
+
+
+def ensure_onnx_export(cfg: Dict[str, Any], model_cls: Any) -> str:
+    """
+    Export model sang ONNX (và bản int8 nếu cần) vào export_dir nếu chưa có, trả về đường dẫn model.
+    `model_cls` là SentenceTransformer hoặc CrossEncoder (sentence-transformers >= 4.1, cần optimum[onnxruntime]).
+    """
+    backend = cfg.get('backend', "torch")
+    onnx_cfg = _onnx_cfg(cfg)
+    export_dir = onnx_cfg['export_dir']
+    target = os.path.join(export_dir, _onnx_file_name(backend, onnx_cfg))
+    if os.path.exists(target):
+        return export_dir
+
+    print(f"-> Export {cfg['model_name']} sang ONNX tại {export_dir} (lần đầu, có thể mất vài phút)...")
+    t0 = time.perf_counter()
+    # backend="onnx" tự export từ checkpoint PyTorch khi repo HF chưa có file ONNX
+    model = model_cls(cfg['model_name'], device="cpu", backend="onnx")
+    model.save_pretrained(export_dir)
+    if backend == "onnx_int8":
+        from sentence_transformers import export_dynamic_quantized_onnx_model
+        export_dynamic_quantized_onnx_model(model, onnx_cfg['quantization'], export_dir)
+    print(f"-> Export xong trong {time.perf_counter() - t0:.1f}s.")
+    return export_dir
+
+
+def model_kwargs_for(cfg: Dict[str, Any], model_cls: Any) -> Tuple[str, Dict[str, Any]]:
+    """
+    Tham số khởi tạo cho SentenceTransformer / CrossEncoder theo backend trong config:
+    (đường dẫn model, {'device', 'backend', 'model_kwargs'}).
+    """
+    backend = cfg.get('backend', "torch")
+    if backend not in BACKENDS:
+        raise ValueError(f"backend phải là một trong {BACKENDS}, nhận được: '{backend}'")
+
+    device = resolve_device(cfg.get('device', 'cpu'))
+    if backend == "torch":
+        return cfg['model_name'], {"device": device}
+
+    onnx_cfg = _onnx_cfg(cfg)
+    provider = "CUDAExecutionProvider" if device.startswith("cuda") else "CPUExecutionProvider"
+    return ensure_onnx_export(cfg, model_cls), {
+        "device": device,
+        "backend": "onnx",
+        "model_kwargs": {"file_name": _onnx_file_name(backend, onnx_cfg), "provider": provider},
+    }
+
+
+def cosine_parity(reference: np.ndarray, candidate: np.ndarray) -> np.ndarray:
+    """ Cosine từng dòng giữa embedding tham chiếu (PyTorch) và embedding của backend mới. """
+    reference = np.asarray(reference, dtype=np.float32)
+    candidate = np.asarray(candidate, dtype=np.float32)
+    num = (reference * candidate).sum(axis=1)
+    den = np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    return num / np.maximum(den, 1e-12)
+
+
+def check_parity_on_load(emb_cfg: Dict[str, Any], embedding_model: Any, texts: List[str] = PARITY_TEXTS):
+    """
+    So embedding của backend ONNX vừa nạp với PyTorch trên vài câu mẫu; lỗi nếu cosine < parity_threshold.
+    Tốn thêm một lần nạp model PyTorch (được giải phóng ngay sau đó), nên chỉ bật khi cần.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    reference = SentenceTransformer(emb_cfg['model_name'], device="cpu")
+    ref_vecs = reference.encode(texts, normalize_embeddings=True)
+    del reference
+    cosines = cosine_parity(ref_vecs, embedding_model.embed_documents(texts))
+    threshold = _onnx_cfg(emb_cfg).get('parity_threshold', 0.99)
+    print(f"-> Parity {emb_cfg.get('backend')} vs torch: min cosine {cosines.min():.4f} (ngưỡng {threshold}).")
+    if cosines.min() < threshold:
+        raise RuntimeError(
+            f"Backend {emb_cfg.get('backend')} lệch so với PyTorch (min cosine {cosines.min():.4f} < {threshold})."
+        )
+
+
+def reranker_parity(rerank_cfg: Dict[str, Any], pairs: List[Tuple[str, str]]) -> Dict[str, Any]:
+    """ So điểm reranker của backend trong config với PyTorch: sai số tuyệt đối lớn nhất và thứ hạng. """
+    from sentence_transformers import CrossEncoder
+
+    max_length = rerank_cfg.get('max_length', 512)
+    reference = CrossEncoder(rerank_cfg['model_name'], device="cpu", max_length=max_length)
+    ref_scores = np.asarray(reference.predict(pairs), dtype=np.float32)
+    path, kwargs = model_kwargs_for({**rerank_cfg, 'device': 'cpu'}, CrossEncoder)
+    candidate = CrossEncoder(path, max_length=max_length, **kwargs)
+    cand_scores = np.asarray(candidate.predict(pairs), dtype=np.float32)
+    return {
+        "backend": rerank_cfg.get('backend', "torch"),
+        "max_abs_diff": float(np.abs(ref_scores - cand_scores).max()),
+        "same_ranking": bool((np.argsort(-ref_scores) == np.argsort(-cand_scores)).all()),
+    }
+
+
+def _rss_mb() -> float:
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:  # Windows
+        return float("nan")
+
+
+def _median_latency_ms(fn: Callable[[], Any], repeats: int) -> float:
+    fn()  # warm-up
+    samples = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return float(np.median(samples))
+
+
+def parity_report(cfg: Dict[str, Any], texts: List[str], repeats: int = 20) -> Dict[str, Any]:
+    """ So sánh backend trong config với PyTorch: cosine nhỏ nhất, latency 1 query, RSS sau khi nạp. """
+    from sentence_transformers import SentenceTransformer
+
+    emb_cfg = cfg['embedding']
+    reference = SentenceTransformer(emb_cfg['model_name'], device="cpu")
+    rss_torch = _rss_mb()
+    ref_vecs = reference.encode(texts, normalize_embeddings=True)
+    torch_ms = _median_latency_ms(lambda: reference.encode([texts[0]], normalize_embeddings=True), repeats)
+
+    path, kwargs = model_kwargs_for({**emb_cfg, 'device': 'cpu'}, SentenceTransformer)
+    candidate = SentenceTransformer(path, **kwargs)
+    cand_vecs = candidate.encode(texts, normalize_embeddings=True)
+    cand_ms = _median_latency_ms(lambda: candidate.encode([texts[0]], normalize_embeddings=True), repeats)
+
+    cosines = cosine_parity(ref_vecs, cand_vecs)
+    threshold = _onnx_cfg(emb_cfg).get('parity_threshold', 0.99)
+    return {
+        "backend": emb_cfg.get('backend', "torch"),
+        "min_cosine": float(cosines.min()),
+        "mean_cosine": float(cosines.mean()),
+        "threshold": threshold,
+        "passed": bool(cosines.min() >= threshold),
+        "torch_query_ms": round(torch_ms, 2),
+        "backend_query_ms": round(cand_ms, 2),
+        # ru_maxrss là đỉnh của cả process, nên chỉ mang tính tham khảo
+        "peak_rss_mb_after_torch": round(rss_torch, 1),
+        "peak_rss_mb_after_backend": round(_rss_mb(), 1),
+    }
+
+
+def main():
+    import json
+    from src.utils import extract_config
+
+    parser = argparse.ArgumentParser(description="Export ONNX/int8 và kiểm tra độ khớp với PyTorch.")
+    parser.add_argument("--config", type=str, default="configs/indexing_pipeline.yml")
+    parser.add_argument("--backend", type=str, choices=BACKENDS[1:], default=None, help="Ghi đè embedding.backend")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    cfg = extract_config(args.config)
+    if args.backend:
+        cfg['embedding']['backend'] = args.backend
+    if cfg['embedding'].get('backend', "torch") == "torch":
+        raise SystemExit("embedding.backend đang là 'torch': chọn --backend onnx hoặc onnx_int8.")
+
+    report = parity_report(cfg, PARITY_TEXTS, repeats=args.repeats)
+    rerank_cfg = cfg.get('reranking', {})
+    if rerank_cfg.get('backend', "torch") != "torch":
+        pairs = [(PARITY_TEXTS[0], text) for text in PARITY_TEXTS[1:]]
+        report["reranker"] = reranker_parity(rerank_cfg, pairs)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if not report["passed"]:
+        raise SystemExit(f"Parity FAILED: min cosine {report['min_cosine']:.4f} < {report['threshold']}")
+
+
+if __name__ == "__main__":
+    main()
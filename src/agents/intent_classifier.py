@@ -1,8 +1,14 @@
 import os
 import asyncio
+import logging
+from typing import Optional
 from groq import AsyncGroq
 from groq.types.chat import ChatCompletionMessageParam
 from src.utils import load_env 
+from src.serving.observability import FALLBACKS
+from src.agents.llm_gateway import LLMGateway
+
+logger = logging.getLogger(__name__)
 
 
 class IntentClassifier:
@@ -10,11 +16,15 @@ class IntentClassifier:
         self,
         api_key,
         model_id: str = "llama-3.1-8b-instant",
+        base_url: Optional[str] = None,
+        gateway: Optional[LLMGateway] = None,
     ):
-        if not api_key:
+        if not api_key and gateway is None:
             raise ValueError(f"API Key for {model_id} not found.")
             
-        self.client = AsyncGroq(api_key=api_key)
+        # base_url cho phép trỏ sang server tương thích khác (vd: mock server khi benchmark)
+        self.client = AsyncGroq(api_key=api_key, base_url=base_url) if gateway is None else None
+        self.gateway = gateway
         self.model_id = model_id
         print(f'>> Intention Classifier has been established successfully.')
         print('--- Model Details ---')
@@ -55,14 +65,18 @@ Class:"""
         ]
 
         try:
-            response = await self.client.chat.completions.create(
-                model=self.model_id,
-                messages=messages,
-                temperature=0.0,
-                max_tokens=10
-            )
+            if self.gateway is not None:
+                content = await self.gateway.chat(messages, max_tokens=10, temperature=0.0, role="classifier")
+            else:
+                response = await self.client.chat.completions.create(
+                    model=self.model_id,
+                    messages=messages,
+                    temperature=0.0,
+                    max_tokens=10
+                )
+                content = response.choices[0].message.content
             
-            result_text = response.choices[0].message.content.strip().lower()
+            result_text = content.strip().lower()
             
             if "general" in result_text:
                 return "general"
@@ -72,6 +86,8 @@ Class:"""
                 return "specific"
 
         except Exception as e:
+            logger.warning(f"Classifier call failed, defaulting to 'specific': {e}")
+            FALLBACKS.inc(kind="classifier_error")
             return "specific"
 
 
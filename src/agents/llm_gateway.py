@@ -0,0 +1,395 @@
+"""
+LLM gateway: một danh sách có thứ tự các endpoint tương thích OpenAI (/chat/completions)
+dùng chung cho SpecificGenerator, GeneralGenerator và IntentClassifier.
+
+- Health scoring: mỗi endpoint có điểm sức khỏe (EWMA tỉ lệ thành công) và cửa sổ latency gần nhất.
+  Endpoint có điểm dưới `min_health` bị xếp sau các endpoint khỏe (vẫn giữ thứ tự trong config).
+- Circuit breaker: `failure_threshold` lỗi liên tiếp (timeout, 429, 5xx, lỗi kết nối) -> mở mạch
+  trong `reset_timeout_seconds` (hoặc theo Retry-After của 429); hết hạn thì cho MỘT request thử (half-open).
+- Hedging: nếu endpoint chính chưa trả lời sau p95 latency của nó, gửi thêm một request trùng
+  sang endpoint kế tiếp; response nào về trước thì dùng, request còn lại bị hủy.
+- Failover: request lỗi -> chuyển ngay sang endpoint kế tiếp (không chờ p95).
+  Riêng 4xx khác 429 (payload sai, khóa API sai...) được ném thẳng cho caller (httpx.HTTPStatusError),
+  không failover và không tính vào circuit breaker.
+
+Bản đồng bộ (`chat_sync`, cho GeneralGenerator) chỉ có failover + circuit breaker, không hedging.
+Thử với server giả lập: `python -m src.benchmark.mock_llm_server --port 9000` (và 9001 với --latency-ms lớn hơn).
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from src.serving.observability import REGISTRY, Counter, Gauge, Histogram
+
+logger = logging.getLogger(__name__)
+
+LLM_REQUESTS = REGISTRY.register(Counter(
+    "rag_llm_requests_total", "Số request tới từng LLM endpoint theo kết quả.", ("endpoint", "outcome")
+))
+LLM_LATENCY = REGISTRY.register(Histogram(
+    "rag_llm_latency_seconds", "Latency của các request LLM thành công.", ("endpoint",)
+))
+LLM_HEDGES = REGISTRY.register(Counter(
+    "rag_llm_hedges_total", "Số request hedge (gửi trùng) theo endpoint nhận request hedge.", ("endpoint",)
+))
+CIRCUIT_OPEN = REGISTRY.register(Gauge(
+    "rag_llm_circuit_open", "1 nếu circuit breaker của endpoint đang mở.", ("endpoint",)
+))
+
+
+class LLMGatewayError(Exception):
+    """ Mọi endpoint đều lỗi hoặc đang mở mạch. """
+
+
+@dataclass
+class LLMEndpoint:
+    name: str
+    url: str                                     # URL đầy đủ tới /chat/completions
+    model: str
+    api_key: Optional[str] = None
+    timeout: float = 60.0
+    models: Dict[str, str] = field(default_factory=dict)  # Model riêng theo vai trò, vd: {"classifier": "..."}
+
+    def model_for(self, role: str) -> str:
+        return self.models.get(role, self.model)
+
+
+class EndpointState:
+    """ Điểm sức khỏe, cửa sổ latency và circuit breaker của một endpoint. """
+    def __init__(self, window: int = 200):
+        self.latencies: deque = deque(maxlen=window)
+        self.health = 1.0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.half_open_probe = False
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        with self._lock:
+            if self.open_until == 0.0:
+                return True
+            # Hết thời gian mở mạch: cho đúng một request thử (half-open)
+            return time.monotonic() >= self.open_until and not self.half_open_probe
+
+    def begin(self):
+        with self._lock:
+            if self.open_until != 0.0:
+                self.half_open_probe = True
+
+    def release_probe(self):
+        """ Request thử bị hủy (request hedge khác thắng): để request sau được thử lại. """
+        with self._lock:
+            self.half_open_probe = False
+
+    def record_success(self, latency: float):
+        with self._lock:
+            self.latencies.append(latency)
+            self.health = 0.9 * self.health + 0.1
+            self.consecutive_failures = 0
+            self.open_until = 0.0
+            self.half_open_probe = False
+
+    def record_failure(self, failure_threshold: int, reset_timeout: float, retry_after: Optional[float] = None) -> bool:
+        """ Ghi nhận lỗi; trả về True nếu mạch vừa được mở. """
+        with self._lock:
+            self.health = 0.9 * self.health
+            self.consecutive_failures += 1
+            if self.half_open_probe or self.consecutive_failures >= failure_threshold or retry_after:
+                # 429 kèm Retry-After: mở mạch đúng khoảng thời gian provider yêu cầu
+                self.open_until = time.monotonic() + (retry_after or reset_timeout)
+                self.half_open_probe = False
+                return True
+            return False
+
+    def quantile(self, q: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self.latencies) < min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        endpoints: List[LLMEndpoint],
+        hedging: bool = True,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay_ms: float = 200.0,
+        hedge_default_delay_ms: float = 2000.0,
+        hedge_min_samples: int = 20,
+        failure_threshold: int = 5,
+        reset_timeout_seconds: float = 30.0,
+        max_retry_after_seconds: float = 60.0,
+        min_health: float = 0.5,
+    ):
+        if not endpoints:
+            raise ValueError("LLMGateway cần ít nhất một endpoint.")
+        self.endpoints = endpoints
+        self.states: Dict[str, EndpointState] = {ep.name: EndpointState() for ep in endpoints}
+        self.hedging = hedging and len(endpoints) > 1
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay_ms / 1000
+        self.hedge_default_delay = hedge_default_delay_ms / 1000
+        self.hedge_min_samples = hedge_min_samples
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout_seconds
+        self.max_retry_after = max_retry_after_seconds
+        self.min_health = min_health
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sync_client: Optional[httpx.Client] = None
+        names = ", ".join(f"{ep.name} ({ep.model})" for ep in endpoints)
+        print(f"-> LLMGateway ready: {names} | hedging={'on' if self.hedging else 'off'}.")
+
+    @classmethod
+    def from_config(cls, gateway_cfg: Dict[str, Any]) -> 'LLMGateway':
+        """
+        Mỗi endpoint trong config có thể lấy url / api_key / model từ biến môi trường
+        (`url_env`, `api_key_env`, `model_env`); endpoint thiếu url hoặc model bị bỏ qua.
+        """
+        endpoints = []
+        for ep_cfg in gateway_cfg.get('endpoints', []):
+            url = os.getenv(ep_cfg['url_env']) if ep_cfg.get('url_env') else None
+            model = os.getenv(ep_cfg['model_env']) if ep_cfg.get('model_env') else None
+            url, model = url or ep_cfg.get('url'), model or ep_cfg.get('model')
+            if not url or not model:
+                logger.warning(f"Bỏ qua LLM endpoint '{ep_cfg.get('name')}': thiếu url hoặc model.")
+                continue
+            endpoints.append(LLMEndpoint(
+                name=ep_cfg.get('name', url),
+                url=url,
+                model=model,
+                api_key=os.getenv(ep_cfg['api_key_env']) if ep_cfg.get('api_key_env') else ep_cfg.get('api_key'),
+                timeout=ep_cfg.get('timeout_seconds', 60.0),
+                models=ep_cfg.get('models') or {},
+            ))
+        hedge_cfg = gateway_cfg.get('hedging', {})
+        breaker_cfg = gateway_cfg.get('circuit_breaker', {})
+        return cls(
+            endpoints,
+            hedging=hedge_cfg.get('enabled', True),
+            hedge_quantile=hedge_cfg.get('quantile', 0.95),
+            hedge_min_delay_ms=hedge_cfg.get('min_delay_ms', 200),
+            hedge_default_delay_ms=hedge_cfg.get('default_delay_ms', 2000),
+            hedge_min_samples=hedge_cfg.get('min_samples', 20),
+            failure_threshold=breaker_cfg.get('failure_threshold', 5),
+            reset_timeout_seconds=breaker_cfg.get('reset_timeout_seconds', 30),
+            max_retry_after_seconds=breaker_cfg.get('max_retry_after_seconds', 60),
+            min_health=gateway_cfg.get('min_health', 0.5),
+        )
+
+    # ------------------------------------------------------------------ #
+    def _ordered_endpoints(self) -> List[LLMEndpoint]:
+        """ Endpoint khả dụng: khỏe trước, yếu sau; trong mỗi nhóm giữ thứ tự config. """
+        healthy, weak = [], []
+        for ep in self.endpoints:
+            state = self.states[ep.name]
+            if not state.available():
+                continue
+            (healthy if state.health >= self.min_health else weak).append(ep)
+        return healthy + weak
+
+    def _hedge_delay(self, endpoint: LLMEndpoint) -> float:
+        p = self.states[endpoint.name].quantile(self.hedge_quantile, self.hedge_min_samples)
+        return max(self.hedge_min_delay, p if p is not None else self.hedge_default_delay)
+
+    @staticmethod
+    def _payload(endpoint: LLMEndpoint, messages: List[Dict[str, str]], max_tokens: int, temperature: float, role: str) -> Dict[str, Any]:
+        return {
+            "model": endpoint.model_for(role),
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }
+
+    @staticmethod
+    def _headers(endpoint: LLMEndpoint) -> Dict[str, str]:
+        headers = {"Content-Type": "application/json"}
+        if endpoint.api_key:
+            headers["Authorization"] = f"Bearer {endpoint.api_key}"
+        return headers
+
+    @staticmethod
+    def _parse(result_json: Dict[str, Any]) -> str:
+        choices = result_json.get("choices") or []
+        if not choices:
+            raise LLMGatewayError("Response không có 'choices'.")
+        return choices[0]["message"]["content"]
+
+    @staticmethod
+    def _is_client_error(error: Exception) -> bool:
+        """ 4xx (trừ 429): lỗi của chính request (payload, khóa API...), gửi lại / sang endpoint khác cũng vậy. """
+        return (
+            isinstance(error, httpx.HTTPStatusError)
+            and 400 <= error.response.status_code < 500
+            and error.response.status_code != 429
+        )
+
+    @staticmethod
+    def _trips_breaker(error: Exception) -> bool:
+        """ Chỉ lỗi cho thấy endpoint quá tải / hỏng mới tính vào circuit breaker: timeout, 429, 5xx, lỗi kết nối. """
+        if isinstance(error, httpx.HTTPStatusError):
+            status = error.response.status_code
+            return status == 429 or status >= 500
+        return isinstance(error, httpx.TransportError)
+
+    def _record_failure(self, endpoint: LLMEndpoint, error: Exception):
+        if not self._trips_breaker(error):
+            LLM_REQUESTS.inc(endpoint=endpoint.name, outcome="client_error" if self._is_client_error(error) else "bad_response")
+            self.states[endpoint.name].release_probe()
+            return
+        retry_after = None
+        rate_limited = isinstance(error, httpx.HTTPStatusError) and error.response.status_code == 429
+        if rate_limited:
+            try:
+                retry_after = min(float(error.response.headers.get("Retry-After", 0)), self.max_retry_after) or None
+            except ValueError:
+                retry_after = None
+        LLM_REQUESTS.inc(endpoint=endpoint.name, outcome="rate_limited" if rate_limited else "error")
+        if self.states[endpoint.name].record_failure(self.failure_threshold, self.reset_timeout, retry_after):
+            CIRCUIT_OPEN.set(1, endpoint=endpoint.name)
+            logger.warning(f"LLM endpoint '{endpoint.name}' mở mạch sau lỗi: {error!r}")
+
+    def _record_success(self, endpoint: LLMEndpoint, latency: float):
+        LLM_REQUESTS.inc(endpoint=endpoint.name, outcome="ok")
+        LLM_LATENCY.observe(latency, endpoint=endpoint.name)
+        self.states[endpoint.name].record_success(latency)
+        CIRCUIT_OPEN.set(0, endpoint=endpoint.name)
+
+    # ------------------------------------------------------------------ #
+    async def _call(self, endpoint: LLMEndpoint, payload: Dict[str, Any]) -> str:
+        if self._client is None:
+            self._client = httpx.AsyncClient()
+        self.states[endpoint.name].begin()
+        t0 = time.perf_counter()
+        try:
+            response = await self._client.post(endpoint.url, json=payload, headers=self._headers(endpoint), timeout=endpoint.timeout)
+            response.raise_for_status()
+            content = self._parse(response.json())
+        except asyncio.CancelledError:
+            # Bị hủy vì request hedge khác thắng: không tính là lỗi
+            LLM_REQUESTS.inc(endpoint=endpoint.name, outcome="cancelled")
+            self.states[endpoint.name].release_probe()
+            raise
+        except Exception as e:
+            self._record_failure(endpoint, e)
+            raise
+        self._record_success(endpoint, time.perf_counter() - t0)
+        return content
+
+    async def chat(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 1024,
+        temperature: float = 0.3,
+        role: str = "default",
+    ) -> str:
+        """
+        Gửi tới endpoint tốt nhất; hedge sau p95 của nó, failover ngay khi lỗi. Lỗi hết -> LLMGatewayError;
+        4xx khác 429 -> httpx.HTTPStatusError.
+        """
+        candidates = self._ordered_endpoints()
+        if not candidates:
+            raise LLMGatewayError("Tất cả LLM endpoint đang mở mạch.")
+
+        pending: Dict[asyncio.Task, LLMEndpoint] = {}
+        errors: List[Tuple[str, Exception]] = []
+        next_idx = 0
+
+        def launch(hedge: bool = False):
+            nonlocal next_idx
+            endpoint = candidates[next_idx]
+            next_idx += 1
+            if hedge:
+                LLM_HEDGES.inc(endpoint=endpoint.name)
+            payload = self._payload(endpoint, messages, max_tokens, temperature, role)
+            pending[asyncio.ensure_future(self._call(endpoint, payload))] = endpoint
+
+        launch()
+        try:
+            while pending:
+                # Chỉ hedge khi còn endpoint dự phòng; mốc chờ theo p95 của request mới nhất
+                timeout = None
+                if self.hedging and next_idx < len(candidates):
+                    timeout = self._hedge_delay(candidates[next_idx - 1])
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch(hedge=True)
+                    continue
+                for task in done:
+                    endpoint = pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    if self._is_client_error(task.exception()):
+                        raise task.exception()
+                    errors.append((endpoint.name, task.exception()))
+                if not pending and next_idx < len(candidates):
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise LLMGatewayError("Tất cả LLM endpoint đều lỗi: " + "; ".join(f"{n}: {e!r}" for n, e in errors))
+
+    def chat_sync(
+        self,
+        messages: List[Dict[str, str]],
+        max_tokens: int = 1024,
+        temperature: float = 0.3,
+        role: str = "default",
+    ) -> str:
+        """ Bản đồng bộ: thử lần lượt các endpoint khả dụng (không hedging). """
+        if self._sync_client is None:
+            self._sync_client = httpx.Client()
+        errors: List[Tuple[str, Exception]] = []
+        for endpoint in self._ordered_endpoints():
+            self.states[endpoint.name].begin()
+            t0 = time.perf_counter()
+            try:
+                response = self._sync_client.post(
+                    endpoint.url,
+                    json=self._payload(endpoint, messages, max_tokens, temperature, role),
+                    headers=self._headers(endpoint),
+                    timeout=endpoint.timeout,
+                )
+                response.raise_for_status()
+                content = self._parse(response.json())
+            except Exception as e:
+                self._record_failure(endpoint, e)
+                if self._is_client_error(e):
+                    raise
+                errors.append((endpoint.name, e))
+                continue
+            self._record_success(endpoint, time.perf_counter() - t0)
+            return content
+        raise LLMGatewayError("Tất cả LLM endpoint đều lỗi hoặc đang mở mạch: " + "; ".join(f"{n}: {e!r}" for n, e in errors))
+
+    def status(self) -> List[Dict[str, Any]]:
+        """ Trạng thái từng endpoint (dùng cho /health). """
+        now = time.monotonic()
+        report = []
+        for ep in self.endpoints:
+            state = self.states[ep.name]
+            p95 = state.quantile(self.hedge_quantile, 1)
+            report.append({
+                "name": ep.name,
+                "model": ep.model,
+                "health": round(state.health, 3),
+                "circuit": "open" if state.open_until > now else ("half_open" if state.open_until else "closed"),
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            })
+        return report
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
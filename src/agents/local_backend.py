@@ -0,0 +1,162 @@
+"""
+Backend sinh câu trả lời ngắn ngay trên máy (không gọi API) cho GeneralGenerator:
+
+- "template" : bảng câu trả lời mẫu cho các ý định phổ biến (chào hỏi, cảm ơn, hỏi danh tính,
+               tạm biệt) và thông báo "không tìm thấy thông tin". Không tốn tài nguyên.
+- "local_llm": model nhỏ (vd: Qwen2.5-0.5B-Instruct) chạy CPU, lượng tử hóa động int8, nạp lười ở lần gọi đầu.
+- "remote"   : giữ nguyên cách cũ (Groq / LLM gateway).
+
+Chọn riêng cho từng loại phản hồi (`general`, `fallback`) trong mục `local_generation` của configs/serving.yml.
+Backend trả về None khi không xử lý được (vd: template không khớp) -> GeneralGenerator gọi remote
+(nếu `fallback_to_remote: true`). Chỉ câu trả lời RAG (SpecificGenerator) luôn đi remote.
+"""
+import re
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.indexing.citation_index import strip_diacritics
+from src.serving.observability import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+LOCAL_BACKENDS = ("remote", "template", "local_llm")
+LOCAL_GENERATIONS = REGISTRY.register(Counter(
+    "rag_local_generations_total", "Số phản hồi được sinh tại chỗ (không gọi API).", ("kind", "backend")
+))
+
+# (ý định, các cụm từ không dấu, câu trả lời)
+GENERAL_TEMPLATES: List[Tuple[str, Tuple[str, ...], str]] = [
+    ("thanks", ("cam on", "thank", "thanks", "tks"),
+     "Rất vui vì đã giúp được bạn! Nếu còn thắc mắc về thủ tục hay quy định y tế, bạn cứ hỏi nhé."),
+    ("goodbye", ("tam biet", "bye", "hen gap lai"),
+     "Tạm biệt bạn! Chúc bạn nhiều sức khỏe, hẹn gặp lại."),
+    ("identity", ("ban la ai", "ban ten gi", "ban la gi", "ban lam duoc gi", "ban giup duoc gi"),
+     "Tôi là trợ lý ảo hỗ trợ tra cứu thủ tục hành chính và quy định pháp luật trong lĩnh vực y tế công. "
+     "Bạn có thể hỏi tôi về bảo hiểm y tế, khám chữa bệnh, giấy phép hành nghề và các văn bản liên quan."),
+    ("greeting", ("xin chao", "chao", "hello", "hi", "alo", "hey"),
+     "Xin chào! Tôi là trợ lý ảo về thủ tục hành chính y tế. Bạn cần tìm hiểu quy định hay thủ tục nào?"),
+]
+FALLBACK_TEMPLATE = (
+    "Xin lỗi, hiện tại tôi chưa tìm thấy thông tin chính xác về \"{query}\" trong cơ sở dữ liệu văn bản pháp luật. "
+    "Bạn vui lòng diễn đạt lại hoặc nêu rõ tên, số hiệu văn bản cần tra cứu nhé."
+)
+
+
+class LocalBackend:
+    """ Giao diện chung: trả về câu trả lời, hoặc None nếu backend không xử lý được yêu cầu này. """
+    name = "base"
+
+    def generate(self, kind: str, text: str, prompt: str, max_tokens: int, temperature: float) -> Optional[str]:
+        raise NotImplementedError
+
+
+class TemplateBackend(LocalBackend):
+    """ Khớp cụm từ (không dấu, nguyên từ) trên câu ngắn; câu dài hơn max_words không được trả lời bằng mẫu. """
+    name = "template"
+
+    def __init__(self, max_words: int = 8, max_query_chars: int = 80):
+        self.max_words = max_words
+        self.max_query_chars = max_query_chars
+        self._rules = [
+            (intent, re.compile(r"(?<!\w)(?:" + "|".join(re.escape(p) for p in phrases) + r")(?!\w)"), response)
+            for intent, phrases, response in GENERAL_TEMPLATES
+        ]
+
+    def match(self, text: str) -> Optional[str]:
+        probe = strip_diacritics(text).lower().strip()
+        if not probe or len(probe.split()) > self.max_words:
+            return None
+        for intent, pattern, response in self._rules:
+            if pattern.search(probe):
+                return response
+        return None
+
+    def generate(self, kind: str, text: str, prompt: str, max_tokens: int, temperature: float) -> Optional[str]:
+        if kind == "fallback":
+            query = text.strip()
+            if len(query) > self.max_query_chars:
+                query = query[: self.max_query_chars].rsplit(" ", 1)[0] + "..."
+            return FALLBACK_TEMPLATE.format(query=query)
+        return self.match(text)
+
+
+class LocalLLMBackend(LocalBackend):
+    """
+    Causal LM nhỏ chạy CPU qua transformers; `quantization: int8` áp dụng lượng tử hóa động
+    cho các lớp Linear (torch.ao.quantization.quantize_dynamic). Model được nạp ở lần gọi đầu tiên.
+    """
+    name = "local_llm"
+
+    def __init__(self, model_name: str = "Qwen/Qwen2.5-0.5B-Instruct", quantization: Optional[str] = "int8", threads: Optional[int] = None):
+        self.model_name = model_name
+        self.quantization = quantization
+        self.threads = threads
+        self._model = None
+        self._tokenizer = None
+        self._lock = threading.Lock()  # generate() của một model không an toàn khi chạy song song
+
+    def _load(self):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        print(f"-> Nạp local LLM {self.model_name} trên CPU (quantization: {self.quantization or 'none'})...")
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        model = AutoModelForCausalLM.from_pretrained(self.model_name, torch_dtype=torch.float32)
+        model.eval()
+        if self.quantization == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self._tokenizer, self._model = tokenizer, model
+
+    def generate(self, kind: str, text: str, prompt: str, max_tokens: int, temperature: float) -> Optional[str]:
+        import torch
+
+        with self._lock:
+            if self._model is None:
+                self._load()
+            messages = [{"role": "user", "content": prompt}]
+            input_ids = self._tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+            with torch.inference_mode():
+                output = self._model.generate(
+                    input_ids,
+                    max_new_tokens=max_tokens,
+                    do_sample=temperature > 0,
+                    temperature=temperature if temperature > 0 else None,
+                    pad_token_id=self._tokenizer.eos_token_id,
+                )
+            answer = self._tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True).strip()
+        return answer or None
+
+
+def build_local_backends(local_cfg: Dict[str, Any]) -> Dict[str, Optional[LocalBackend]]:
+    """
+    {"general": backend | None, "fallback": backend | None} theo config; None nghĩa là "remote".
+    Hai loại phản hồi cùng chọn local_llm thì dùng chung một model.
+    """
+    shared: Dict[str, LocalBackend] = {}
+    backends: Dict[str, Optional[LocalBackend]] = {}
+    for kind in ("general", "fallback"):
+        name = (local_cfg.get(kind) or {}).get('backend', "remote")
+        if name not in LOCAL_BACKENDS:
+            raise ValueError(f"local_generation.{kind}.backend phải là một trong {LOCAL_BACKENDS}, nhận được: '{name}'")
+        if name == "remote":
+            backends[kind] = None
+            continue
+        if name not in shared:
+            if name == "template":
+                template_cfg = local_cfg.get('template', {})
+                shared[name] = TemplateBackend(
+                    max_words=template_cfg.get('max_words', 8),
+                    max_query_chars=template_cfg.get('max_query_chars', 80),
+                )
+            else:
+                llm_cfg = local_cfg.get('local_llm', {})
+                shared[name] = LocalLLMBackend(
+                    model_name=llm_cfg.get('model_name', "Qwen/Qwen2.5-0.5B-Instruct"),
+                    quantization=llm_cfg.get('quantization', "int8"),
+                    threads=llm_cfg.get('threads'),
+                )
+        backends[kind] = shared[name]
+    return backends
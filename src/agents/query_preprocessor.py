@@ -0,0 +1,258 @@
+"""
+Tiền xử lý câu hỏi trước IntentClassifier / BM25 / embedding:
+
+1. Chuẩn hóa Unicode NFC và khoảng trắng.
+2. Thay teencode / viết tắt phổ biến ("ko" -> "không", "bhyt" -> "bảo hiểm y tế", ...).
+3. Khôi phục dấu cho câu gõ không dấu, dựa trên bảng unigram/bigram học từ chính corpus lúc index.
+4. Nhận diện trích dẫn ("nd 109", "Nghị định 109/2016", "Điều 22 Luật Khám bệnh, chữa bệnh")
+   và tra bảng CitationIndex: câu hỏi chỉ gồm trích dẫn được trả lời thẳng từ bảng, không cần
+   hybrid search; các câu khác được ưu tiên chunk được trích dẫn khi hợp nhất (xem DatabaseRetriever).
+
+Kết quả được memoize (LRU) theo câu hỏi gốc.
+"""
+import os
+import re
+import json
+import threading
+import unicodedata
+from collections import OrderedDict, Counter
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+from src.indexing.citation_index import CitationIndex, Citation, DocRef, find_doc_refs, strip_diacritics
+from src.indexing.chunk_table import page_contents
+from src.serving.observability import CACHE_HITS, CACHE_MISSES
+
+_WS = re.compile(r"\s+")
+_TOKEN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+# Một từ kèm dấu câu dính liền hai bên: "(bhyt)?" -> "(", "bhyt", ")?"
+_AFFIXED = re.compile(r"^(\W*)(\w+)(\W*)$", re.UNICODE)
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+# Teencode / viết tắt (khóa chữ thường, chỉ thay khi là nguyên một từ). Bảng được áp dụng trước cả phân loại,
+# BM25 và embedding nên chỉ giữ viết tắt KHÔNG mơ hồ trong ngữ cảnh hành chính - y tế:
+# - không có khóa một chữ cái ("k", "j"): trùng ký hiệu điểm ("điểm k khoản 2")
+# - bỏ "dk"/"đk" (điều kiện / đăng ký), "đc" (địa chỉ), "bn" (bệnh nhân / bạn), "kh" (khách hàng / kế hoạch),
+#   "ms" (mã số): thay sai sẽ xóa mất từ khóa quan trọng nhất của câu hỏi
+TEENCODE: Dict[str, str] = {
+    "ko": "không", "hok": "không", "hem": "không", "dc": "được",
+    "ntn": "như thế nào", "vs": "với", "ng": "người", "mn": "mọi người",
+    "bnh": "bao nhiêu", "cx": "cũng",
+    "bhyt": "bảo hiểm y tế", "bhxh": "bảo hiểm xã hội", "kcb": "khám chữa bệnh", "bv": "bệnh viện",
+    "csyt": "cơ sở y tế", "bs": "bác sĩ",
+}
+# Từ không mang nội dung khi xét "câu hỏi chỉ gồm số hiệu văn bản"
+LOOKUP_FILLERS = {
+    "là", "gì", "về", "của", "nội", "dung", "quy", "định", "văn", "bản", "toàn", "cho", "tôi",
+    "xem", "tra", "cứu", "số", "hỏi", "thông", "tin", "các", "những", "điều", "khoản", "?", ".", ":",
+}
+
+
+# So khớp filler cả khi người dùng gõ không dấu ("la gi", "noi dung")
+_STRIPPED_FILLERS = {strip_diacritics(f) for f in LOOKUP_FILLERS}
+
+
+def has_diacritics(text: str) -> bool:
+    return strip_diacritics(text) != unicodedata.normalize("NFC", text)
+
+
+def _split_affixes(word: str) -> Tuple[str, str, str]:
+    m = _AFFIXED.match(word)
+    return (m.group(1), m.group(2), m.group(3)) if m else (word, "", "")
+
+
+class DiacriticRestorer:
+    """
+    Khôi phục dấu theo từ điển học từ corpus: ưu tiên cặp từ (bigram) phổ biến nhất
+    có cùng dạng không dấu, nếu không có thì dùng từ đơn (unigram) phổ biến nhất.
+    """
+    def __init__(self, unigrams: Optional[Dict[str, str]] = None, bigrams: Optional[Dict[str, str]] = None):
+        self.unigrams = unigrams or {}
+        self.bigrams = bigrams or {}
+
+    @classmethod
+    def fit(cls, texts: Iterable[str], min_bigram_count: int = 2) -> 'DiacriticRestorer':
+        uni: Dict[str, Counter] = {}
+        bi: Dict[str, Counter] = {}
+        for text in texts:
+            words = _WORD.findall(unicodedata.normalize("NFC", text).lower())
+            stripped = [strip_diacritics(w) for w in words]
+            for i, (w, s) in enumerate(zip(words, stripped)):
+                uni.setdefault(s, Counter())[w] += 1
+                if i + 1 < len(words):
+                    bi.setdefault(f"{s} {stripped[i + 1]}", Counter())[f"{w} {words[i + 1]}"] += 1
+        unigrams = {s: c.most_common(1)[0][0] for s, c in uni.items()}
+        bigrams = {}
+        for s, c in bi.items():
+            best, count = c.most_common(1)[0]
+            # Chỉ giữ bigram đủ phổ biến và khác với kết quả ghép unigram (tiết kiệm bộ nhớ)
+            if count >= min_bigram_count and best != " ".join(unigrams[p] for p in s.split(" ")):
+                bigrams[s] = best
+        return cls(unigrams, bigrams)
+
+    def restore(self, text: str) -> str:
+        parts = [_split_affixes(w) for w in text.split(" ")]
+        cores = [core.lower() for _, core, _ in parts]
+        out: List[str] = []
+        i = 0
+        while i < len(parts):
+            # Không ghép bigram qua dấu câu (vd: "a, b")
+            if i + 1 < len(parts) and cores[i] and cores[i + 1] and not parts[i][2] and not parts[i + 1][0]:
+                pair = self.bigrams.get(f"{cores[i]} {cores[i + 1]}")
+                if pair:
+                    first, second = pair.split(" ")
+                    out.append(parts[i][0] + first)
+                    out.append(second + parts[i + 1][2])
+                    i += 2
+                    continue
+            prefix, core, suffix = parts[i]
+            out.append(prefix + self.unigrams.get(cores[i], core) + suffix if core else prefix + suffix)
+            i += 1
+        return " ".join(out)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"unigrams": self.unigrams, "bigrams": self.bigrams}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> 'DiacriticRestorer':
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data.get("unigrams"), data.get("bigrams"))
+
+
+@dataclass
+class ProcessedQuery:
+    original: str
+    text: str                                   # Câu hỏi đã chuẩn hóa (dùng cho classifier, BM25, embedding)
+    doc_refs: List[DocRef] = field(default_factory=list)
+    citations: List[Citation] = field(default_factory=list)
+    chunk_keys: List[str] = field(default_factory=list)  # Chunk của các văn bản / Điều được trích dẫn
+    article_keys: List[str] = field(default_factory=list)  # Phần của chunk_keys thuộc các Điều được nêu rõ
+    is_lookup: bool = False                     # Câu hỏi chỉ gồm trích dẫn -> trả thẳng từ bảng
+
+
+class QueryPreprocessor:
+    def __init__(
+        self,
+        citation_index: Optional[CitationIndex] = None,
+        restorer: Optional[DiacriticRestorer] = None,
+        cache_size: int = 4096,
+        max_lookup_extra_words: int = 2,
+    ):
+        self.citation_index = citation_index or CitationIndex()
+        self.restorer = restorer
+        self.cache_size = cache_size
+        self.max_lookup_extra_words = max_lookup_extra_words
+        self._cache: "OrderedDict[str, ProcessedQuery]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, qp_cfg: Dict[str, Any], documents=None) -> 'QueryPreprocessor':
+        """
+        Nạp bảng đã build lúc index; nếu chưa có (index cũ) thì build từ `documents` đang có trong bộ nhớ.
+        """
+        citation_path = qp_cfg.get('citation_index_path', "./data/legal_documents/citation_index.json")
+        diacritics_path = qp_cfg.get('diacritics_path', "./data/legal_documents/diacritics.json")
+        if os.path.exists(citation_path):
+            citation_index = CitationIndex.load(citation_path)
+        else:
+            print(f"-> Chưa có citation index tại {citation_path}, build từ documents đang nạp...")
+            citation_index = CitationIndex.build(documents or [])
+        if os.path.exists(diacritics_path):
+            restorer = DiacriticRestorer.load(diacritics_path)
+        else:
+            restorer = DiacriticRestorer.fit(page_contents(documents or []))
+        print(
+            f"-> QueryPreprocessor ready ({len(citation_index)} khóa văn bản, {len(citation_index.article_index)} khóa Điều, "
+            f"{len(restorer.unigrams)} từ khôi phục dấu)."
+        )
+        return cls(
+            citation_index=citation_index,
+            restorer=restorer,
+            cache_size=qp_cfg.get('cache_size', 4096),
+            max_lookup_extra_words=qp_cfg.get('max_lookup_extra_words', 2),
+        )
+
+    def normalize(self, query: str) -> str:
+        """ NFC + gộp khoảng trắng + teencode + khôi phục dấu (chỉ khi cả câu không có dấu). """
+        text = _WS.sub(" ", unicodedata.normalize("NFC", query)).strip()
+        # Người dùng gõ không dấu: xét trên câu gốc, trước khi teencode chèn từ có dấu
+        unaccented = not has_diacritics(text)
+        words = []
+        for word in text.split(" "):
+            prefix, core, suffix = _split_affixes(word)
+            replacement = TEENCODE.get(core.lower()) if core else None
+            words.append(prefix + replacement + suffix if replacement else word)
+        text = " ".join(words)
+        if self.restorer is not None and unaccented:
+            text = self.restorer.restore(text)
+        return text
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def process(self, query: str) -> ProcessedQuery:
+        with self._lock:
+            cached = self._cache.get(query)
+            if cached is not None:
+                self._cache.move_to_end(query)
+        if cached is not None:
+            CACHE_HITS.inc(cache="query_preprocess")
+            return cached
+        CACHE_MISSES.inc(cache="query_preprocess")
+
+        text = self.normalize(query)
+        # Trích dẫn tìm trên câu gốc (đã NFC) để "nd 109" không bị khôi phục dấu thành từ khác
+        ref_source = unicodedata.normalize("NFC", query)
+        citations = self.citation_index.find_citations(ref_source)
+        if not citations:
+            ref_source = text
+            citations = self.citation_index.find_citations(text)
+        chunk_keys: List[str] = []
+        article_keys: List[str] = []
+        for citation in citations:
+            for key in self.citation_index.lookup_citation(citation):
+                if key not in chunk_keys:
+                    chunk_keys.append(key)
+                    if citation.article is not None:
+                        article_keys.append(key)
+        spans = sorted(span for citation in citations for span in citation.spans)
+        result = ProcessedQuery(
+            original=query,
+            text=text,
+            doc_refs=find_doc_refs(ref_source),
+            citations=citations,
+            chunk_keys=chunk_keys,
+            article_keys=article_keys,
+            is_lookup=bool(chunk_keys) and self._only_refs(ref_source, spans),
+        )
+
+        if self.cache_size > 0:
+            with self._lock:
+                self._cache[query] = result
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return result
+
+    def _only_refs(self, query: str, spans: List[Tuple[int, int]]) -> bool:
+        """ Câu hỏi chỉ còn tối đa max_lookup_extra_words từ nội dung sau khi bỏ các trích dẫn. """
+        rest, last = [], 0
+        for start, end in spans:
+            rest.append(query[last:start])
+            last = max(last, end)
+        rest.append(query[last:])
+        words = [w for w in _TOKEN.findall(" ".join(rest).lower()) if strip_diacritics(w) not in _STRIPPED_FILLERS]
+        return len(words) <= self.max_lookup_extra_words
+
+
+def build_query_tables(documents, qp_cfg: Dict[str, Any]) -> Tuple[CitationIndex, DiacriticRestorer]:
+    """ Dùng lúc index (DocumentIndexer): build và lưu bảng số hiệu + bảng khôi phục dấu. """
+    documents = list(documents)
+    citation_index = CitationIndex.build(documents)
+    citation_index.save(qp_cfg.get('citation_index_path', "./data/legal_documents/citation_index.json"))
+    restorer = DiacriticRestorer.fit(doc.page_content for doc in documents)
+    restorer.save(qp_cfg.get('diacritics_path', "./data/legal_documents/diacritics.json"))
+    return citation_index, restorer
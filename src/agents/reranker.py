@@ -0,0 +1,69 @@
+from typing import List, Dict, Any, Optional, Tuple
+from langchain_core.documents import Document
+
+
+class CrossEncoderReranker:
+    """
+    Sắp xếp lại (rerank) các đoạn văn bản ứng viên bằng Cross-Encoder
+    (mặc định: maidalun1020/bce-reranker-base_v1, xem mục `reranking` trong config).
+    """
+    def __init__(
+        self,
+        model_name: str = "maidalun1020/bce-reranker-base_v1",
+        device: str = "cpu",
+        max_length: int = 512,
+        backend: str = "torch", # "torch" | "onnx" | "onnx_int8" (xem src/agents/inference_backend.py)
+        onnx: Optional[Dict[str, Any]] = None,
+    ):
+        # Import trễ: sentence_transformers kéo theo torch, chỉ tải khi thật sự bật reranker
+        from sentence_transformers import CrossEncoder
+        from src.agents.inference_backend import model_kwargs_for
+
+        model_path, model_kwargs = model_kwargs_for(
+            {"model_name": model_name, "device": device, "backend": backend, "onnx": onnx}, CrossEncoder
+        )
+        self.model_name = model_name
+        self.device = model_kwargs['device']
+        self.backend = backend
+        self.max_length = max_length
+        self.model = CrossEncoder(model_path, max_length=max_length, **model_kwargs)
+        print(f"-> CrossEncoderReranker ready. Model: {model_name} trên {self.device} (backend: {backend}).")
+
+    @classmethod
+    def from_config(cls, rerank_cfg: Dict[str, Any]) -> 'CrossEncoderReranker':
+        return cls(
+            model_name=rerank_cfg.get('model_name', "maidalun1020/bce-reranker-base_v1"),
+            device=rerank_cfg.get('device', 'cpu'),
+            max_length=rerank_cfg.get('max_length', 512),
+            backend=rerank_cfg.get('backend', 'torch'),
+            onnx=rerank_cfg.get('onnx'),
+        )
+
+    def score(self, query: str, documents: List[Document]) -> List[float]:
+        if not documents:
+            return []
+        pairs = [(query, doc.page_content) for doc in documents]
+        return [float(s) for s in self.model.predict(pairs)]
+
+    def score_many(self, requests: List[Tuple[str, List[Document]]]) -> List[List[float]]:
+        """ Chấm nhiều cặp (query, candidates) trong MỘT lần predict (dùng cho micro-batching). """
+        pairs = [(query, doc.page_content) for query, docs in requests for doc in docs]
+        if not pairs:
+            return [[] for _ in requests]
+        flat = [float(s) for s in self.model.predict(pairs)]
+        results, start = [], 0
+        for _, docs in requests:
+            results.append(flat[start : start + len(docs)])
+            start += len(docs)
+        return results
+
+    @staticmethod
+    def order_by_scores(documents: List[Document], scores: List[float], top_n: Optional[int] = None) -> List[Document]:
+        order = sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)
+        if top_n is not None:
+            order = order[:top_n]
+        return [documents[i] for i in order]
+
+    def rerank(self, query: str, documents: List[Document], top_n: Optional[int] = None) -> List[Document]:
+        """ Trả về các documents theo thứ tự điểm Cross-Encoder giảm dần (cắt còn top_n nếu có). """
+        return self.order_by_scores(documents, self.score(query, documents), top_n)
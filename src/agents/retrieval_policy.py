@@ -0,0 +1,135 @@
+"""
+Chính sách truy vấn thích ứng cho DatabaseRetriever: thay vì luôn chạy cả BM25 lẫn Vector với
+bm25_k / vector_k cố định, quyết định theo từng câu hỏi dựa trên điểm BM25 (rất rẻ, có trước):
+
+- early exit : top-1 BM25 vượt hẳn top-2 (margin tương đối >= skip_vector_margin, điểm đủ cao)
+               -> bỏ nhánh Vector (không embed, không quét vector).
+- deepen     : điểm top-k BM25 "phẳng" (điểm hạng k / điểm hạng 1 >= flat_ratio) hoặc không có
+               hit lexical -> tăng bm25_k / vector_k lên deepen_factor lần (tối đa max_k).
+- rerank     : số ứng viên đưa vào reranker giảm tuyến tính theo tải (load_fn, 0..1) từ
+               rerank_depth xuống min_rerank_depth.
+
+Mỗi quyết định được đếm trong metrics và (nếu cấu hình) ghi JSONL để tinh chỉnh ngưỡng
+trên bộ benchmark: python -m src.benchmark.retrieval --adaptive off on
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import Counter as Tally
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, Optional, Sequence
+
+from src.serving.observability import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_DECISIONS = REGISTRY.register(Counter(
+    "rag_retrieval_decisions_total", "Quyết định của chính sách truy vấn thích ứng.", ("decision",)
+))
+
+
+@dataclass
+class RetrievalPlan:
+    decision: str           # "early_exit" | "deepen" | "no_lexical" | "default"
+    bm25_k: int
+    vector_k: int           # 0: bỏ nhánh Vector
+    margin: float           # (top1 - top2) / top1 của BM25
+    flatness: float         # điểm hạng bm25_k / điểm hạng 1
+    rerank_depth: Optional[int] = None
+
+    @property
+    def skip_vector(self) -> bool:
+        return self.vector_k == 0
+
+
+class AdaptiveRetrievalPolicy:
+    def __init__(
+        self,
+        skip_vector_margin: float = 0.5,
+        min_top_score: float = 5.0,
+        flat_ratio: float = 0.85,
+        deepen_factor: float = 2.0,
+        max_k: int = 40,
+        rerank_depth: int = 20,
+        min_rerank_depth: int = 6,
+        load_low: float = 0.5,
+        load_high: float = 1.0,
+        decision_log: Optional[str] = None,
+    ):
+        self.skip_vector_margin = skip_vector_margin
+        self.min_top_score = min_top_score
+        self.flat_ratio = flat_ratio
+        self.deepen_factor = deepen_factor
+        self.max_k = max_k
+        self.full_rerank_depth = rerank_depth
+        self.min_rerank_depth = min_rerank_depth
+        self.load_low = load_low
+        self.load_high = load_high
+        self.decision_log = decision_log
+        if decision_log:
+            os.makedirs(os.path.dirname(decision_log) or ".", exist_ok=True)
+        self.load_fn: Optional[Callable[[], float]] = None  # main_api gắn tải của admission control
+        self.stats: Tally = Tally()  # Số lần mỗi quyết định (benchmark đọc để so sánh chi phí)
+        self._log_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, adaptive_cfg: Dict[str, Any]) -> 'AdaptiveRetrievalPolicy':
+        return cls(
+            skip_vector_margin=adaptive_cfg.get('skip_vector_margin', 0.5),
+            min_top_score=adaptive_cfg.get('min_top_score', 5.0),
+            flat_ratio=adaptive_cfg.get('flat_ratio', 0.85),
+            deepen_factor=adaptive_cfg.get('deepen_factor', 2.0),
+            max_k=adaptive_cfg.get('max_k', 40),
+            rerank_depth=adaptive_cfg.get('rerank_depth', 20),
+            min_rerank_depth=adaptive_cfg.get('min_rerank_depth', 6),
+            load_low=adaptive_cfg.get('load_low', 0.5),
+            load_high=adaptive_cfg.get('load_high', 1.0),
+            decision_log=adaptive_cfg.get('decision_log'),
+        )
+
+    def probe_depth(self, bm25_k: int) -> int:
+        """ Số hit BM25 cần lấy để quyết định (đủ cho cả trường hợp deepen). """
+        return min(self.max_k, max(bm25_k, int(bm25_k * self.deepen_factor)))
+
+    def plan(self, bm25_scores: Sequence[float], bm25_k: int, vector_k: int) -> RetrievalPlan:
+        """ Quyết định dựa trên điểm BM25 (giảm dần) đã lấy tới probe_depth(bm25_k). """
+        scores = list(bm25_scores)
+        if not scores:
+            plan = RetrievalPlan("no_lexical", bm25_k, self._deepen(vector_k), 0.0, 0.0)
+        else:
+            top = float(scores[0])
+            margin = (top - float(scores[1])) / top if len(scores) > 1 and top > 0 else 1.0
+            flatness = float(scores[min(bm25_k, len(scores)) - 1]) / top if top > 0 else 1.0
+            if margin >= self.skip_vector_margin and top >= self.min_top_score:
+                plan = RetrievalPlan("early_exit", bm25_k, 0, margin, flatness)
+            elif len(scores) >= bm25_k and flatness >= self.flat_ratio:
+                plan = RetrievalPlan("deepen", self._deepen(bm25_k), self._deepen(vector_k), margin, flatness)
+            else:
+                plan = RetrievalPlan("default", bm25_k, vector_k, margin, flatness)
+        plan.rerank_depth = self.rerank_depth()
+        RETRIEVAL_DECISIONS.inc(decision=plan.decision)
+        self.stats[plan.decision] += 1
+        return plan
+
+    def _deepen(self, k: int) -> int:
+        return min(self.max_k, max(k, int(k * self.deepen_factor)))
+
+    def rerank_depth(self) -> int:
+        """ Độ sâu rerank theo tải hiện tại: đầy đủ khi tải <= load_low, tối thiểu khi >= load_high. """
+        load = self.load_fn() if self.load_fn is not None else 0.0
+        if load <= self.load_low:
+            return self.full_rerank_depth
+        if load >= self.load_high:
+            return self.min_rerank_depth
+        fraction = (load - self.load_low) / max(self.load_high - self.load_low, 1e-9)
+        return round(self.full_rerank_depth - fraction * (self.full_rerank_depth - self.min_rerank_depth))
+
+    def log(self, query: str, plan: RetrievalPlan, **extra: Any):
+        logger.debug(f"[ADAPTIVE] {plan.decision} margin={plan.margin:.2f} flat={plan.flatness:.2f} '{query[:60]}'")
+        if not self.decision_log:
+            return
+        record = {"ts": round(time.time(), 3), "query": query, **asdict(plan), **extra}
+        with self._log_lock, open(self.decision_log, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -0,0 +1,337 @@
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, List, Dict, Any, Optional
+
+from groq import AsyncGroq
+from langchain_core.documents import Document
+
+from src.serving.observability import CACHE_HITS, CACHE_MISSES, FALLBACKS
+from src.agents.llm_gateway import LLMGateway
+
+logger = logging.getLogger(__name__)
+
+# Dấu hiệu của câu hỏi nối tiếp (phụ thuộc ngữ cảnh hội thoại trước), so khớp theo nguyên từ.
+# Không dùng các từ mở đầu câu hỏi độc lập rất phổ biến ("thế nào là...", "trường hợp nào...")
+# và "họ" (trùng "họ tên").
+FOLLOW_UP_PREFIXES = ("còn", "vậy", "và", "rồi", "thế còn", "thế thì")
+# "nếu" / "với" chỉ tính là nối tiếp khi câu hỏi rất ngắn ("với người nước ngoài?", "nếu trái tuyến?")
+SHORT_FOLLOW_UP_PREFIXES = ("nếu", "với")
+FOLLOW_UP_PHRASES = (
+    "thì sao", "thì thế nào", "điều đó", "điều này", "văn bản đó", "văn bản này", "luật đó", "luật này",
+    "trường hợp đó", "trường hợp này", "như trên", "ở trên", "vừa nói", "vừa rồi", "nó",
+)
+
+
+def _word_pattern(words, anchored: bool = False) -> re.Pattern:
+    alternatives = "|".join(re.escape(w) for w in words)
+    return re.compile(("^" if anchored else r"(?<!\w)") + f"(?:{alternatives})" + r"(?!\w)")
+
+
+_FOLLOW_UP_PREFIX = _word_pattern(FOLLOW_UP_PREFIXES, anchored=True)
+_SHORT_FOLLOW_UP_PREFIX = _word_pattern(SHORT_FOLLOW_UP_PREFIXES, anchored=True)
+_FOLLOW_UP_PHRASE = _word_pattern(FOLLOW_UP_PHRASES)
+
+
+@dataclass
+class Turn:
+    query: str
+    answer: str
+    intent: str
+    standalone_query: Optional[str] = None
+    timestamp: float = field(default_factory=time.time)
+
+
+@dataclass
+class Session:
+    session_id: str
+    turns: Deque[Turn]
+    updated_at: float = field(default_factory=time.time)
+    # Kết quả truy vấn gần nhất, dùng lại cho câu hỏi nối tiếp cùng chủ đề
+    last_retrieval_query: Optional[str] = None
+    last_documents: List[Document] = field(default_factory=list)
+    # Chỉ giữ trong bộ nhớ, không ghi xuống backing store
+    last_query_vector: Optional[List[float]] = None
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "session_id": self.session_id,
+            "updated_at": self.updated_at,
+            "turns": [t.__dict__ for t in self.turns],
+            "last_retrieval_query": self.last_retrieval_query,
+            "last_documents": [{"page_content": d.page_content, "metadata": d.metadata} for d in self.last_documents],
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, payload: str, max_turns: int) -> 'Session':
+        data = json.loads(payload)
+        return cls(
+            session_id=data["session_id"],
+            turns=deque((Turn(**t) for t in data.get("turns", [])), maxlen=max_turns),
+            updated_at=data.get("updated_at", time.time()),
+            last_retrieval_query=data.get("last_retrieval_query"),
+            last_documents=[Document(**d) for d in data.get("last_documents", [])],
+        )
+
+
+class SessionStore:
+    """
+    Lưu lịch sử hội thoại theo session_id: trong bộ nhớ với giới hạn TTL + LRU,
+    tùy chọn ghi xuống SQLite cục bộ (backing_path) để giữ session qua các lần restart.
+    """
+    def __init__(
+        self,
+        ttl_seconds: float = 1800,
+        max_sessions: int = 10000,
+        max_turns: int = 6,
+        max_answer_chars: int = 400,
+        backing_path: Optional[str] = None,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.max_answer_chars = max_answer_chars
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        if backing_path:
+            self._db = sqlite3.connect(backing_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, payload TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._db.commit()
+        print(f"-> SessionStore ready (ttl={ttl_seconds}s, max_sessions={max_sessions}, max_turns={max_turns}, backing={backing_path or 'memory'}).")
+
+    @classmethod
+    def from_config(cls, session_cfg: Dict[str, Any]) -> 'SessionStore':
+        return cls(
+            ttl_seconds=session_cfg.get('ttl_seconds', 1800),
+            max_sessions=session_cfg.get('max_sessions', 10000),
+            max_turns=session_cfg.get('max_turns', 6),
+            max_answer_chars=session_cfg.get('max_answer_chars', 400),
+            backing_path=session_cfg.get('backing_path'),
+        )
+
+    def _expired(self, session: Session) -> bool:
+        return time.time() - session.updated_at > self.ttl_seconds
+
+    def get(self, session_id: str) -> Optional[Session]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None and self._db is not None:
+                row = self._db.execute("SELECT payload FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+                if row:
+                    session = Session.from_json(row[0], self.max_turns)
+                    self._sessions[session_id] = session
+            if session is None:
+                return None
+            if self._expired(session):
+                self._delete_locked(session_id)
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def get_or_create(self, session_id: str) -> Session:
+        session = self.get(session_id)
+        if session is not None:
+            return session
+        with self._lock:
+            session = Session(session_id=session_id, turns=deque(maxlen=self.max_turns))
+            self._sessions[session_id] = session
+            self._evict_locked()
+            return session
+
+    def append_turn(
+        self,
+        session: Session,
+        turn: Turn,
+        retrieval_query: Optional[str] = None,
+        documents: Optional[List[Document]] = None,
+        query_vector: Optional[List[float]] = None,
+    ):
+        """ Ghi một lượt hội thoại (câu trả lời bị cắt gọn để lịch sử luôn nhỏ). """
+        turn.answer = turn.answer[: self.max_answer_chars]
+        session.turns.append(turn)
+        session.updated_at = time.time()
+        if documents:
+            session.last_retrieval_query = retrieval_query
+            session.last_documents = list(documents)
+            session.last_query_vector = query_vector
+        if self._db is not None:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sessions (session_id, payload, updated_at) VALUES (?, ?, ?)",
+                    (session.session_id, session.to_json(), session.updated_at),
+                )
+                self._db.commit()
+
+    def purge_expired(self) -> int:
+        """ Xóa các session đã hết hạn (trong bộ nhớ và backing store). """
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            expired = [sid for sid, s in self._sessions.items() if s.updated_at < cutoff]
+            for sid in expired:
+                del self._sessions[sid]
+            if self._db is not None:
+                self._db.execute("DELETE FROM sessions WHERE updated_at < ?", (cutoff,))
+                self._db.commit()
+        return len(expired)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _delete_locked(self, session_id: str):
+        self._sessions.pop(session_id, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._db.commit()
+
+    def _evict_locked(self):
+        # LRU: bỏ session ít dùng nhất khỏi bộ nhớ (vẫn còn trong backing store nếu có)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+
+class QueryCondenser:
+    """
+    Viết lại câu hỏi nối tiếp thành câu hỏi độc lập dựa trên lịch sử hội thoại.
+    Lịch sử đưa vào prompt bị giới hạn cả số lượt lẫn số ký tự để prompt không phình to.
+    """
+    def __init__(
+        self,
+        api_key: Optional[str],
+        model_id: str = "llama-3.1-8b-instant",
+        base_url: Optional[str] = None,
+        gateway: Optional[LLMGateway] = None,
+        max_history_turns: int = 3,
+        max_chars_per_turn: int = 300,
+        max_history_chars: int = 1200,
+        max_query_chars: int = 500,
+        max_output_tokens: int = 96,
+        max_follow_up_words: int = 15,
+        max_short_follow_up_words: int = 6,
+        reuse_threshold: float = 0.9,
+    ):
+        if not api_key and gateway is None:
+            raise ValueError(f"API Key for {model_id} not found.")
+        # Có gateway -> dùng chung failover / circuit breaker / hedging, không cần GROQ_API_KEY
+        self.client = AsyncGroq(api_key=api_key, base_url=base_url) if gateway is None else None
+        self.gateway = gateway
+        self.model_id = model_id
+        self.max_history_turns = max_history_turns
+        self.max_chars_per_turn = max_chars_per_turn
+        self.max_history_chars = max_history_chars
+        self.max_query_chars = max_query_chars
+        self.max_output_tokens = max_output_tokens
+        self.max_follow_up_words = max_follow_up_words
+        self.max_short_follow_up_words = max_short_follow_up_words
+        self.reuse_threshold = reuse_threshold
+        print(f"-> QueryCondenser ready. Model: {self.model_id}. History budget: {max_history_turns} turns / {max_history_chars} chars.")
+
+    @classmethod
+    def from_config(
+        cls,
+        api_key: Optional[str],
+        session_cfg: Dict[str, Any],
+        base_url: Optional[str] = None,
+        gateway: Optional[LLMGateway] = None,
+    ) -> 'QueryCondenser':
+        cond_cfg = session_cfg.get('condenser', {})
+        return cls(
+            api_key=api_key,
+            model_id=cond_cfg.get('model_id', "llama-3.1-8b-instant"),
+            base_url=base_url,
+            gateway=gateway,
+            max_history_turns=cond_cfg.get('max_history_turns', 3),
+            max_chars_per_turn=cond_cfg.get('max_chars_per_turn', 300),
+            max_history_chars=cond_cfg.get('max_history_chars', 1200),
+            max_query_chars=cond_cfg.get('max_query_chars', 500),
+            max_output_tokens=cond_cfg.get('max_output_tokens', 96),
+            max_follow_up_words=cond_cfg.get('max_follow_up_words', 15),
+            max_short_follow_up_words=cond_cfg.get('max_short_follow_up_words', 6),
+            reuse_threshold=session_cfg.get('reuse_threshold', 0.9),
+        )
+
+    def is_follow_up(self, query: str, session: Optional[Session]) -> bool:
+        if session is None or not session.turns:
+            return False
+        text = query.lower().strip()
+        words = len(text.split())
+        if words > self.max_follow_up_words:
+            return False
+        if _FOLLOW_UP_PREFIX.search(text) or _FOLLOW_UP_PHRASE.search(text):
+            return True
+        return words <= self.max_short_follow_up_words and bool(_SHORT_FOLLOW_UP_PREFIX.search(text))
+
+    def _history_block(self, session: Session) -> str:
+        """ Lấy các lượt gần nhất, mỗi lượt bị cắt ngắn, tổng không quá max_history_chars. """
+        lines: List[str] = []
+        total = 0
+        for turn in reversed(list(session.turns)[-self.max_history_turns:]):
+            question = (turn.standalone_query or turn.query)[: self.max_chars_per_turn]
+            answer = turn.answer[: self.max_chars_per_turn]
+            block = f"Người dùng: {question}\nTrợ lý: {answer}"
+            if total + len(block) > self.max_history_chars:
+                break
+            lines.append(block)
+            total += len(block)
+        return "\n".join(reversed(lines))
+
+    async def condense(self, query: str, session: Session) -> str:
+        history = self._history_block(session)
+        if not history:
+            return query
+        prompt = f"""Dựa vào lịch sử hội thoại, hãy viết lại câu hỏi cuối cùng của người dùng thành MỘT câu hỏi độc lập,
+đầy đủ ngữ cảnh (nêu rõ chủ đề, văn bản luật nếu có), bằng tiếng Việt. CHỈ trả về câu hỏi đã viết lại.
+
+--- LỊCH SỬ ---
+{history}
+
+--- CÂU HỎI CUỐI ---
+{query[: self.max_query_chars]}
+
+Câu hỏi độc lập:"""
+        messages = [{"role": "user", "content": prompt}]
+        try:
+            if self.gateway is not None:
+                content = await self.gateway.chat(messages, max_tokens=self.max_output_tokens, temperature=0.0, role="condenser")
+            else:
+                response = await self.client.chat.completions.create(
+                    model=self.model_id,
+                    messages=messages,
+                    temperature=0.0,
+                    max_tokens=self.max_output_tokens,
+                )
+                content = response.choices[0].message.content
+            rewritten = content.strip().strip('"')
+            return rewritten[: self.max_query_chars] or query
+        except Exception as e:
+            logger.warning(f"Query condensation failed, using raw query: {e}")
+            FALLBACKS.inc(kind="condense_error")
+            return query
+
+    def reusable_documents(self, session: Session, query_vector: Optional[List[float]]) -> Optional[List[Document]]:
+        """
+        Trả về kết quả truy vấn lần trước nếu câu hỏi (đã viết lại) vẫn cùng chủ đề,
+        tức cosine với query lần trước >= reuse_threshold (vector đã được chuẩn hóa).
+        """
+        if not session.last_documents or session.last_query_vector is None or query_vector is None:
+            CACHE_MISSES.inc(cache="session_retrieval")
+            return None
+        similarity = sum(a * b for a, b in zip(query_vector, session.last_query_vector))
+        if similarity >= self.reuse_threshold:
+            CACHE_HITS.inc(cache="session_retrieval")
+            return session.last_documents
+        CACHE_MISSES.inc(cache="session_retrieval")
+        return None
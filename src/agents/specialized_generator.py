@@ -1,7 +1,14 @@
 import httpx
+import logging
 from typing import List, Optional
 from langchain_core.documents import Document
 
+from src.serving.observability import ERRORS, FALLBACKS
+from src.agents.llm_gateway import LLMGateway, LLMGatewayError
+from src.agents.extractive_answerer import ExtractiveAnswerer, UNAVAILABLE_HEADER
+
+logger = logging.getLogger(__name__)
+
 class SpecificGenerator:
     """
     Tạo phản hồi chi tiết bằng cách gọi vào Groq API.
@@ -13,17 +20,30 @@ class SpecificGenerator:
         model_id: str = "llama-3.1-8b-instant", # Tên model của Groq
         max_output_tokens: int = 1024,
         api_url: str = "https://api.groq.com/openai/v1/chat/completions", # URL chuẩn của Groq
-        timeout: float = 60.0
+        timeout: float = 60.0,
+        gateway: Optional[LLMGateway] = None, # Nếu có: gọi qua LLMGateway (failover + hedging) thay vì api_url
+        extractive: Optional[ExtractiveAnswerer] = None, # Nếu có: LLM lỗi -> trả trích dẫn nguyên văn thay vì thông báo lỗi
     ):
         self.api_key = api_key
         self.api_url = api_url
         self.model_id = model_id
         self.max_output_tokens = max_output_tokens
         self.timeout = timeout
+        self.gateway = gateway
+        self.extractive = extractive
         
-        print(f"-> SpecificGenerator (Groq API) ready. Target: {self.api_url} | Model: {self.model_id}")
+        target = "LLMGateway" if gateway is not None else self.api_url
+        print(f"-> SpecificGenerator (Groq API) ready. Target: {target} | Model: {self.model_id}")
 
-    async def generate_response(self, query: str, documents: List[Document]) -> str:
+    async def generate_response(
+        self,
+        query: str,
+        documents: List[Document],
+        max_tokens: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ) -> str:
+        """ max_tokens / timeout: ghi đè cấu hình cho riêng lần gọi này (theo deadline còn lại của request). """
+        max_tokens = max_tokens or self.max_output_tokens
         # 1. Chuẩn bị Context
         context_texts = []
         for doc in documents:
@@ -61,10 +81,24 @@ Nhiệm vụ của bạn là giải đáp thắc mắc dựa trên các trích d
                 {"role": "system", "content": "Bạn là chuyên gia tư vấn pháp luật y tế Việt Nam tin cậy và chính xác."},
                 {"role": "user", "content": final_user_content}
             ],
-            "max_tokens": self.max_output_tokens,
+            "max_tokens": max_tokens,
             "temperature": 0.3 # Giữ thấp để AI ít "chém gió", bám sát luật hơn
         }
 
+        if self.gateway is not None:
+            try:
+                return await self.gateway.chat(
+                    payload["messages"], max_tokens=max_tokens, temperature=payload["temperature"], role="generate"
+                )
+            except LLMGatewayError as e:
+                logger.error(f"Error in specific generation: {e}")
+                ERRORS.inc(stage="generate")
+                return self._unavailable(query, documents, "Xin lỗi, hệ thống mô hình ngôn ngữ đang quá tải. Bạn vui lòng thử lại sau ít phút.")
+            except httpx.HTTPStatusError as e:
+                logger.error(f"Error in specific generation: {e}")
+                ERRORS.inc(stage="generate")
+                return self._unavailable(query, documents, f"❌ Lỗi API LLM ({e.response.status_code}): {e.response.text}")
+
         # Header bắt buộc cho Groq
         headers = {
             "Content-Type": "application/json",
@@ -73,7 +107,7 @@ Nhiệm vụ của bạn là giải đáp thắc mắc dựa trên các trích d
 
         # 4. Gọi API
         try:
-            async with httpx.AsyncClient(timeout=self.timeout) as client:
+            async with httpx.AsyncClient(timeout=timeout or self.timeout) as client:
                 response = await client.post(
                     self.api_url, 
                     json=payload,
@@ -89,12 +123,25 @@ Nhiệm vụ của bạn là giải đáp thắc mắc dựa trên các trích d
                 if "choices" in result_json and len(result_json["choices"]) > 0:
                     return result_json["choices"][0]["message"]["content"]
                 else:
-                    return "Không tìm thấy câu trả lời từ Groq."
+                    return self._unavailable(query, documents, "Không tìm thấy câu trả lời từ Groq.")
 
         except httpx.ConnectError:
-            return "❌ Lỗi: Không kết nối được tới Server Groq. Vui lòng kiểm tra internet hoặc API URL."
+            ERRORS.inc(stage="generate")
+            return self._unavailable(query, documents, "❌ Lỗi: Không kết nối được tới Server Groq. Vui lòng kiểm tra internet hoặc API URL.")
         except httpx.HTTPStatusError as e:
-             return f"❌ Lỗi API Groq ({e.response.status_code}): {e.response.text}"
+             ERRORS.inc(stage="generate")
+             return self._unavailable(query, documents, f"❌ Lỗi API Groq ({e.response.status_code}): {e.response.text}")
         except Exception as e:
-            print(f"Error in specific generation: {e}")
-            return f"Xin lỗi, có lỗi kỹ thuật khi gọi model: {str(e)}"
\ No newline at end of file
+            logger.error(f"Error in specific generation: {e}")
+            ERRORS.inc(stage="generate")
+            return self._unavailable(query, documents, f"Xin lỗi, có lỗi kỹ thuật khi gọi model: {str(e)}")
+
+    def _unavailable(self, query: str, documents: List[Document], message: str) -> str:
+        """ LLM không trả lời được: trích dẫn nguyên văn đoạn luật khớp nhất (nếu bật), nếu không thì thông báo lỗi. """
+        if self.extractive is None:
+            return message
+        answer = self.extractive.answer(query, documents)
+        if not answer.passages:
+            return message
+        FALLBACKS.inc(kind="llm_unavailable_extractive")
+        return answer.format(UNAVAILABLE_HEADER)
\ No newline at end of file
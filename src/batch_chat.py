@@ -0,0 +1,65 @@
+import os
+import json
+import argparse
+from typing import List, Dict, Any, Iterator
+
+import httpx
+import pandas as pd
+from langchain_core.documents import Document
+
+
+def iter_batch_results(client: httpx.Client, url: str, queries: List[str], args) -> Iterator[Dict[str, Any]]:
+    """ Gửi một batch tới /chat/batch và đọc kết quả NDJSON (đã đúng thứ tự). """
+    payload = {
+        "queries": queries,
+        "k": args.k,
+        "concurrency": args.concurrency,
+        "classify": args.classify,
+        "include_context": True,
+    }
+    with client.stream("POST", url, json=payload) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chạy pipeline RAG cho cả file câu hỏi qua API /chat/batch.")
+    parser.add_argument('--input', type=str, default="data/question_answer/test.csv")
+    parser.add_argument('--output', type=str, required=True, help="vd: data/inferenced_dataset/llama_rag_result.csv")
+    parser.add_argument('--url', type=str, default="http://localhost:8000")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--classify', action='store_true', help="Chạy Intent Classifier thay vì coi mọi câu là 'specific'")
+    parser.add_argument('--timeout', type=float, default=600.0)
+    args = parser.parse_args()
+
+    print(f"📂 Đọc file: {args.input}")
+    df = pd.read_csv(args.input)
+    questions = df["question"].astype(str).str.strip().tolist()
+    url = args.url.rstrip("/") + "/chat/batch"
+
+    outputs, contexts = [], []
+    with httpx.Client(timeout=args.timeout) as client:
+        for start in range(0, len(questions), args.batch_size):
+            batch = questions[start : start + args.batch_size]
+            print(f"   -> Processing batch {start} to {start + len(batch)}...")
+            for item in iter_batch_results(client, url, batch, args):
+                outputs.append(item["response"])
+                # Giữ định dạng cột context giống các file *_rag_result.csv cũ (repr list Document)
+                docs = [Document(**c) for c in (item.get("context") or [])]
+                contexts.append(str(docs))
+
+    result_df = df.copy()
+    result_df["context"] = contexts
+    result_df["model_output"] = outputs
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    result_df.to_csv(args.output, index=False)
+    print(f"✅ Xong! Kết quả lưu tại: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
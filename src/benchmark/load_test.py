@@ -0,0 +1,278 @@
+"""
+Load test cho FastAPI /chat: phát lại hỗn hợp câu hỏi thực tế (specific từ test.csv
++ câu chào hỏi general) theo RPS mục tiêu (open-loop) hoặc theo số client đồng thời
+(closed-loop), tăng dần từng bước để tìm điểm bão hòa.
+
+Cách chạy (kết hợp với mock server để đo offline):
+    python -m src.benchmark.mock_llm_server --port 9000 &
+    GROQ_BASE_URL=http://localhost:9000 LLM_API_URL=http://localhost:9000/v1/chat/completions python main_api.py &
+    python -m src.benchmark.load_test --rps 1 2 4 8 16 --duration 30
+    python -m src.benchmark.load_test --concurrency 1 4 16 64 --duration 30
+
+Mọi request của load test đến từ cùng một IP: để admission.rate_limit.enabled: false trong
+configs/serving.yml (mặc định), nếu không kết quả chỉ đo giới hạn của rate limiter (429).
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+from collections import Counter
+from typing import List, Dict, Any, Optional
+
+import httpx
+import numpy as np
+import pandas as pd
+
+GENERAL_QUERIES = [
+    "Xin chào",
+    "Chào bạn, bạn là ai?",
+    "Cảm ơn bạn nhiều nhé",
+    "Alo admin ơi",
+    "Bạn có khỏe không?",
+    "Tạm biệt",
+]
+
+# Biên các bucket histogram (ms)
+HISTOGRAM_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+
+def load_query_mix(dataset: str, general_ratio: float, seed: int) -> List[str]:
+    """ Trộn câu hỏi chuyên môn (từ dataset) với câu hỏi chung theo tỉ lệ general_ratio. """
+    questions = pd.read_csv(dataset)["question"].dropna().astype(str).tolist()
+    rng = random.Random(seed)
+    n_general = int(round(len(questions) * general_ratio / max(1e-9, 1 - general_ratio)))
+    mix = questions + [rng.choice(GENERAL_QUERIES) for _ in range(n_general)]
+    rng.shuffle(mix)
+    return mix
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """ 'classify;dur=12.3, retrieve;dur=45.6' -> {'classify': 12.3, 'retrieve': 45.6} """
+    stages = {}
+    if not header:
+        return stages
+    for part in header.split(","):
+        fields = [f.strip() for f in part.split(";")]
+        name = fields[0]
+        for f in fields[1:]:
+            if f.startswith("dur="):
+                try:
+                    stages[name] = float(f[4:])
+                except ValueError:
+                    pass
+    return stages
+
+
+def histogram(values: List[float]) -> Dict[str, int]:
+    # Bucket i chứa các giá trị trong (bucket[i-1], bucket[i]] (giống "le" của Prometheus)
+    idx = np.searchsorted(HISTOGRAM_BUCKETS_MS, values, side="left")
+    counts = np.bincount(idx, minlength=len(HISTOGRAM_BUCKETS_MS) + 1)
+    labels = [f"le_{b}" for b in HISTOGRAM_BUCKETS_MS] + ["le_inf"]
+    return {label: int(c) for label, c in zip(labels, counts)}
+
+
+def summarize(values: List[float]) -> Dict[str, Any]:
+    if not values:
+        return {}
+    arr = np.asarray(values, dtype=float)
+    return {
+        "count": int(arr.size),
+        "p50": float(np.percentile(arr, 50)),
+        "p95": float(np.percentile(arr, 95)),
+        "p99": float(np.percentile(arr, 99)),
+        "mean": float(arr.mean()),
+        "max": float(arr.max()),
+        "histogram": histogram(values),
+    }
+
+
+class StepRecorder:
+    """ Thu thập kết quả của một bước tải (một mức RPS hoặc concurrency). """
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.stages: Dict[str, List[float]] = {}
+        self.outcomes = Counter()
+        self.intents = Counter()
+
+    def record(self, latency_ms: float, outcome: str, intent: Optional[str] = None, stages: Optional[Dict[str, float]] = None):
+        self.outcomes[outcome] += 1
+        if outcome == "ok":
+            self.latencies.append(latency_ms)
+            if intent:
+                self.intents[intent] += 1
+            for name, ms in (stages or {}).items():
+                self.stages.setdefault(name, []).append(ms)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        sent = sum(self.outcomes.values())
+        errors = sent - self.outcomes["ok"]
+        return {
+            "sent": sent,
+            "completed_ok": self.outcomes["ok"],
+            "error_rate": errors / sent if sent else 0.0,
+            "outcomes": dict(self.outcomes),
+            "intents": dict(self.intents),
+            "throughput_rps": self.outcomes["ok"] / elapsed if elapsed > 0 else 0.0,
+            "latency_ms": summarize(self.latencies),
+            "stage_latency_ms": {name: summarize(v) for name, v in self.stages.items()},
+        }
+
+
+async def send_one(client: httpx.AsyncClient, url: str, query: str, recorder: StepRecorder):
+    t0 = time.perf_counter()
+    try:
+        resp = await client.post(url, json={"query": query, "session_id": None})
+        latency = (time.perf_counter() - t0) * 1000
+        if resp.status_code != 200:
+            recorder.record(latency, f"http_{resp.status_code}")
+            return
+        body = resp.json()
+        # API hiện trả lỗi upstream dưới dạng chuỗi trong response -> tính là lỗi
+        if body.get("intent") == "error" or str(body.get("response", "")).startswith("❌"):
+            recorder.record(latency, "upstream_error")
+            return
+        recorder.record(latency, "ok", body.get("intent"), parse_server_timing(resp.headers.get("server-timing")))
+    except httpx.TimeoutException:
+        recorder.record((time.perf_counter() - t0) * 1000, "timeout")
+    except httpx.HTTPError as e:
+        recorder.record((time.perf_counter() - t0) * 1000, type(e).__name__)
+
+
+async def run_open_loop(url: str, queries: List[str], rps: float, duration: float, timeout: float, seed: int) -> Dict[str, Any]:
+    """ Open-loop: yêu cầu đến theo tiến trình Poisson với tốc độ rps, không phụ thuộc phản hồi. """
+    rng = random.Random(seed)
+    recorder = StepRecorder()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=1000)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        tasks = []
+        t_start = time.perf_counter()
+        next_at = t_start
+        i = 0
+        while next_at - t_start < duration:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send_one(client, url, queries[i % len(queries)], recorder)))
+            i += 1
+            next_at += rng.expovariate(rps)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - t_start
+    result = recorder.report(elapsed)
+    result.update({"mode": "rps", "target": rps, "elapsed_s": elapsed})
+    return result
+
+
+async def run_closed_loop(url: str, queries: List[str], concurrency: int, duration: float, timeout: float, seed: int) -> Dict[str, Any]:
+    """ Closed-loop: `concurrency` client, mỗi client gửi yêu cầu mới ngay khi nhận phản hồi. """
+    recorder = StepRecorder()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=1000)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as client:
+        t_start = time.perf_counter()
+
+        async def worker(worker_id: int):
+            rng = random.Random(seed + worker_id)
+            while time.perf_counter() - t_start < duration:
+                await send_one(client, url, rng.choice(queries), recorder)
+
+        await asyncio.gather(*(worker(w) for w in range(concurrency)))
+        elapsed = time.perf_counter() - t_start
+    result = recorder.report(elapsed)
+    result.update({"mode": "concurrency", "target": concurrency, "elapsed_s": elapsed})
+    return result
+
+
+def find_saturation(steps: List[Dict[str, Any]], max_error_rate: float, slo_p95_ms: float) -> Optional[Dict[str, Any]]:
+    """
+    Bước cuối cùng còn "khỏe": error rate <= max_error_rate, p95 <= SLO và throughput còn tăng
+    (open-loop: đạt >= 90% RPS mục tiêu; closed-loop: tăng >= 5% so với bước trước).
+    """
+    healthy = None
+    prev_throughput = 0.0
+    for step in steps:
+        p95 = step["latency_ms"].get("p95", float("inf"))
+        ok = step["error_rate"] <= max_error_rate and p95 <= slo_p95_ms
+        if step["mode"] == "rps":
+            ok = ok and step["throughput_rps"] >= 0.9 * step["target"]
+        else:
+            ok = ok and step["throughput_rps"] >= 1.05 * prev_throughput
+        if not ok:
+            break
+        healthy = {"mode": step["mode"], "target": step["target"], "throughput_rps": step["throughput_rps"], "p95_ms": p95}
+        prev_throughput = step["throughput_rps"]
+    return healthy
+
+
+async def async_main(args):
+    url = args.url.rstrip("/") + "/chat"
+    queries = load_query_mix(args.dataset, args.general_ratio, args.seed)
+    print(f"📂 {len(queries)} câu hỏi trong query mix (general_ratio={args.general_ratio})")
+
+    steps = []
+    if args.concurrency:
+        levels, runner = args.concurrency, run_closed_loop
+    else:
+        levels, runner = args.rps, run_open_loop
+    for level in levels:
+        print(f"🚀 Bước tải: {'concurrency' if args.concurrency else 'rps'}={level} trong {args.duration}s...")
+        step = await runner(url, queries, level, args.duration, args.timeout, args.seed)
+        steps.append(step)
+        lat = step["latency_ms"]
+        print(
+            f"   -> throughput={step['throughput_rps']:.2f} rps | error_rate={step['error_rate']:.2%} | "
+            f"p50={lat.get('p50', 0):.0f}ms p95={lat.get('p95', 0):.0f}ms p99={lat.get('p99', 0):.0f}ms"
+        )
+        if args.cooldown > 0:
+            await asyncio.sleep(args.cooldown)
+
+    saturation = find_saturation(steps, args.max_error_rate, args.slo_p95_ms)
+    print(f"📈 Điểm bão hòa (bước khỏe cuối cùng): {saturation}")
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        commit = None
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": commit,
+        "url": url,
+        "dataset": args.dataset,
+        "general_ratio": args.general_ratio,
+        "duration_s": args.duration,
+        "slo_p95_ms": args.slo_p95_ms,
+        "max_error_rate": args.max_error_rate,
+        "saturation": saturation,
+        "steps": steps,
+    }
+    out_path = args.output or os.path.join("data", "benchmark", f"load_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ Xong! Kết quả lưu tại: {out_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test cho FastAPI /chat.")
+    parser.add_argument("--url", type=str, default="http://localhost:8000")
+    parser.add_argument("--dataset", type=str, default="data/question_answer/test.csv")
+    parser.add_argument("--general-ratio", type=float, default=0.2)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--rps", type=float, nargs="+", default=[1, 2, 4, 8])
+    group.add_argument("--concurrency", type=int, nargs="+", default=None)
+    parser.add_argument("--duration", type=float, default=30.0, help="Thời gian mỗi bước tải (giây)")
+    parser.add_argument("--cooldown", type=float, default=2.0)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--slo-p95-ms", type=float, default=10000.0)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    asyncio.run(async_main(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Server giả lập API tương thích OpenAI (/v1/chat/completions) để benchmark
+`main_api.py` offline, không tốn quota Groq/LLM.
+
+Cách chạy:
+    python -m src.benchmark.mock_llm_server --port 9000 --latency-ms 300 --jitter-ms 100
+
+Sau đó trỏ API chính vào server giả lập:
+    GROQ_BASE_URL=http://localhost:9000
+    LLM_API_URL=http://localhost:9000/v1/chat/completions
+"""
+import json
+import time
+import random
+import re
+import asyncio
+import argparse
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+GENERAL_MARKERS = ("xin chào", "chào", "cảm ơn", "cám ơn", "hello", "hi", "alo", "bạn là ai", "tạm biệt")
+# So khớp nguyên từ: "hi" không được khớp trong "khi", "chi", "thi"
+_GENERAL_PATTERN = re.compile(r"(?<!\w)(?:" + "|".join(re.escape(m) for m in GENERAL_MARKERS) + r")(?!\w)")
+
+
+@dataclass
+class MockSettings:
+    latency_ms: float = 300.0     # Độ trễ trung bình trước token đầu tiên
+    jitter_ms: float = 100.0      # Độ lệch (phân phối đều +/- jitter)
+    tokens_per_second: float = 200.0  # Tốc độ sinh token (ảnh hưởng cả non-stream và stream)
+    error_rate: float = 0.0       # Tỉ lệ trả lỗi 429
+    answer_tokens: int = 120      # Số token của câu trả lời giả
+
+
+settings = MockSettings()
+app = FastAPI(title="Mock OpenAI-compatible LLM server")
+
+
+def _fake_answer(messages: list, max_tokens: int) -> str:
+    last = messages[-1]["content"] if messages else ""
+    system = messages[0]["content"] if messages else ""
+
+    # Giả lập Intent Classifier: chỉ trả về "general" hoặc "specific"
+    if "Intent Classifier" in system or "Intent Classifier" in last:
+        current = last.rsplit('Input: "', 1)[-1].lower()
+        return "general" if _GENERAL_PATTERN.search(current) else "specific"
+
+    # Giả lập QueryCondenser: trả lại nguyên câu hỏi cuối
+    if "Câu hỏi độc lập:" in last and "--- CÂU HỎI CUỐI ---" in last:
+        return last.split("--- CÂU HỎI CUỐI ---", 1)[1].split("Câu hỏi độc lập:", 1)[0].strip()
+
+    n_tokens = max(1, min(settings.answer_tokens, max_tokens))
+    return " ".join(["Theo quy định hiện hành"] + ["nội dung"] * (n_tokens - 4))
+
+
+async def _sleep_latency():
+    delay = settings.latency_ms + random.uniform(-settings.jitter_ms, settings.jitter_ms)
+    await asyncio.sleep(max(0.0, delay) / 1000)
+
+
+def _completion_body(model: str, content: str) -> dict:
+    return {
+        "id": f"chatcmpl-mock-{int(time.time() * 1000)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len(content.split()), "total_tokens": len(content.split())},
+    }
+
+
+async def _stream(model: str, content: str):
+    per_token = 1.0 / settings.tokens_per_second if settings.tokens_per_second > 0 else 0.0
+    for i, word in enumerate(content.split(" ")):
+        chunk = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        await asyncio.sleep(per_token)
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+@app.post("/openai/v1/chat/completions")  # Đường dẫn mà Groq SDK sử dụng
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "mock-model")
+    messages = body.get("messages", [])
+    max_tokens = int(body.get("max_tokens") or 1024)
+
+    await _sleep_latency()
+    if settings.error_rate > 0 and random.random() < settings.error_rate:
+        return JSONResponse(status_code=429, content={"error": {"message": "Rate limit reached (mock)", "type": "rate_limit"}})
+
+    content = _fake_answer(messages, max_tokens)
+    if body.get("stream"):
+        return StreamingResponse(_stream(model, content), media_type="text/event-stream")
+
+    # Non-stream: mô phỏng thời gian sinh toàn bộ token
+    if settings.tokens_per_second > 0:
+        await asyncio.sleep(len(content.split()) / settings.tokens_per_second)
+    return _completion_body(model, content)
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "mock-model", "object": "model"}]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible LLM server.")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=settings.latency_ms)
+    parser.add_argument("--jitter-ms", type=float, default=settings.jitter_ms)
+    parser.add_argument("--tokens-per-second", type=float, default=settings.tokens_per_second)
+    parser.add_argument("--error-rate", type=float, default=settings.error_rate)
+    parser.add_argument("--answer-tokens", type=int, default=settings.answer_tokens)
+    args = parser.parse_args()
+
+    settings.latency_ms = args.latency_ms
+    settings.jitter_ms = args.jitter_ms
+    settings.tokens_per_second = args.tokens_per_second
+    settings.error_rate = args.error_rate
+    settings.answer_tokens = args.answer_tokens
+
+    print(f"🚀 Mock LLM server tại http://{args.host}:{args.port} | {settings}")
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
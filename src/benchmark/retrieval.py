@@ -0,0 +1,270 @@
+"""
+Benchmark offline cho DatabaseRetriever: phát lại bộ câu hỏi trong
+`data/question_answer/test_with_context.csv`, quét nhiều cấu hình
+(bm25_k, vector_k, fusion, k, reranker on/off, số shard được route) và ghi recall@k, MRR, nDCG@k
+cùng độ trễ p50/p95/p99 của từng bước ra file JSON.
+
+Cách chạy:
+    python -m src.benchmark.retrieval --bm25-k 5 10 20 --vector-k 5 10 --fusion concat rrf --rerank off on
+    # Khi bật sharding: so routing top-m với tìm mọi shard (routing_recall@k = độ phủ top-k exhaustive)
+    python -m src.benchmark.retrieval --shard-top-m 0 1 2 4
+    # So chính sách truy vấn thích ứng với bm25_k / vector_k cố định
+    python -m src.benchmark.retrieval --adaptive off on
+"""
+import os
+import re
+import io
+import json
+import time
+import asyncio
+import argparse
+import itertools
+import subprocess
+import contextlib
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+import pandas as pd
+from langchain_core.documents import Document
+
+DOC_NUMBER_PATTERN = re.compile(r"\d+/\d{4}/[A-ZĐ][A-ZĐ0-9\-]*")
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+STAGES = ("bm25", "embed", "vector", "shard_search", "fusion", "rerank", "total")
+
+
+# --- Đánh giá mức độ liên quan ---
+def extract_doc_numbers(text: str) -> set:
+    """ Lấy các số hiệu văn bản (vd: 02/2014/TT-BYT) xuất hiện trong text. """
+    if not isinstance(text, str):
+        return set()
+    return {m.upper() for m in DOC_NUMBER_PATTERN.findall(text)}
+
+
+def _tokens(text: str) -> set:
+    return set(TOKEN_PATTERN.findall(text.lower())) if isinstance(text, str) else set()
+
+
+def is_relevant(doc: Document, gold_answer: str, gold_doc_numbers: set, overlap_threshold: float) -> bool:
+    """
+    Một chunk được coi là liên quan nếu:
+    - số hiệu văn bản nguồn của nó được trích dẫn trong đáp án chuẩn, hoặc
+    - nó phủ ít nhất `overlap_threshold` tỉ lệ từ vựng của đáp án chuẩn.
+    """
+    source_numbers = extract_doc_numbers(doc.metadata.get("source", ""))
+    if gold_doc_numbers and source_numbers & gold_doc_numbers:
+        return True
+    answer_tokens = _tokens(gold_answer)
+    if not answer_tokens:
+        return False
+    overlap = len(answer_tokens & _tokens(doc.page_content)) / len(answer_tokens)
+    return overlap >= overlap_threshold
+
+
+def ranking_metrics(relevance: List[bool], k: int) -> Dict[str, float]:
+    """ recall@k (tỉ lệ câu hỏi có ít nhất một chunk liên quan trong top-k), RR và nDCG@k (gain nhị phân). """
+    rel = relevance[:k]
+    hit = float(any(rel))
+    rr = 0.0
+    for rank, r in enumerate(rel, start=1):
+        if r:
+            rr = 1.0 / rank
+            break
+    dcg = sum(1.0 / np.log2(rank + 1) for rank, r in enumerate(rel, start=1) if r)
+    n_rel = sum(rel)
+    idcg = sum(1.0 / np.log2(rank + 1) for rank in range(1, n_rel + 1))
+    ndcg = float(dcg / idcg) if idcg > 0 else 0.0
+    return {"recall": hit, "rr": rr, "ndcg": ndcg}
+
+
+def latency_summary(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    arr = np.asarray(values, dtype=float)
+    return {
+        "p50": float(np.percentile(arr, 50)),
+        "p95": float(np.percentile(arr, 95)),
+        "p99": float(np.percentile(arr, 99)),
+        "mean": float(arr.mean()),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+# --- Chạy benchmark ---
+async def run_config(
+    retriever,
+    questions: List[str],
+    answers: List[str],
+    params: Dict[str, Any],
+    overlap_threshold: float,
+    warmup: int = 3,
+    verbose: bool = False,
+    policy=None,
+) -> Dict[str, Any]:
+    """ Phát lại toàn bộ câu hỏi với một cấu hình, trả về metrics + latency. """
+    retriever.bm25_k = params["bm25_k"]
+    retriever.vector_k = params["vector_k"]
+    retriever.fusion = params["fusion"]
+    retriever.use_reranker = params["rerank"]
+    retriever.shard_top_m = params.get("shard_top_m")
+    retriever.policy = policy if params.get("adaptive") else None
+    if policy is not None:
+        policy.stats.clear()
+    # Routing (top-m > 0) được so với exhaustive trên cùng câu hỏi
+    check_routing = retriever.shards is not None and bool(retriever.shard_top_m)
+    k = params["k"]
+
+    sink = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with sink:
+        # Cache embedding / tiền xử lý còn từ cấu hình trước hoặc warm-up sẽ làm latency các cấu hình sau
+        # thấp giả tạo: warm-up chỉ để nạp model, mỗi lượt đo bắt đầu với cache rỗng
+        retriever.clear_caches()
+        for query in questions[:warmup]:
+            await retriever.retrieve(query, k=k)
+        retriever.clear_caches()
+
+        per_query = []
+        routing_recall: List[float] = []
+        stage_latency: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+        for query, answer in zip(questions, answers):
+            timings: Dict[str, float] = {}
+            docs = await retriever.retrieve(query, k=k, timings=timings)
+            gold_numbers = extract_doc_numbers(answer)
+            relevance = [is_relevant(doc, answer, gold_numbers, overlap_threshold) for doc in docs]
+            per_query.append(ranking_metrics(relevance, k))
+            for stage, ms in timings.items():
+                stage_latency.setdefault(stage, []).append(ms)
+            if check_routing:
+                # Lượt exhaustive chỉ để đo recall: không tính vào thống kê quyết định của chính sách thích ứng
+                decisions = retriever.policy.stats.copy() if retriever.policy is not None else None
+                retriever.shard_top_m = 0
+                exhaustive = {doc.page_content for doc in await retriever.retrieve(query, k=k)}
+                retriever.shard_top_m = params["shard_top_m"]
+                if decisions is not None:
+                    retriever.policy.stats = decisions
+                if exhaustive:
+                    routing_recall.append(len(exhaustive & {doc.page_content for doc in docs}) / len(exhaustive))
+
+    n = len(per_query)
+    metrics = {
+        f"recall@{k}": sum(m["recall"] for m in per_query) / n,
+        "mrr": sum(m["rr"] for m in per_query) / n,
+        f"ndcg@{k}": sum(m["ndcg"] for m in per_query) / n,
+    }
+    if routing_recall:
+        metrics[f"routing_recall@{k}"] = sum(routing_recall) / len(routing_recall)
+    return {
+        "params": params,
+        "metrics": metrics,
+        # Phân bố quyết định của chính sách thích ứng (gồm cả lượt warm-up)
+        "adaptive_decisions": dict(retriever.policy.stats) if retriever.policy is not None else None,
+        "latency_ms": {stage: latency_summary(v) for stage, v in stage_latency.items() if v},
+        "n_queries": n,
+    }
+
+
+def build_sweep(args) -> List[Dict[str, Any]]:
+    sweep = []
+    for bm25_k, vector_k, fusion, k, rerank, shard_top_m, adaptive in itertools.product(
+        args.bm25_k, args.vector_k, args.fusion, args.k, args.rerank, args.shard_top_m, args.adaptive
+    ):
+        sweep.append({
+            "bm25_k": bm25_k,
+            "vector_k": vector_k,
+            "fusion": fusion,
+            "k": k,
+            "rerank": rerank == "on",
+            "shard_top_m": shard_top_m,
+            "adaptive": adaptive == "on",
+        })
+    return sweep
+
+
+async def async_main(args):
+    from src.agents.database_retriever import DatabaseRetriever
+    from src.agents.reranker import CrossEncoderReranker
+    from src.agents.retrieval_policy import AdaptiveRetrievalPolicy
+
+    df = pd.read_csv(args.dataset).dropna(subset=["question", "answer"])
+    if args.limit:
+        df = df.head(args.limit)
+    questions = df["question"].astype(str).tolist()
+    answers = df["answer"].astype(str).tolist()
+    print(f"📂 Đọc {len(questions)} câu hỏi từ {args.dataset}")
+
+    t0 = time.perf_counter()
+    retriever = DatabaseRetriever.from_config(config_path=args.config)
+    if "on" in args.rerank and retriever.reranker is None:
+        cfg = DatabaseRetriever._load_config(args.config)
+        retriever.reranker = CrossEncoderReranker.from_config(cfg.get("reranking", {}))
+    policy = retriever.policy
+    if "on" in args.adaptive and policy is None:
+        cfg = DatabaseRetriever._load_config(args.config)
+        policy = AdaptiveRetrievalPolicy.from_config(cfg.get("retrieval", {}).get("adaptive", {}))
+    init_seconds = time.perf_counter() - t0
+    print(f"-> Thời gian khởi tạo: {init_seconds:.2f} giây")
+
+    runs = []
+    for params in build_sweep(args):
+        result = await run_config(
+            retriever, questions, answers, params,
+            overlap_threshold=args.overlap_threshold,
+            warmup=args.warmup,
+            verbose=args.verbose,
+            policy=policy,
+        )
+        runs.append(result)
+        m = result["metrics"]
+        total = result["latency_ms"].get("total", {})
+        print(
+            f"   {params} | " + " ".join(f"{name}={value:.3f}" for name, value in m.items())
+            + f" | total p50={total.get('p50', 0):.1f}ms p95={total.get('p95', 0):.1f}ms p99={total.get('p99', 0):.1f}ms"
+        )
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": _git_commit(),
+        "config_path": args.config,
+        "dataset": args.dataset,
+        "overlap_threshold": args.overlap_threshold,
+        "init_seconds": init_seconds,
+        "runs": runs,
+    }
+
+    out_path = args.output or os.path.join("data", "benchmark", f"retrieval_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✅ Xong! Kết quả lưu tại: {out_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark chất lượng và độ trễ của DatabaseRetriever.")
+    parser.add_argument("--config", type=str, default="configs/indexing_pipeline.yml")
+    parser.add_argument("--dataset", type=str, default="data/question_answer/test_with_context.csv")
+    parser.add_argument("--output", type=str, default=None, help="File JSON kết quả (mặc định: data/benchmark/retrieval_<time>.json)")
+    parser.add_argument("--bm25-k", type=int, nargs="+", default=[10])
+    parser.add_argument("--vector-k", type=int, nargs="+", default=[10])
+    parser.add_argument("--fusion", type=str, nargs="+", default=["concat"], choices=["concat", "rrf"])
+    parser.add_argument("--k", type=int, nargs="+", default=[5])
+    parser.add_argument("--rerank", type=str, nargs="+", default=["off"], choices=["off", "on"])
+    parser.add_argument("--shard-top-m", type=int, nargs="+", default=[None],
+                        help="Số shard router chọn (0: mọi shard); cần sharding.enabled trong config")
+    parser.add_argument("--adaptive", type=str, nargs="+", default=["off"], choices=["off", "on"],
+                        help="Chính sách truy vấn thích ứng (retrieval.adaptive trong config)")
+    parser.add_argument("--overlap-threshold", type=float, default=0.5)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true", help="Giữ lại log của retriever trong lúc đo")
+    args = parser.parse_args()
+
+    asyncio.run(async_main(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Index artifacts dạng file phẳng, đọc bằng memory-map, để nhiều worker của API
+(`uvicorn main_api:app --workers N`) dùng chung MỘT bản dữ liệu trong page cache
+của hệ điều hành thay vì mỗi process tự giữ một bản copy:
+
+    <directory>/
+        manifest.json          # số chunk, số chiều vector, tham số BM25, thời điểm export
+        bm25/                  # SparseBM25Index.save (data/indices/indptr .npy + vocab)
+        vectors.npy            # float32 (N, d), đã chuẩn hóa L2
+        chunks/text.bin        # toàn bộ page_content, UTF-8, nối liền
+        chunks/offsets.npy     # int64 (N + 1), chunk i = text[offsets[i]:offsets[i+1]]
+        chunks/meta_ids.npy    # int32 (N), chỉ số vào bảng metadata (đã loại trùng)
+        chunks/metadata.json   # bảng metadata duy nhất (các chunk cùng văn bản dùng chung)
+
+Export một lần từ Chroma:
+    python -m src.indexing.artifacts --config configs/indexing_pipeline.yml
+"""
+import os
+import json
+import time
+import argparse
+from typing import List, Dict, Any, Optional, Tuple, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.indexing.bm25_index import SparseBM25Index
+
+MANIFEST_FILE = "manifest.json"
+
+
+class MmapDocumentList(Sequence):
+    """
+    Danh sách Document "lười": text nằm trong file mmap, Document chỉ được tạo
+    khi được truy cập (vd: top-k của BM25), nên gần như không tốn bộ nhớ riêng của process.
+    """
+    def __init__(self, directory: str):
+        text_path = os.path.join(directory, "text.bin")
+        # np.memmap không mở được file rỗng
+        if os.path.getsize(text_path) > 0:
+            self.text = np.memmap(text_path, dtype=np.uint8, mode="r")
+        else:
+            self.text = np.zeros(0, dtype=np.uint8)
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode="r")
+        self.meta_ids = np.load(os.path.join(directory, "meta_ids.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "metadata.json"), "r", encoding="utf-8") as f:
+            self.metadata_table: List[Dict[str, Any]] = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def text_at(self, i: int) -> str:
+        return bytes(self.text[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        # Copy metadata để caller sửa Document không làm hỏng bảng dùng chung
+        return Document(page_content=self.text_at(i), metadata=dict(self.metadata_table[self.meta_ids[i]]))
+
+    def column(self, key: str) -> List[Any]:
+        """ Giá trị của một khóa metadata cho mọi chunk, không tạo Document. """
+        by_meta = [meta.get(key) for meta in self.metadata_table]
+        return [by_meta[mid] for mid in self.meta_ids.tolist()]
+
+    def texts(self):
+        for i in range(len(self)):
+            yield self.text_at(i)
+
+    def matching_meta_ids(self, filters: Dict[str, Any]) -> np.ndarray:
+        """ Các chỉ số metadata thỏa filter kiểu Chroma (so sánh bằng, $eq, $in, $and). """
+        return np.asarray(
+            [mid for mid, meta in enumerate(self.metadata_table) if _match_filter(meta, filters)],
+            dtype=np.int32,
+        )
+
+
+def _match_filter(metadata: Dict[str, Any], filters: Dict[str, Any]) -> bool:
+    for key, cond in filters.items():
+        if key == "$and":
+            if not all(_match_filter(metadata, sub) for sub in cond):
+                return False
+        elif key == "$or":
+            if not any(_match_filter(metadata, sub) for sub in cond):
+                return False
+        elif isinstance(cond, dict):
+            for op, value in cond.items():
+                if op == "$eq" and metadata.get(key) != value:
+                    return False
+                if op == "$ne" and metadata.get(key) == value:
+                    return False
+                if op == "$in" and metadata.get(key) not in value:
+                    return False
+                if op not in ("$eq", "$ne", "$in"):
+                    raise ValueError(f"Toán tử filter '{op}' chưa được hỗ trợ trên mmap artifacts.")
+        elif metadata.get(key) != cond:
+            return False
+    return True
+
+
+class MmapVectorStore:
+    """
+    Vector search brute-force (tích vô hướng trên vector đã chuẩn hóa = cosine) trên ma trận mmap.
+    Cùng giao diện `similarity_search_by_vector` mà DatabaseRetriever dùng với Chroma.
+    """
+    def __init__(self, vectors: np.ndarray, documents: MmapDocumentList):
+        self.vectors = vectors
+        self.documents = documents
+
+    def similarity_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[Dict[str, Any]] = None,
+    ) -> List[Document]:
+        doc_ids, _ = self.search(np.asarray(embedding, dtype=np.float32), k, filter)
+        return [self.documents[i] for i in doc_ids]
+
+    def search(self, query: np.ndarray, k: int, filters: Optional[Dict[str, Any]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self.vectors @ query
+        if filters:
+            allowed = np.isin(self.documents.meta_ids, self.documents.matching_meta_ids(filters))
+            scores = np.where(allowed, scores, -np.inf)
+            k = min(k, int(allowed.sum()))
+        k = min(k, scores.shape[0])
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        order = np.argsort(-scores[top], kind="stable")
+        return top[order], scores[top[order]]
+
+
+def write_artifacts(
+    directory: str,
+    texts: List[str],
+    metadatas: List[Dict[str, Any]],
+    vectors: np.ndarray,
+    bm25_k1: float = 1.5,
+    bm25_b: float = 0.75,
+):
+    """ Ghi toàn bộ artifacts. Ghi vào thư mục tạm rồi đổi tên để worker không đọc phải bản dở dang. """
+    tmp_dir = directory.rstrip("/\\") + ".tmp"
+    chunk_dir = os.path.join(tmp_dir, "chunks")
+    os.makedirs(chunk_dir, exist_ok=True)
+
+    # --- Chunk text: một buffer liền + offsets ---
+    encoded = [t.encode("utf-8") for t in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    with open(os.path.join(chunk_dir, "text.bin"), "wb") as f:
+        for b in encoded:
+            f.write(b)
+    np.save(os.path.join(chunk_dir, "offsets.npy"), offsets)
+
+    # --- Metadata: loại trùng (các chunk của cùng một văn bản có metadata giống nhau) ---
+    table: List[Dict[str, Any]] = []
+    index: Dict[str, int] = {}
+    meta_ids = np.zeros(len(metadatas), dtype=np.int32)
+    for i, meta in enumerate(metadatas):
+        key = json.dumps(meta or {}, sort_keys=True, ensure_ascii=False)
+        meta_ids[i] = index.setdefault(key, len(table))
+        if meta_ids[i] == len(table):
+            table.append(meta or {})
+    np.save(os.path.join(chunk_dir, "meta_ids.npy"), meta_ids)
+    with open(os.path.join(chunk_dir, "metadata.json"), "w", encoding="utf-8") as f:
+        json.dump(table, f, ensure_ascii=False)
+
+    # --- Vectors (chuẩn hóa lại cho chắc, để tích vô hướng = cosine) ---
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.save(os.path.join(tmp_dir, "vectors.npy"), vectors / np.maximum(norms, 1e-12))
+
+    # --- BM25 ---
+    bm25_index = SparseBM25Index.from_texts(texts, k1=bm25_k1, b=bm25_b)
+    bm25_index.save(os.path.join(tmp_dir, "bm25"))
+
+    manifest = {
+        "num_chunks": len(texts),
+        "dim": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+        "num_metadata": len(table),
+        "bm25": {"k1": bm25_k1, "b": bm25_b, "vocab_size": len(bm25_index.vocab)},
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    if os.path.exists(directory):
+        old_dir = directory.rstrip("/\\") + ".old"
+        if os.path.exists(old_dir):
+            import shutil
+            shutil.rmtree(old_dir)
+        os.replace(directory, old_dir)
+    os.replace(tmp_dir, directory)
+    return manifest
+
+
+def load_artifacts(directory: str) -> Tuple[MmapVectorStore, MmapDocumentList, SparseBM25Index, Dict[str, Any]]:
+    """ Mở artifacts ở chế độ read-only mmap: (vector_store, documents, bm25_index, manifest). """
+    manifest_path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(
+            f"Không tìm thấy artifacts tại '{directory}'. Chạy: python -m src.indexing.artifacts --config <config>"
+        )
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    documents = MmapDocumentList(os.path.join(directory, "chunks"))
+    vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+    bm25_index = SparseBM25Index.load(os.path.join(directory, "bm25"), mmap=True)
+    return MmapVectorStore(vectors, documents), documents, bm25_index, manifest
+
+
+def export_from_chroma(cfg: Dict[str, Any], directory: Optional[str] = None) -> Dict[str, Any]:
+    """ Đọc documents + embeddings đã có trong Chroma và ghi ra artifacts (không embed lại). """
+    from langchain_chroma import Chroma
+
+    from src.indexing.projection import projected_collection_name
+
+    data_cfg = cfg['data']
+    collection = projected_collection_name(cfg)
+    directory = directory or cfg.get('artifacts', {}).get('directory', "./data/legal_documents/artifacts")
+    print(f"-> Đọc Chroma tại: {data_cfg['persist_directory']} (Collection: {collection})")
+    vector_db = Chroma(persist_directory=data_cfg['persist_directory'], collection_name=collection)
+    dump = vector_db.get(include=["documents", "metadatas", "embeddings"])
+    if not dump['documents']:
+        raise ValueError("ChromaDB không chứa Documents nào để export.")
+
+    retrieval_cfg = cfg.get('retrieval', {})
+    t0 = time.perf_counter()
+    manifest = write_artifacts(
+        directory,
+        texts=list(dump['documents']),
+        metadatas=list(dump['metadatas']),
+        vectors=np.asarray(dump['embeddings'], dtype=np.float32),
+        bm25_k1=retrieval_cfg.get('bm25_k1', 1.5),
+        bm25_b=retrieval_cfg.get('bm25_b', 0.75),
+    )
+    print(f"-> Export {manifest['num_chunks']} chunks (dim={manifest['dim']}) tới {directory} trong {time.perf_counter() - t0:.2f}s.")
+    return manifest
+
+
+def main():
+    from src.utils import extract_config
+
+    parser = argparse.ArgumentParser(description="Export index artifacts (mmap) từ Chroma cho chế độ multi-worker.")
+    parser.add_argument("--config", type=str, default="configs/indexing_pipeline.yml")
+    parser.add_argument("--output", type=str, default=None, help="Mặc định: artifacts.directory trong config")
+    args = parser.parse_args()
+    export_from_chroma(extract_config(args.config), args.output)
+
+
+if __name__ == "__main__":
+    main()
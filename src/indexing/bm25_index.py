@@ -0,0 +1,160 @@
+import os
+import re
+import json
+import unicodedata
+from typing import List, Dict, Tuple, Callable
+
+import numpy as np
+from scipy import sparse
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def default_tokenize(text: str) -> List[str]:
+    """ Chuẩn hóa Unicode NFC, chữ thường, tách theo ký tự chữ/số. """
+    return TOKEN_PATTERN.findall(unicodedata.normalize("NFC", text).lower())
+
+
+class SparseBM25Index:
+    """
+    BM25 (Okapi) dạng ma trận thưa: trọng số BM25 của từng cặp (term, document) được
+    tính sẵn lúc build và lưu trong ma trận CSR term x document.
+
+    Chấm điểm một query = cộng các hàng (posting list) của các term trong query,
+    tức một phép nhân sparse (query x term) @ (term x document). Chỉ các document
+    chứa ít nhất một term của query bị chạm tới, nên chi phí phụ thuộc vào độ dài
+    posting list chứ không vào tổng số document. Top-k lấy bằng argpartition.
+    """
+    def __init__(
+        self,
+        term_doc: sparse.csr_matrix,
+        vocab: Dict[str, int],
+        num_docs: int,
+        k1: float = 1.5,
+        b: float = 0.75,
+        tokenizer: Callable[[str], List[str]] = default_tokenize,
+    ):
+        self.term_doc = term_doc
+        self.vocab = vocab
+        self.num_docs = num_docs
+        self.k1 = k1
+        self.b = b
+        self.tokenizer = tokenizer
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        k1: float = 1.5,
+        b: float = 0.75,
+        tokenizer: Callable[[str], List[str]] = default_tokenize,
+    ) -> 'SparseBM25Index':
+        vocab: Dict[str, int] = {}
+        rows: List[int] = []   # term id
+        cols: List[int] = []   # doc id
+        tfs: List[int] = []
+        doc_len = np.zeros(len(texts), dtype=np.float32)
+
+        for doc_id, text in enumerate(texts):
+            tokens = tokenizer(text)
+            doc_len[doc_id] = len(tokens)
+            counts: Dict[int, int] = {}
+            for tok in tokens:
+                term_id = vocab.setdefault(tok, len(vocab))
+                counts[term_id] = counts.get(term_id, 0) + 1
+            rows.extend(counts.keys())
+            cols.extend([doc_id] * len(counts))
+            tfs.extend(counts.values())
+
+        rows_arr = np.asarray(rows, dtype=np.int32)
+        cols_arr = np.asarray(cols, dtype=np.int32)
+        tf = np.asarray(tfs, dtype=np.float32)
+
+        # --- Trọng số BM25 tính sẵn cho mọi cặp (term, doc) ---
+        num_docs = len(texts)
+        avgdl = float(doc_len.mean()) if num_docs else 0.0
+        df = np.bincount(rows_arr, minlength=len(vocab)).astype(np.float32)
+        # IDF dạng Lucene: luôn dương, tránh phải xử lý idf âm như rank_bm25
+        idf = np.log1p((num_docs - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = k1 * (1.0 - b + b * doc_len[cols_arr] / max(avgdl, 1e-9))
+        weights = idf[rows_arr] * tf * (k1 + 1.0) / (tf + norm)
+
+        term_doc = sparse.csr_matrix(
+            (weights.astype(np.float32), (rows_arr, cols_arr)),
+            shape=(len(vocab), num_docs),
+        )
+        term_doc.sum_duplicates()
+        return cls(term_doc, vocab, num_docs, k1=k1, b=b, tokenizer=tokenizer)
+
+    def _query_matrix(self, queries: List[str]) -> sparse.csr_matrix:
+        """ Ma trận (query x term) đếm số lần xuất hiện của term trong query (bỏ qua term lạ). """
+        rows, cols = [], []
+        for qi, query in enumerate(queries):
+            for tok in self.tokenizer(query):
+                term_id = self.vocab.get(tok)
+                if term_id is not None:
+                    rows.append(qi)
+                    cols.append(term_id)
+        data = np.ones(len(rows), dtype=np.float32)
+        q = sparse.csr_matrix((data, (rows, cols)), shape=(len(queries), len(self.vocab)))
+        q.sum_duplicates()
+        return q
+
+    def search(self, query: str, k: int = 10) -> Tuple[np.ndarray, np.ndarray]:
+        """ Trả về (doc_ids, scores) của top-k, điểm giảm dần, chỉ gồm doc có điểm > 0. """
+        return self.search_batch([query], k)[0]
+
+    def search_batch(self, queries: List[str], k: int = 10) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """ Chấm điểm cả batch bằng một phép nhân sparse duy nhất. """
+        if not queries:
+            return []
+        scores = (self._query_matrix(queries) @ self.term_doc).tocsr()
+        results = []
+        for qi in range(len(queries)):
+            start, end = scores.indptr[qi], scores.indptr[qi + 1]
+            doc_ids = scores.indices[start:end]
+            row = scores.data[start:end]
+            if row.size > k:
+                top = np.argpartition(-row, k - 1)[:k]
+                doc_ids, row = doc_ids[top], row[top]
+            order = np.argsort(-row, kind="stable")
+            results.append((doc_ids[order], row[order]))
+        return results
+
+    def get_scores(self, query: str) -> np.ndarray:
+        """ Điểm BM25 dạng dense cho toàn bộ document (chủ yếu để kiểm tra/so sánh). """
+        return np.asarray((self._query_matrix([query]) @ self.term_doc).todense()).ravel()
+
+    def save(self, directory: str):
+        """ Lưu ma trận CSR thành các file .npy (có thể mmap) cùng vocab và tham số. """
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "data.npy"), self.term_doc.data.astype(np.float32, copy=False))
+        np.save(os.path.join(directory, "indices.npy"), self.term_doc.indices.astype(np.int32, copy=False))
+        np.save(os.path.join(directory, "indptr.npy"), self.term_doc.indptr.astype(np.int64, copy=False))
+        with open(os.path.join(directory, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(self.vocab, f, ensure_ascii=False)
+        with open(os.path.join(directory, "params.json"), "w", encoding="utf-8") as f:
+            json.dump({"num_docs": self.num_docs, "k1": self.k1, "b": self.b}, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> 'SparseBM25Index':
+        """
+        Nạp index đã lưu. Với mmap=True các mảng posting được ánh xạ bộ nhớ (read-only),
+        nên nhiều worker trên cùng máy dùng chung một bản trong page cache của hệ điều hành.
+        """
+        mode = "r" if mmap else None
+        data = np.load(os.path.join(directory, "data.npy"), mmap_mode=mode)
+        indices = np.load(os.path.join(directory, "indices.npy"), mmap_mode=mode)
+        indptr = np.load(os.path.join(directory, "indptr.npy"), mmap_mode=mode)
+        with open(os.path.join(directory, "vocab.json"), "r", encoding="utf-8") as f:
+            vocab = json.load(f)
+        with open(os.path.join(directory, "params.json"), "r", encoding="utf-8") as f:
+            params = json.load(f)
+        term_doc = sparse.csr_matrix(
+            (data, indices, indptr), shape=(len(vocab), params["num_docs"]), copy=False
+        )
+        return cls(term_doc, vocab, params["num_docs"], k1=params["k1"], b=params["b"])
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.term_doc.data.nbytes + self.term_doc.indices.nbytes + self.term_doc.indptr.nbytes)
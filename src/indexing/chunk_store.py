@@ -0,0 +1,192 @@
+"""
+Chunk store cục bộ (SQLite, đọc qua mmap) để mở rộng kết quả truy vấn về Điều luật đầy đủ.
+
+DocumentIndexer ghi mỗi chunk kèm `chunk_id`, `parent_id` (Điều chứa nó) và liên kết
+prev/next tới các chunk anh em. Sau khi xếp hạng, DatabaseRetriever tra cứu theo khóa
+chính (không cần thêm lượt vector search) để thay chunk 512 ký tự bằng cả Điều,
+hoặc bằng cửa sổ chunk lân cận nếu Điều quá dài, trong giới hạn ký tự cho phép.
+"""
+import os
+import sqlite3
+import hashlib
+import threading
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+from langchain_core.documents import Document
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS parents (
+    parent_id TEXT PRIMARY KEY,
+    source TEXT,
+    article TEXT,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_id TEXT PRIMARY KEY,
+    parent_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    prev_id TEXT,
+    next_id TEXT,
+    text TEXT NOT NULL
+);
+"""
+
+
+def make_id(*parts: Any) -> str:
+    """ ID ổn định (cùng văn bản, cùng vị trí -> cùng ID qua các lần index). """
+    return hashlib.sha1("|".join(str(p) for p in parts).encode("utf-8")).hexdigest()[:16]
+
+
+class ChunkStore:
+    """
+    Tra cứu chunk / Điều theo ID. Mỗi thread giữ một connection read-only riêng;
+    `PRAGMA mmap_size` cho phép SQLite đọc file qua mmap nên các worker dùng chung page cache.
+    """
+    def __init__(self, path: str, mmap_size: int = 256 * 1024 * 1024):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Không tìm thấy chunk store tại '{path}'. Chạy lại DocumentIndexer để tạo.")
+        self.path = path
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        # Mọi connection đã mở (của mọi thread) để close() đóng được hết, không chỉ của thread gọi nó
+        self._conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        print(f"-> ChunkStore ready ({path}, {self.count()} chunks).")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+            with self._conns_lock:
+                self._conns.append(conn)
+            self._local.conn = conn
+        return conn
+
+    def count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def get_chunk(self, chunk_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT chunk_id, parent_id, position, prev_id, next_id, text FROM chunks WHERE chunk_id = ?", (chunk_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("chunk_id", "parent_id", "position", "prev_id", "next_id", "text"), row))
+
+    def get_parent(self, parent_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(
+            "SELECT parent_id, source, article, text FROM parents WHERE parent_id = ?", (parent_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("parent_id", "source", "article", "text"), row))
+
+    def expand(self, documents: List[Document], max_chars_per_doc: int = 4000, max_total_chars: int = 12000) -> List[Document]:
+        """
+        Mở rộng từng hit (theo thứ tự xếp hạng) về Điều chứa nó nếu Điều không vượt max_chars_per_doc;
+        nếu vượt, ghép thêm các chunk kề trước/sau cho tới hết ngân sách. Nhiều hit cùng một Điều
+        chỉ giữ lại hit đầu tiên. Tổng độ dài không vượt max_total_chars (hit không mở rộng được giữ nguyên).
+        """
+        expanded: List[Document] = []
+        seen_parents = set()
+        total = 0
+        for doc in documents:
+            chunk_id = doc.metadata.get("chunk_id")
+            chunk = self.get_chunk(chunk_id) if chunk_id else None
+            if chunk is None:
+                expanded.append(doc)
+                total += len(doc.page_content)
+                continue
+            if chunk["parent_id"] in seen_parents:
+                continue
+            seen_parents.add(chunk["parent_id"])
+
+            budget = min(max_chars_per_doc, max(max_total_chars - total, len(doc.page_content)))
+            parent = self.get_parent(chunk["parent_id"])
+            if parent is not None and len(parent["text"]) <= budget:
+                text, mode = parent["text"], "parent"
+            else:
+                text, mode = self._window(chunk, budget), "siblings"
+
+            metadata = dict(doc.metadata)
+            metadata["expanded"] = mode
+            if parent is not None and parent.get("article"):
+                metadata.setdefault("article", parent["article"])
+            expanded.append(Document(page_content=text, metadata=metadata))
+            total += len(text)
+        return expanded
+
+    def _window(self, chunk: Dict[str, Any], budget: int) -> str:
+        """ Ghép xen kẽ chunk sau rồi chunk trước quanh hit cho tới khi hết ngân sách ký tự. """
+        parts = [chunk["text"]]
+        size = len(chunk["text"])
+        prev_id, next_id = chunk["prev_id"], chunk["next_id"]
+        while prev_id or next_id:
+            progressed = False
+            for direction in ("next", "prev"):
+                neighbour_id = next_id if direction == "next" else prev_id
+                if not neighbour_id:
+                    continue
+                neighbour = self.get_chunk(neighbour_id)
+                if neighbour is None or size + len(neighbour["text"]) + 1 > budget:
+                    if direction == "next":
+                        next_id = None
+                    else:
+                        prev_id = None
+                    continue
+                size += len(neighbour["text"]) + 1
+                progressed = True
+                if direction == "next":
+                    parts.append(neighbour["text"])
+                    next_id = neighbour["next_id"]
+                else:
+                    parts.insert(0, neighbour["text"])
+                    prev_id = neighbour["prev_id"]
+            if not progressed:
+                break
+        return "\n".join(parts)
+
+    def close(self):
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+            # threading.local mới: thread nào dùng lại store sẽ mở connection mới thay vì dùng bản đã đóng
+            self._local = threading.local()
+        for conn in conns:
+            conn.close()
+
+
+class ChunkStoreWriter:
+    """ Ghi chunk store lúc index (ghi ra file tạm rồi đổi tên, để bản đang phục vụ không bị đọc dở). """
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+        self._db = sqlite3.connect(self.tmp_path)
+        self._db.executescript(SCHEMA)
+
+    def add_parent(self, parent_id: str, source: str, article: str, text: str):
+        self._db.execute(
+            "INSERT OR REPLACE INTO parents (parent_id, source, article, text) VALUES (?, ?, ?, ?)",
+            (parent_id, source, article, text),
+        )
+
+    def add_chunks(self, parent_id: str, chunks: Iterable[Tuple[str, str]]):
+        """ chunks: [(chunk_id, text)] theo đúng thứ tự trong Điều; liên kết prev/next được tạo tự động. """
+        chunks = list(chunks)
+        rows = []
+        for pos, (chunk_id, text) in enumerate(chunks):
+            prev_id = chunks[pos - 1][0] if pos > 0 else None
+            next_id = chunks[pos + 1][0] if pos + 1 < len(chunks) else None
+            rows.append((chunk_id, parent_id, pos, prev_id, next_id, text))
+        self._db.executemany(
+            "INSERT OR REPLACE INTO chunks (chunk_id, parent_id, position, prev_id, next_id, text) VALUES (?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+
+    def commit(self):
+        self._db.commit()
+        self._db.close()
+        os.replace(self.tmp_path, self.path)
@@ -0,0 +1,101 @@
+"""
+Bảng chunk dạng cột trong bộ nhớ, thay cho danh sách LangChain `Document` (mỗi chunk một object
++ một dict metadata riêng, vài trăm byte overhead Python mỗi chunk):
+
+- text      : toàn bộ page_content nối liền trong MỘT buffer UTF-8 + offsets int64
+- metadata  : mỗi khóa là một cột mã int32 trỏ vào bảng giá trị đã loại trùng của khóa đó
+              (các chunk cùng văn bản dùng chung source/link/title..., nên bảng giá trị rất nhỏ)
+
+`Document` chỉ được tạo khi truy cập từng phần tử (kết quả BM25 / tra cứu / top-k cuối cùng).
+Cùng giao diện Sequence[Document] với `MmapDocumentList` (src/indexing/artifacts.py).
+"""
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+MISSING = -1
+
+
+class ChunkTable(Sequence):
+    def __init__(self, text: bytes, offsets: np.ndarray, codes: Dict[str, np.ndarray], values: Dict[str, List[Any]]):
+        self.text = text
+        self.offsets = offsets
+        self.codes = codes    # khóa -> mã int32 (N,), MISSING nếu chunk không có khóa đó
+        self.values = values  # khóa -> bảng giá trị duy nhất
+
+    @classmethod
+    def from_records(cls, texts: Iterable[str], metadatas: Iterable[Optional[Dict[str, Any]]]) -> 'ChunkTable':
+        encoded = [t.encode("utf-8") for t in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        text = b"".join(encoded)
+        del encoded
+
+        n = len(offsets) - 1
+        codes: Dict[str, np.ndarray] = {}
+        values: Dict[str, List[Any]] = {}
+        lookup: Dict[str, Dict[Any, int]] = {}
+        for i, meta in enumerate(metadatas):
+            for key, value in (meta or {}).items():
+                column = codes.get(key)
+                if column is None:
+                    column = codes[key] = np.full(n, MISSING, dtype=np.int32)
+                    values[key], lookup[key] = [], {}
+                code = lookup[key].get(value)
+                if code is None:
+                    code = lookup[key][value] = len(values[key])
+                    values[key].append(value)
+                column[i] = code
+        return cls(text, offsets, codes, values)
+
+    @classmethod
+    def from_documents(cls, documents: Iterable[Document]) -> 'ChunkTable':
+        documents = list(documents)
+        return cls.from_records((d.page_content for d in documents), (d.metadata for d in documents))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def text_at(self, i: int) -> str:
+        return self.text[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def metadata_at(self, i: int) -> Dict[str, Any]:
+        return {key: self.values[key][code] for key, column in self.codes.items() if (code := column[i]) != MISSING}
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        return Document(page_content=self.text_at(i), metadata=self.metadata_at(i))
+
+    def column(self, key: str) -> List[Any]:
+        """ Giá trị của một khóa metadata cho mọi chunk (None nếu thiếu), không tạo Document. """
+        column = self.codes.get(key)
+        if column is None:
+            return [None] * len(self)
+        table = self.values[key]
+        return [table[code] if code != MISSING else None for code in column.tolist()]
+
+    def texts(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self.text_at(i)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.text) + self.offsets.nbytes + sum(column.nbytes for column in self.codes.values())
+
+
+def metadata_column(documents: Sequence[Document], key: str) -> List[Any]:
+    """ Cột metadata của ChunkTable / MmapDocumentList / list[Document] mà không tạo Document nếu tránh được. """
+    if hasattr(documents, "column"):
+        return documents.column(key)
+    return [doc.metadata.get(key) for doc in documents]
+
+
+def page_contents(documents: Sequence[Document]) -> Iterable[str]:
+    if hasattr(documents, "texts"):
+        return documents.texts()
+    return (doc.page_content for doc in documents)
@@ -0,0 +1,319 @@
+"""
+Chuẩn hóa trích dẫn văn bản pháp luật và bảng tra cứu chính xác (trích dẫn -> chunk).
+
+Các cách viết "Nghị định 109/2016/NĐ-CP", "nghị định số 109", "nd 109", "109/2016/NĐ-CP"
+đều được đưa về cùng một khóa chuẩn `loại|số|năm` (vd: "nghị định|109|2016"),
+kèm khóa không có năm ("nghị định|109|") cho câu hỏi không ghi năm.
+Văn bản được gọi theo tên (vd: "Luật Khám bệnh, chữa bệnh 2023") có khóa `loại|tên|năm`.
+
+Ngoài bảng theo văn bản còn có bảng theo Điều (`<khóa văn bản>#22`), để câu hỏi như
+"Điều 22 Nghị định 109/2016" trỏ thẳng tới các chunk của Điều đó.
+
+Bảng được DocumentIndexer build lúc index từ metadata `source` / `article` của từng chunk và lưu JSON.
+"""
+import os
+import re
+import json
+import unicodedata
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Iterable, Tuple
+
+from langchain_core.documents import Document
+
+# Loại văn bản chuẩn -> các cách viết tắt thường gặp (đã chữ thường). Thứ tự: dài trước ngắn.
+DOC_TYPE_ALIASES: Dict[str, Tuple[str, ...]] = {
+    "thông tư liên tịch": ("thông tư liên tịch", "ttlt"),
+    "nghị định": ("nghị định", "nđ", "nd"),
+    "nghị quyết": ("nghị quyết", "nq"),
+    "quyết định": ("quyết định", "qđ", "qd"),
+    "thông tư": ("thông tư", "tt"),
+    "chỉ thị": ("chỉ thị", "ct"),
+    "pháp lệnh": ("pháp lệnh", "pl"),
+    "luật": ("luật",),
+    "công văn": ("công văn", "cv"),
+}
+# Ký hiệu sau số hiệu (vd: NĐ-CP, TT-BYT) cũng cho biết loại văn bản
+CODE_TYPES = (("TTLT", "thông tư liên tịch"), ("NĐ", "nghị định"), ("ND", "nghị định"), ("NQ", "nghị quyết"),
+              ("QĐ", "quyết định"), ("QD", "quyết định"), ("TT", "thông tư"), ("CT", "chỉ thị"), ("PL", "pháp lệnh"))
+
+
+def strip_diacritics(text: str) -> str:
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    return text.replace("đ", "d").replace("Đ", "D")
+
+
+# Nhận cả cách gõ không dấu ("nghi dinh 109", "thong tu 39")
+_ALIAS_TO_TYPE = {
+    variant: doc_type
+    for doc_type, aliases in DOC_TYPE_ALIASES.items()
+    for alias in aliases
+    for variant in (alias, strip_diacritics(alias))
+}
+_ALIAS_PATTERN = "|".join(sorted((re.escape(a) for a in _ALIAS_TO_TYPE), key=len, reverse=True))
+
+# "<loại> [số[:]] 109[ /2016][ /NĐ-CP]"
+TYPED_REF = re.compile(
+    rf"(?<!\w)({_ALIAS_PATTERN})\s*(?:s[ốo]\s*:?\s*)?(\d{{1,5}})(?:\s*/\s*(\d{{4}}))?(?:\s*/\s*([a-zđ0-9\-]+))?(?!\w)",
+    re.IGNORECASE,
+)
+# "109/2016/NĐ-CP" không kèm tên loại
+CODE_REF = re.compile(r"(?<!\w)(\d{1,5})\s*/\s*(\d{4})\s*/\s*([a-zđ][a-zđ0-9\-]*)", re.IGNORECASE)
+# "(2000)" trong tên văn bản cũ, vd: "Chỉ thị 08/CT-UB (2000)"
+_YEAR_IN_PARENS = re.compile(r"\((\d{4})\)")
+# "Điều 22", "dieu 22a"
+ARTICLE_REF = re.compile(r"(?<!\w)(?:điều|dieu)\s+(\d{1,4}[a-zđ]?)(?!\w)", re.IGNORECASE)
+# Văn bản gọi theo tên: "Luật Khám bệnh, chữa bệnh 2023", "Bộ luật Dân sự năm 2015"
+NAMED_TYPES = ("bộ luật", "luật", "pháp lệnh")
+NAMED_SOURCE = re.compile(
+    r"^\s*(bộ luật|luật|pháp lệnh)\s+([^\d/]+?)(?:\s+(?:năm\s+)?(\d{4}))?\s*$", re.IGNORECASE
+)
+_WORD = re.compile(r"\w+", re.UNICODE)
+# Năm ngay sau tên luật trong câu hỏi: "luật ... 2023", "luật ... năm 2023"
+_YEAR_AFTER = re.compile(r"\s+(?:nam\s+)?(\d{4})(?!\w)")
+
+
+@dataclass(frozen=True)
+class DocRef:
+    doc_type: str
+    number: int
+    year: Optional[int] = None
+    span: Tuple[int, int] = (0, 0)  # Vị trí trong chuỗi nguồn (để tách phần còn lại của câu hỏi)
+
+    @property
+    def key(self) -> str:
+        return doc_key(self.doc_type, self.number, self.year)
+
+
+@dataclass(frozen=True)
+class Citation:
+    """ Một trích dẫn trong câu hỏi: văn bản (các khóa tương đương) và Điều (nếu có). """
+    doc_keys: Tuple[str, ...]
+    article: Optional[str] = None
+    spans: Tuple[Tuple[int, int], ...] = ()
+
+
+def doc_key(doc_type: str, number: int, year: Optional[int] = None) -> str:
+    return f"{doc_type}|{int(number)}|{year or ''}"
+
+
+def name_key(doc_type: str, name: str, year: Optional[int] = None) -> str:
+    return f"{doc_type}|{name}|{year or ''}"
+
+
+def article_key(key: str, article: str) -> str:
+    return f"{key}#{article}"
+
+
+def normalize_name(name: str) -> str:
+    """ "Khám bệnh, chữa bệnh" -> "kham benh chua benh" (so khớp không phân biệt dấu / dấu câu). """
+    return " ".join(_WORD.findall(strip_diacritics(unicodedata.normalize("NFC", name)).lower()))
+
+
+def normalize_article(article: str) -> Optional[str]:
+    """ Số Điều từ metadata `article` hoặc đầu chunk ("Điều 22." -> "22"); None nếu không có. """
+    m = ARTICLE_REF.match(unicodedata.normalize("NFC", article or "").strip())
+    return m.group(1).lower() if m else None
+
+
+def _type_from_code(code: Optional[str]) -> Optional[str]:
+    if not code:
+        return None
+    code = code.upper()
+    for prefix, doc_type in CODE_TYPES:
+        if code.startswith(prefix):
+            return doc_type
+    return None
+
+
+def find_doc_refs(text: str) -> List[DocRef]:
+    """ Tìm các số hiệu văn bản trong câu (đã/không dấu, viết tắt). """
+    text = unicodedata.normalize("NFC", text)
+    refs: List[DocRef] = []
+    taken: List[Tuple[int, int]] = []
+    for m in TYPED_REF.finditer(text):
+        doc_type = _ALIAS_TO_TYPE.get(m.group(1).lower()) or _ALIAS_TO_TYPE[strip_diacritics(m.group(1).lower())]
+        # "Thông tư 39/2011/TTLT-..." -> ký hiệu chính xác hơn tên loại
+        doc_type = _type_from_code(m.group(4)) or doc_type
+        refs.append(DocRef(doc_type, int(m.group(2)), int(m.group(3)) if m.group(3) else None, m.span()))
+        taken.append(m.span())
+    for m in CODE_REF.finditer(text):
+        if any(s <= m.start() < e for s, e in taken):
+            continue
+        doc_type = _type_from_code(m.group(3))
+        if doc_type:
+            refs.append(DocRef(doc_type, int(m.group(1)), int(m.group(2)), m.span()))
+    return sorted(refs, key=lambda r: r.span)
+
+
+def parse_source(source: str) -> Optional[DocRef]:
+    """ Số hiệu của một văn bản từ metadata `source` (vd: 'Thông tư liên tịch 39/2011/TTLT-BYT-BTC'). """
+    refs = find_doc_refs(source or "")
+    if not refs:
+        return None
+    ref = refs[0]
+    if ref.year is None:
+        year = _YEAR_IN_PARENS.search(source)
+        if year:
+            ref = DocRef(ref.doc_type, ref.number, int(year.group(1)), ref.span)
+    return ref
+
+
+def find_article_refs(text: str) -> List[Tuple[str, Tuple[int, int]]]:
+    """ Các "Điều N" trong câu: [(số Điều, span)]. """
+    return [(m.group(1).lower(), m.span()) for m in ARTICLE_REF.finditer(unicodedata.normalize("NFC", text))]
+
+
+def parse_named_source(source: str) -> Optional[Tuple[str, str, Optional[int]]]:
+    """ (loại, tên đã chuẩn hóa, năm) của văn bản gọi theo tên, vd: 'Luật Khám bệnh, chữa bệnh 2023'. """
+    m = NAMED_SOURCE.match(unicodedata.normalize("NFC", source or ""))
+    if not m:
+        return None
+    name = normalize_name(m.group(2))
+    if not name:
+        return None
+    return m.group(1).lower(), name, int(m.group(3)) if m.group(3) else None
+
+
+def chunk_key(doc: Document, position: int) -> str:
+    """ Khóa của chunk trong bảng tra cứu: chunk_id, hoặc vị trí nếu index cũ chưa có chunk_id. """
+    return doc.metadata.get("chunk_id") or f"#{position}"
+
+
+class CitationIndex:
+    """
+    Inverted index trích dẫn -> danh sách chunk (theo thứ tự xuất hiện trong văn bản):
+    - doc_index    : khóa văn bản (`loại|số|năm`, `loại|số|`, `loại|tên|năm`, `loại|tên|`) -> chunk
+    - article_index: `<khóa văn bản>#<số Điều>` -> chunk của Điều đó
+    - name_index   : "loai ten" không dấu (vd: "luat kham benh chua benh") -> khóa văn bản
+    """
+    def __init__(
+        self,
+        doc_index: Optional[Dict[str, List[str]]] = None,
+        article_index: Optional[Dict[str, List[str]]] = None,
+        name_index: Optional[Dict[str, List[str]]] = None,
+    ):
+        self.doc_index: Dict[str, List[str]] = doc_index or {}
+        self.article_index: Dict[str, List[str]] = article_index or {}
+        self.name_index: Dict[str, List[str]] = name_index or {}
+        self._name_pattern: Optional[re.Pattern] = None
+
+    @classmethod
+    def build(cls, documents: Iterable[Document]) -> 'CitationIndex':
+        index = cls()
+        for position, doc in enumerate(documents):
+            source = doc.metadata.get("source", "")
+            keys = index._source_keys(source)
+            if not keys:
+                continue
+            key = chunk_key(doc, position)
+            # Index cũ chưa có metadata `article`: lấy "Điều N" ở đầu chunk (nếu có)
+            article = normalize_article(doc.metadata.get("article") or doc.page_content[:20])
+            for k in keys:
+                index.doc_index.setdefault(k, []).append(key)
+                if article:
+                    index.article_index.setdefault(article_key(k, article), []).append(key)
+        return index
+
+    def _source_keys(self, source: str) -> Tuple[str, ...]:
+        ref = parse_source(source)
+        if ref is not None:
+            return tuple(dict.fromkeys((ref.key, doc_key(ref.doc_type, ref.number))))
+        named = parse_named_source(source)
+        if named is None:
+            return ()
+        doc_type, name, year = named
+        keys = tuple(dict.fromkeys((name_key(doc_type, name, year), name_key(doc_type, name))))
+        phrase = f"{normalize_name(doc_type)} {name}"
+        entries = self.name_index.setdefault(phrase, [])
+        if keys[-1] not in entries:
+            entries.append(keys[-1])
+        return keys
+
+    def lookup(self, ref: DocRef) -> List[str]:
+        return self.doc_index.get(ref.key, [])
+
+    def lookup_citation(self, citation: Citation) -> List[str]:
+        """ Chunk của Điều được trích dẫn (khóa đầu tiên có kết quả), hoặc cả văn bản nếu không nêu Điều. """
+        for key in citation.doc_keys:
+            if citation.article is not None:
+                chunks = self.article_index.get(article_key(key, citation.article))
+            else:
+                chunks = self.doc_index.get(key)
+            if chunks:
+                return chunks
+        return []
+
+    def find_citations(self, text: str) -> List[Citation]:
+        """
+        Tìm trích dẫn trong câu: số hiệu văn bản, tên luật đã biết, và "Điều N" gắn với văn bản
+        đứng ngay sau ("Điều 22 Luật ...") hoặc, nếu không có, văn bản gần nhất đứng trước
+        ("Nghị định 109/2016, Điều 5"). "Điều N" không kèm văn bản nào thì bỏ qua.
+        """
+        text = unicodedata.normalize("NFC", text)
+        docs: List[Tuple[Tuple[int, int], Tuple[str, ...]]] = [
+            (ref.span, (ref.key,)) for ref in find_doc_refs(text)
+        ]
+        docs.extend(self._find_named(text))
+        docs.sort(key=lambda d: d[0])
+        if not docs:
+            return []
+
+        citations: List[Citation] = []
+        cited_docs = set()
+        for article, span in find_article_refs(text):
+            after = [i for i, (s, _) in enumerate(docs) if s[0] >= span[1]]
+            before = [i for i, (s, _) in enumerate(docs) if s[1] <= span[0]]
+            target = after[0] if after else (before[-1] if before else None)
+            if target is None:
+                continue
+            cited_docs.add(target)
+            citations.append(Citation(docs[target][1], article, (span, docs[target][0])))
+        for i, (doc_span, keys) in enumerate(docs):
+            if i not in cited_docs:
+                citations.append(Citation(keys, None, (doc_span,)))
+        return sorted(citations, key=lambda c: min(c.spans))
+
+    def _find_named(self, text: str) -> List[Tuple[Tuple[int, int], Tuple[str, ...]]]:
+        if not self.name_index:
+            return []
+        if self._name_pattern is None:
+            # Một regex cho tất cả tên (dài trước), khớp trên chuỗi không dấu, bỏ qua dấu câu giữa các từ
+            phrases = sorted(self.name_index, key=len, reverse=True)
+            alternatives = "|".join(r"\W+".join(map(re.escape, p.split(" "))) for p in phrases)
+            self._name_pattern = re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)")
+        probe = strip_diacritics(text).lower()
+        if len(probe) != len(text):  # span trên chuỗi không dấu phải trùng với chuỗi gốc
+            return []
+        found = []
+        for m in self._name_pattern.finditer(probe):
+            keys = self.name_index.get(normalize_name(m.group(0)), [])
+            year = _YEAR_AFTER.match(probe, m.end())
+            if year:
+                keys = [k[: -1] + year.group(1) if k.endswith("|") else k for k in keys] + keys
+                found.append(((m.start(), year.end()), tuple(keys)))
+            else:
+                found.append((m.span(), tuple(keys)))
+        return found
+
+    def __len__(self) -> int:
+        return len(self.doc_index)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"documents": self.doc_index, "articles": self.article_index, "names": self.name_index},
+                f,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> 'CitationIndex':
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(
+            doc_index=data.get("documents", {}),
+            article_index=data.get("articles", {}),
+            name_index=data.get("names", {}),
+        )
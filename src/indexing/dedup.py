@@ -0,0 +1,158 @@
+"""
+Loại chunk trùng lặp lúc index.
+
+Mỗi file keyword (`metadata_law_khám_chữa_bệnh.json`, `metadata_law_bảo_hiểm_y_tế.json`, ...)
+cào lại nhiều văn bản giống nhau, nên cùng một Điều bị embed và lưu nhiều lần.
+
+- Trùng tuyệt đối: băm nội dung đã chuẩn hóa (NFC, chữ thường, gộp khoảng trắng).
+- Gần trùng: MinHash trên shingle từ + LSH theo band, xác nhận bằng độ tương đồng
+  Jaccard ước lượng >= threshold (vd: cùng Điều nhưng khác dấu câu / bản cào lệch vài chữ).
+
+Chunk giữ lại ghi nhận toàn bộ keyword, link và tên văn bản của các bản bị gộp
+(dạng chuỗi nối bằng MULTI_VALUE_SEP vì metadata của Chroma chỉ nhận giá trị vô hướng).
+"""
+import re
+import zlib
+import hashlib
+import unicodedata
+from typing import List, Dict, Any, Tuple, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+MULTI_VALUE_SEP = " | "
+MERGED_FIELDS = (("keywords", "keywords"), ("link", "links"), ("source", "sources"))
+_PRIME = (1 << 31) - 1
+_WS = re.compile(r"\s+")
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def normalize_text(text: str) -> str:
+    return _WS.sub(" ", unicodedata.normalize("NFC", text).lower()).strip()
+
+
+def split_multi(value: Optional[str]) -> List[str]:
+    """ Tách lại giá trị nhiều phần tử đã được nối (keywords/links/sources). """
+    return [v for v in (value or "").split(MULTI_VALUE_SEP) if v]
+
+
+class ChunkDeduplicator:
+    def __init__(
+        self,
+        near_duplicate: bool = True,
+        threshold: float = 0.9,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 3,
+        min_words: int = 8,
+        seed: int = 221,
+    ):
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm ({num_perm}) phải chia hết cho bands ({bands}).")
+        self.near_duplicate = near_duplicate
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.min_words = min_words
+        rng = np.random.default_rng(seed)
+        # Họ hàm băm (a*x + b) mod p, a != 0
+        self._a = rng.integers(1, _PRIME, size=num_perm, dtype=np.int64)
+        self._b = rng.integers(0, _PRIME, size=num_perm, dtype=np.int64)
+
+    @classmethod
+    def from_config(cls, dedup_cfg: Dict[str, Any]) -> 'ChunkDeduplicator':
+        return cls(
+            near_duplicate=dedup_cfg.get('near_duplicate', True),
+            threshold=dedup_cfg.get('threshold', 0.9),
+            num_perm=dedup_cfg.get('num_perm', 64),
+            bands=dedup_cfg.get('bands', 16),
+            shingle_size=dedup_cfg.get('shingle_size', 3),
+            min_words=dedup_cfg.get('min_words', 8),
+        )
+
+    def _signature(self, words: List[str]) -> np.ndarray:
+        n = self.shingle_size
+        shingles = {" ".join(words[i : i + n]) for i in range(max(1, len(words) - n + 1))}
+        x = np.fromiter((zlib.crc32(s.encode("utf-8")) % _PRIME for s in shingles), dtype=np.int64, count=len(shingles))
+        # (num_perm, num_shingles) -> min theo từng hàm băm
+        return ((self._a[:, None] * x[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def deduplicate(self, documents: List[Document]) -> Tuple[List[Document], Dict[str, int]]:
+        """ Trả về (chunk giữ lại theo thứ tự gốc, thống kê). Metadata của chunk giữ lại được gộp. """
+        survivors: List[Document] = []
+        merged: List[Dict[str, List[str]]] = []
+        dup_counts: List[int] = []
+        exact_index: Dict[str, int] = {}
+        id_index: Dict[str, int] = {}
+        signatures: List[Optional[np.ndarray]] = []
+        buckets: Dict[Tuple[int, bytes], List[int]] = {}
+        stats = {"input": len(documents), "exact": 0, "near": 0}
+
+        for doc in documents:
+            normalized = normalize_text(doc.page_content)
+            digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+            target = exact_index.get(digest)
+            if target is None and doc.metadata.get("chunk_id") in id_index:
+                target = id_index[doc.metadata["chunk_id"]]
+            if target is not None:
+                stats["exact"] += 1
+                dup_counts[target] += 1
+                self._merge(merged[target], doc.metadata)
+                continue
+
+            signature = None
+            words = _WORD.findall(normalized)
+            if self.near_duplicate and len(words) >= self.min_words:
+                signature = self._signature(words)
+                target = self._find_near(signature, signatures, buckets)
+                if target is not None:
+                    stats["near"] += 1
+                    dup_counts[target] += 1
+                    self._merge(merged[target], doc.metadata)
+                    continue
+
+            idx = len(survivors)
+            survivors.append(doc)
+            merged.append({field: [] for field, _ in MERGED_FIELDS})
+            dup_counts.append(0)
+            self._merge(merged[idx], doc.metadata)
+            exact_index[digest] = idx
+            if doc.metadata.get("chunk_id"):
+                id_index[doc.metadata["chunk_id"]] = idx
+            signatures.append(signature)
+            if signature is not None:
+                for key in self._band_keys(signature):
+                    buckets.setdefault(key, []).append(idx)
+
+        for doc, values, count in zip(survivors, merged, dup_counts):
+            # Bản sao metadata: các chunk cùng văn bản từng dùng chung một dict
+            doc.metadata = dict(doc.metadata)
+            for field, plural in MERGED_FIELDS:
+                doc.metadata[plural] = MULTI_VALUE_SEP.join(values[field])
+            doc.metadata["duplicates"] = count
+        stats["output"] = len(survivors)
+        return survivors, stats
+
+    def _band_keys(self, signature: np.ndarray):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows : (band + 1) * self.rows].tobytes()
+
+    def _find_near(self, signature: np.ndarray, signatures: List[Optional[np.ndarray]], buckets) -> Optional[int]:
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(buckets.get(key, ()))
+        best, best_sim = None, self.threshold
+        for idx in sorted(candidates):
+            sim = float(np.mean(signatures[idx] == signature))
+            if sim >= best_sim:
+                best, best_sim = idx, sim
+        return best
+
+    @staticmethod
+    def _merge(values: Dict[str, List[str]], metadata: Dict[str, Any]):
+        for field, _ in MERGED_FIELDS:
+            for item in split_multi(metadata.get(field)):
+                if item not in values[field]:
+                    values[field].append(item)
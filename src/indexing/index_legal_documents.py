@@ -1,11 +1,21 @@
 import json
 import re
 import os 
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 from langchain_core.documents import Document
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+from sentence_transformers import SentenceTransformer
+
+from src.agents.inference_backend import model_kwargs_for
+from src.indexing.chunk_store import ChunkStoreWriter, make_id
+from src.indexing.dedup import ChunkDeduplicator
+from src.agents.query_preprocessor import build_query_tables
+
+ARTICLE_PATTERN = re.compile(r"Điều \d+[a-zđ]?")
+# Link chi tiết chứa cả "&Keyword=..." của lần cào, chỉ ItemID là ổn định giữa các file keyword
+ITEM_ID_PATTERN = re.compile(r"ItemID=(\d+)", re.IGNORECASE)
 
 
 class DocumentIndexer:
@@ -19,9 +29,11 @@ class DocumentIndexer:
         emb_cfg = self.cfg['embedding']
         print(f"-> Init Embedding: {emb_cfg['model_name']} on device: {emb_cfg['device']}")
 
+        # backend torch | onnx | onnx_int8, tự chuyển về CPU nếu không có CUDA
+        model_path, model_kwargs = model_kwargs_for(emb_cfg, SentenceTransformer)
         self.embedding_model = HuggingFaceEmbeddings(
-            model_name=emb_cfg['model_name'],
-            model_kwargs={'device': emb_cfg.get('device', 'cpu')}, 
+            model_name=model_path,
+            model_kwargs=model_kwargs, 
             encode_kwargs={'normalize_embeddings': True, 'batch_size': 64} 
         )
         
@@ -33,6 +45,8 @@ class DocumentIndexer:
         )
 
         self.batch_size = 5000 
+        # parent_id -> (source, article, full text của Điều), được ghi vào chunk store sau khi cắt
+        self.parents: Dict[str, Tuple[str, str, str]] = {}
 
     def _load_and_split_json(self, json_path: str) -> List[Document]:
         """
@@ -68,23 +82,30 @@ class DocumentIndexer:
 
             pattern = r"(?=\nĐiều \d+)" 
             raw_chunks = re.split(pattern, full_text)
+            doc_key = self._document_key(base_metadata)
 
-            for chunk_text in raw_chunks:
+            for article_idx, chunk_text in enumerate(raw_chunks):
                 chunk_text = chunk_text.strip()
                 if not chunk_text or len(chunk_text) < 10: continue
-                
+
+                # Điều luật là "parent"; các chunk con trỏ về nó qua parent_id (dùng cho chunk store)
+                article_match = ARTICLE_PATTERN.match(chunk_text)
+                article = article_match.group(0) if article_match else "Phần mở đầu"
+                parent_id = make_id(doc_key, article_idx)
+                self.parents[parent_id] = (base_metadata["source"], article, chunk_text)
+
                 if len(chunk_text) > self.sub_splitter.chunk_size:
-                    sub_docs = self.sub_splitter.create_documents(
-                        [chunk_text], 
-                        metadatas=[base_metadata]
-                    )
-                    final_docs.extend(sub_docs)
+                    pieces = self.sub_splitter.split_text(chunk_text)
                 else:
-                    doc = Document(
-                        page_content=chunk_text,
-                        metadata=base_metadata
-                    )
-                    final_docs.append(doc)
+                    pieces = [chunk_text]
+                for sub_idx, piece in enumerate(pieces):
+                    metadata = dict(base_metadata)
+                    metadata.update({
+                        "chunk_id": make_id(doc_key, article_idx, sub_idx),
+                        "parent_id": parent_id,
+                        "article": article,
+                    })
+                    final_docs.append(Document(page_content=piece, metadata=metadata))
 
         print(f"-> Xử lý xong {len(data)} văn bản gốc. Tạo ra {len(final_docs)} chunks (Điều luật).")
 
@@ -108,11 +129,34 @@ class DocumentIndexer:
 
             json_file = f"{base_pre_path}{keyword}.json"
             docs = self._load_and_split_json(json_file)
+            for doc in docs:
+                doc.metadata["keywords"] = _keyword
             all_documents.extend(docs)
 
         if not all_documents:
             print("Warning: There are no documents for processing!")
-            return
+            return 0
+
+        dedup_cfg = self.cfg.get('dedup', {})
+        if dedup_cfg.get('enabled', True):
+            print("--- [PHASE] DEDUPLICATION ---")
+            all_documents, stats = ChunkDeduplicator.from_config(dedup_cfg).deduplicate(all_documents)
+            print(
+                f"-> {stats['input']} chunks -> {stats['output']} chunks "
+                f"(bỏ {stats['exact']} trùng tuyệt đối, {stats['near']} gần trùng)."
+            )
+        else:
+            # Cùng ItemID được cào dưới nhiều keyword -> trùng chunk_id; Chroma `add` từ chối ID trùng
+            # trong cùng batch nên vẫn giữ bản đầu tiên của mỗi chunk_id khi tắt dedup
+            unique: Dict[str, Document] = {}
+            for doc in all_documents:
+                unique.setdefault(doc.metadata["chunk_id"], doc)
+            if len(unique) < len(all_documents):
+                print(f"-> Bỏ {len(all_documents) - len(unique)} chunks trùng chunk_id (dedup đang tắt).")
+            all_documents = list(unique.values())
+
+        self._write_chunk_store(all_documents)
+        self._write_query_tables(all_documents)
 
         total_docs = len(all_documents)
         print(f"\n--- EMBEDDING AND DATABASE LOADING")
@@ -129,6 +173,37 @@ class DocumentIndexer:
         for i in range(0, total_docs, batch_size):
             batch = all_documents[i : i + batch_size]
             print(f"   -> Processing batch {i} to {min(i + batch_size, total_docs)}...")
-            vector_db.add_documents(documents=batch)
+            # chunk_id làm ID trong Chroma: index lại cùng dữ liệu không sinh bản ghi trùng
+            vector_db.add_documents(documents=batch, ids=[doc.metadata["chunk_id"] for doc in batch])
+
+        print("-> Loading data to Database completed!")
+        return total_docs
+
+    @staticmethod
+    def _document_key(base_metadata: Dict[str, Any]) -> str:
+        match = ITEM_ID_PATTERN.search(base_metadata["link"] or "")
+        return match.group(1) if match else (base_metadata["link"] or base_metadata["source"])
+
+    def _write_query_tables(self, documents: List[Document]):
+        """ Bảng tra cứu trích dẫn (văn bản / Điều -> chunk) + bảng khôi phục dấu cho QueryPreprocessor. """
+        citation_index, restorer = build_query_tables(documents, self.cfg.get('query_preprocessing', {}))
+        print(
+            f"-> Query tables: {len(citation_index)} khóa văn bản, {len(citation_index.article_index)} khóa Điều, "
+            f"{len(restorer.unigrams)} từ / {len(restorer.bigrams)} cặp từ khôi phục dấu."
+        )
 
-        print("-> Loading data to Database completed!")
\ No newline at end of file
+    def _write_chunk_store(self, documents: List[Document]):
+        """ Ghi chunk store (chunk + Điều cha + liên kết prev/next) cho bước mở rộng lúc truy vấn. """
+        store_path = self.cfg.get('chunk_store', {}).get('path', "./data/legal_documents/chunk_store.sqlite")
+        by_parent: Dict[str, List[Tuple[str, str]]] = {}
+        for doc in documents:
+            by_parent.setdefault(doc.metadata["parent_id"], []).append((doc.metadata["chunk_id"], doc.page_content))
+
+        writer = ChunkStoreWriter(store_path)
+        for parent_id, chunks in by_parent.items():
+            source, article, text = self.parents[parent_id]
+            writer.add_parent(parent_id, source, article, text)
+            # Văn bản bị cào lại ở nhiều keyword sinh ra cùng chunk_id: chỉ giữ một bản mỗi ID
+            writer.add_chunks(parent_id, list(dict(chunks).items()))
+        writer.commit()
+        print(f"-> Chunk store: {len(by_parent)} Điều, {len(documents)} chunks -> {store_path}")
@@ -0,0 +1,299 @@
+"""
+Giảm số chiều embedding lưu trong index (768 -> d) để giảm bộ nhớ và chi phí quét vector.
+
+- "pca"     : fit PCA trên embedding của toàn bộ corpus, chiếu lên d thành phần chính.
+- "truncate": giữ d chiều đầu (chỉ hợp với model huấn luyện kiểu Matryoshka).
+Vector sau khi chiếu được chuẩn hóa L2 lại (tích vô hướng = cosine).
+
+Phép chiếu được lưu cạnh index (`embedding.projection.path`) và áp cho query lúc tìm kiếm qua
+`ProjectedEmbeddings`; vector đã giảm chiều được ghi sang collection Chroma riêng
+(`<collection_name>_<method><dim>`) nên collection đầy đủ vẫn còn để so sánh / rollback.
+
+    python -m src.indexing.projection fit                  # fit theo config + ghi collection giảm chiều
+    python -m src.indexing.projection report --dims 64 128 256 384 --method pca truncate
+"""
+import os
+import io
+import json
+import time
+import argparse
+import contextlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+PROJECTION_METHODS = ("pca", "truncate")
+
+
+class EmbeddingProjection:
+    def __init__(
+        self,
+        method: str,
+        dim: int,
+        mean: Optional[np.ndarray] = None,
+        components: Optional[np.ndarray] = None,  # (dim, full_dim), chỉ dùng với pca
+        explained_variance: Optional[float] = None,
+    ):
+        if method not in PROJECTION_METHODS:
+            raise ValueError(f"projection.method phải là một trong {PROJECTION_METHODS}, nhận được: '{method}'")
+        self.method = method
+        self.dim = dim
+        self.mean = mean
+        self.components = components
+        self.explained_variance = explained_variance
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, method: str = "pca", dim: int = 256) -> 'EmbeddingProjection':
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if dim >= vectors.shape[1]:
+            raise ValueError(f"projection.dim ({dim}) phải nhỏ hơn số chiều gốc ({vectors.shape[1]}).")
+        if method == "truncate":
+            return cls(method, dim)
+        mean = vectors.mean(axis=0)
+        # SVD trên dữ liệu đã trừ trung bình: hàng của Vt là các thành phần chính
+        _, singular, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+        variance = singular ** 2
+        explained = float(variance[:dim].sum() / max(variance.sum(), 1e-12))
+        return cls(method, dim, mean=mean, components=np.ascontiguousarray(vt[:dim], dtype=np.float32), explained_variance=explained)
+
+    def transform(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.method == "truncate":
+            reduced = vectors[..., : self.dim]
+        else:
+            reduced = (vectors - self.mean) @ self.components.T
+        return reduced / np.maximum(np.linalg.norm(reduced, axis=-1, keepdims=True), 1e-12)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        arrays: Dict[str, Any] = {"method": np.asarray(self.method), "dim": np.asarray(self.dim)}
+        if self.method == "pca":
+            arrays.update(mean=self.mean, components=self.components, explained_variance=np.asarray(self.explained_variance))
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'EmbeddingProjection':
+        with np.load(path) as data:
+            method = str(data["method"])
+            if method == "truncate":
+                return cls(method, int(data["dim"]))
+            return cls(
+                method, int(data["dim"]), mean=data["mean"], components=data["components"],
+                explained_variance=float(data["explained_variance"]),
+            )
+
+
+class ProjectedEmbeddings(Embeddings):
+    """ Bọc embedding model: mọi vector trả ra (query lẫn document) đều đã được chiếu xuống d chiều. """
+    def __init__(self, base: Embeddings, projection: EmbeddingProjection):
+        self.base = base
+        self.projection = projection
+        self.model_name = f"{getattr(base, 'model_name', type(base).__name__)} ({projection.method}{projection.dim})"
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self.projection.transform(np.asarray(self.base.embed_documents(texts))).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.projection.transform(np.asarray(self.base.embed_query(text))).tolist()
+
+
+def projection_config(cfg: Dict[str, Any]) -> Dict[str, Any]:
+    return cfg.get('embedding', {}).get('projection') or {}
+
+
+def projected_collection_name(cfg: Dict[str, Any]) -> str:
+    """ Collection chứa vector đã giảm chiều (hoặc collection gốc nếu không bật projection). """
+    collection = cfg['data']['collection_name']
+    proj_cfg = projection_config(cfg)
+    if not proj_cfg.get('enabled', False):
+        return collection
+    return f"{collection}_{proj_cfg.get('method', 'pca')}{proj_cfg.get('dim', 256)}"
+
+
+def with_projection(embedding_model: Embeddings, cfg: Dict[str, Any]) -> Embeddings:
+    """ Bọc model bằng phép chiếu đã lưu nếu projection được bật (model đã bọc thì bọc lại từ model gốc). """
+    base = getattr(embedding_model, "base", embedding_model)
+    proj_cfg = projection_config(cfg)
+    if not proj_cfg.get('enabled', False):
+        return base
+    projection = EmbeddingProjection.load(proj_cfg.get('path', "./data/legal_documents/projection.npz"))
+    print(f"-> Embedding projection: {projection.method} -> {projection.dim} chiều.")
+    return ProjectedEmbeddings(base, projection)
+
+
+def _read_collection(persist_dir: str, collection: str):
+    from langchain_chroma import Chroma
+
+    dump = Chroma(persist_directory=persist_dir, collection_name=collection).get(
+        include=["documents", "metadatas", "embeddings"]
+    )
+    if not dump['documents']:
+        raise ValueError(f"Collection '{collection}' không có Documents nào.")
+    return dump
+
+
+def build_projected_collection(cfg: Dict[str, Any], batch_size: int = 2000) -> Dict[str, Any]:
+    """ Fit phép chiếu trên embedding đầy đủ của collection gốc, lưu lại, rồi ghi collection giảm chiều. """
+    from langchain_chroma import Chroma
+
+    proj_cfg = projection_config(cfg)
+    method, dim = proj_cfg.get('method', "pca"), proj_cfg.get('dim', 256)
+    path = proj_cfg.get('path', "./data/legal_documents/projection.npz")
+    data_cfg = cfg['data']
+
+    dump = _read_collection(data_cfg['persist_directory'], data_cfg['collection_name'])
+    full = np.asarray(dump['embeddings'], dtype=np.float32)
+    t0 = time.perf_counter()
+    projection = EmbeddingProjection.fit(full, method, dim)
+    reduced = projection.transform(full)
+    projection.save(path)
+    print(
+        f"-> Fit {method} {full.shape[1]} -> {dim} chiều trên {len(full)} vector trong {time.perf_counter() - t0:.2f}s"
+        + (f" (giữ {projection.explained_variance:.1%} phương sai)" if projection.explained_variance is not None else "")
+        + f", lưu tại {path}"
+    )
+
+    target = f"{data_cfg['collection_name']}_{method}{dim}"
+    store = Chroma(persist_directory=data_cfg['persist_directory'], collection_name=target)
+    store.delete_collection()  # Ghi lại từ đầu: phép chiếu mới làm vector cũ mất hiệu lực
+    store = Chroma(persist_directory=data_cfg['persist_directory'], collection_name=target)
+    for i in range(0, len(reduced), batch_size):
+        store._collection.upsert(
+            ids=dump['ids'][i : i + batch_size],
+            embeddings=reduced[i : i + batch_size].tolist(),
+            documents=dump['documents'][i : i + batch_size],
+            metadatas=dump['metadatas'][i : i + batch_size],
+        )
+    print(
+        f"-> Ghi {len(reduced)} vector {dim} chiều vào collection '{target}' "
+        f"({full.shape[1] * 4} -> {dim * 4} bytes/vector)."
+    )
+    return {
+        "method": method,
+        "dim": dim,
+        "full_dim": int(full.shape[1]),
+        "explained_variance": projection.explained_variance,
+        "collection_name": target,
+        "num_vectors": len(reduced),
+    }
+
+
+def _top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ vectors.T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def recall_report(
+    cfg: Dict[str, Any],
+    dataset: str,
+    dims: List[int],
+    methods: List[str],
+    k: int = 10,
+    overlap_threshold: float = 0.5,
+    limit: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    So sánh vector search đầy đủ chiều với từng (method, dim) trên bộ QA test:
+    recall@k theo đáp án chuẩn (cùng tiêu chí với src.benchmark.retrieval), độ phủ top-k của bản
+    đầy đủ (overlap@k), bộ nhớ vector và thời gian quét brute-force mỗi query.
+    """
+    import pandas as pd
+    from langchain_core.documents import Document
+    from src.agents.database_retriever import DatabaseRetriever
+    from src.benchmark.retrieval import extract_doc_numbers, is_relevant
+
+    df = pd.read_csv(dataset).dropna(subset=["question", "answer"])
+    if limit:
+        df = df.head(limit)
+    questions = df["question"].astype(str).tolist()
+    answers = df["answer"].astype(str).tolist()
+
+    data_cfg = cfg['data']
+    dump = _read_collection(data_cfg['persist_directory'], data_cfg['collection_name'])
+    documents = [Document(page_content=t, metadata=m or {}) for t, m in zip(dump['documents'], dump['metadatas'])]
+    full = np.asarray(dump['embeddings'], dtype=np.float32)
+    full /= np.maximum(np.linalg.norm(full, axis=1, keepdims=True), 1e-12)
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = DatabaseRetriever._load_embedding_model(cfg['embedding'])
+    query_full = np.asarray(model.embed_documents(questions), dtype=np.float32)
+    print(f"-> {len(questions)} câu hỏi, {len(documents)} chunks, {full.shape[1]} chiều.")
+
+    def evaluate(vectors: np.ndarray, queries: np.ndarray, reference: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        t0 = time.perf_counter()
+        top = _top_k(vectors, queries, k)
+        scan_ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        hits = [
+            any(is_relevant(documents[i], answer, extract_doc_numbers(answer), overlap_threshold) for i in row)
+            for row, answer in zip(top, answers)
+        ]
+        result = {
+            f"recall@{k}": sum(hits) / len(hits),
+            "vector_bytes": int(vectors.shape[1] * 4 * len(vectors)),
+            "scan_ms_per_query": round(scan_ms, 3),
+        }
+        if reference is not None:
+            result[f"overlap@{k}"] = float(np.mean([len(set(a) & set(b)) / k for a, b in zip(top, reference)]))
+        return result, top
+
+    baseline, full_top = evaluate(full, query_full)
+    runs = [{"method": "full", "dim": int(full.shape[1]), **baseline}]
+    print(f"   full {full.shape[1]}: {baseline}")
+    for method in methods:
+        for dim in dims:
+            if dim >= full.shape[1]:
+                continue
+            projection = EmbeddingProjection.fit(full, method, dim)
+            result, _ = evaluate(projection.transform(full), projection.transform(query_full), full_top)
+            if projection.explained_variance is not None:
+                result["explained_variance"] = projection.explained_variance
+            runs.append({"method": method, "dim": dim, **result})
+            print(f"   {method} {dim}: {result}")
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "dataset": dataset,
+        "embedding_model": cfg['embedding']['model_name'],
+        "k": k,
+        "overlap_threshold": overlap_threshold,
+        "runs": runs,
+    }
+
+
+def main():
+    from src.utils import extract_config
+
+    parser = argparse.ArgumentParser(description="Giảm số chiều embedding (PCA / cắt chiều Matryoshka).")
+    parser.add_argument("--config", type=str, default="configs/indexing_pipeline.yml")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("fit", help="Fit phép chiếu theo embedding.projection và ghi collection giảm chiều")
+    report = sub.add_parser("report", help="recall@k của vector search giảm chiều so với đầy đủ chiều")
+    report.add_argument("--dataset", type=str, default="data/question_answer/test_with_context.csv")
+    report.add_argument("--dims", type=int, nargs="+", default=[64, 128, 256, 384])
+    report.add_argument("--method", type=str, nargs="+", default=["pca"], choices=list(PROJECTION_METHODS))
+    report.add_argument("--k", type=int, default=10)
+    report.add_argument("--overlap-threshold", type=float, default=0.5)
+    report.add_argument("--limit", type=int, default=None)
+    report.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    cfg = extract_config(args.config)
+    if args.command == "fit":
+        build_projected_collection(cfg)
+        return
+    result = recall_report(cfg, args.dataset, args.dims, args.method, args.k, args.overlap_threshold, args.limit)
+    out_path = args.output or os.path.join("data", "benchmark", f"projection_{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"✅ Xong! Kết quả lưu tại: {out_path}")
+
+
+if __name__ == "__main__":
+    main()
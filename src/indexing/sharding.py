@@ -0,0 +1,223 @@
+"""
+Chia index thành các shard theo chủ đề để mỗi câu hỏi chỉ tìm trong vài shard liên quan.
+
+- Shard theo `keywords` (16 từ khóa lúc thu thập: bảo hiểm y tế, viện phí, chuyển tuyến, ...;
+  chunk đã gộp qua dedup có nhiều keyword -> dùng keyword đầu tiên)
+  hoặc theo cụm `kmeans` trên vector chunk (số shard cố định, không phụ thuộc metadata).
+  Shard lớn hơn `max_shard_size` được chia nhỏ tiếp bằng k-means.
+- Mỗi shard có BM25 riêng (các cột của ma trận BM25 toàn cục, nên IDF/avgdl giống hệt index
+  chung và điểm so sánh được giữa các shard), ma trận vector riêng và centroid (vector trung bình).
+- Router: cosine(query, centroid) -> top-m shard, tìm song song, gộp theo điểm.
+  Chế độ exhaustive tìm trên mọi shard và cho kết quả giống hệt index không chia shard
+  (dùng để đo recall của routing: python -m src.benchmark.retrieval --shard-top-m 0 2 4).
+"""
+import time
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.indexing.bm25_index import SparseBM25Index
+from src.indexing.chunk_table import metadata_column
+from src.indexing.dedup import split_multi
+
+logger = logging.getLogger(__name__)
+
+SHARD_STRATEGIES = ("keywords", "kmeans")
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def kmeans(vectors: np.ndarray, num_clusters: int, iterations: int = 20, seed: int = 0) -> np.ndarray:
+    """ Spherical k-means (cosine) đơn giản; trả về nhãn cụm của từng vector. """
+    n = vectors.shape[0]
+    num_clusters = max(1, min(num_clusters, n))
+    rng = np.random.default_rng(seed)
+    # Khởi tạo k-means++: tâm mới được chọn với xác suất tỉ lệ khoảng cách (1 - cosine) tới tâm gần nhất
+    centroids = np.empty((num_clusters, vectors.shape[1]), dtype=np.float32)
+    centroids[0] = vectors[rng.integers(n)]
+    dist = np.maximum(1.0 - vectors @ centroids[0], 0.0)
+    for c in range(1, num_clusters):
+        total = dist.sum()
+        centroids[c] = vectors[rng.choice(n, p=dist / total) if total > 0 else rng.integers(n)]
+        dist = np.minimum(dist, np.maximum(1.0 - vectors @ centroids[c], 0.0))
+    labels = np.zeros(n, dtype=np.int64)
+    for iteration in range(iterations):
+        new_labels = np.argmax(vectors @ centroids.T, axis=1)
+        if iteration > 0 and np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        for c in range(num_clusters):
+            members = vectors[labels == c]
+            # Cụm rỗng: lấy lại một điểm ngẫu nhiên làm tâm
+            centroids[c] = members.mean(axis=0) if len(members) else vectors[rng.integers(n)]
+        centroids = _normalize_rows(centroids)
+    return labels
+
+
+class Shard:
+    def __init__(self, name: str, doc_ids: np.ndarray, vectors: np.ndarray, bm25_index: SparseBM25Index):
+        self.name = name
+        self.doc_ids = doc_ids  # vị trí toàn cục (trong retriever.documents)
+        self.vectors = vectors
+        self.bm25_index = bm25_index
+        self.centroid = _normalize_rows(vectors.mean(axis=0)) if len(vectors) else np.zeros(vectors.shape[1], np.float32)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def search(self, query: str, query_vector: np.ndarray, bm25_k: int, vector_k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """ (bm25 ids toàn cục, điểm, vector ids toàn cục, điểm). """
+        return (*self.search_bm25(query, bm25_k), *self.search_vectors(query_vector, vector_k))
+
+    def search_bm25(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        bm25_ids, bm25_scores = self.bm25_index.search(query, k=k)
+        return self.doc_ids[bm25_ids], bm25_scores
+
+    def search_vectors(self, query_vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(self.doc_ids))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        scores = self.vectors @ query_vector
+        top = np.argpartition(-scores, k - 1)[:k]
+        return self.doc_ids[top], scores[top]
+
+
+class ShardedIndex:
+    def __init__(self, shards: List[Shard], top_m: int = 3, max_workers: int = 4):
+        self.shards = shards
+        self.top_m = top_m
+        self.centroids = np.stack([shard.centroid for shard in shards]) if shards else np.zeros((0, 0), np.float32)
+        self._pool = ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix="shard")
+
+    @classmethod
+    def build(
+        cls,
+        documents: Sequence[Document],
+        vectors: np.ndarray,
+        bm25_index: SparseBM25Index,
+        by: str = "keywords",
+        num_shards: int = 16,
+        max_shard_size: Optional[int] = None,
+        top_m: int = 3,
+        max_workers: int = 4,
+    ) -> 'ShardedIndex':
+        if by not in SHARD_STRATEGIES:
+            raise ValueError(f"sharding.by phải là một trong {SHARD_STRATEGIES}, nhận được: '{by}'")
+        t0 = time.perf_counter()
+        vectors = _normalize_rows(vectors)
+
+        groups: Dict[str, List[int]] = defaultdict(list)
+        if by == "keywords":
+            for i, keyword in enumerate(metadata_column(documents, "keywords")):
+                # Sau dedup, keywords là chuỗi "a | b" của các bản đã gộp: dùng keyword chính
+                # (của chunk được giữ lại, đứng đầu) để mỗi chunk thuộc đúng một shard chủ đề
+                keywords = split_multi(str(keyword)) if keyword else []
+                groups[keywords[0] if keywords else "khác"].append(i)
+        else:
+            for i, label in enumerate(kmeans(vectors, num_shards)):
+                groups[f"cluster_{label}"].append(i)
+
+        if max_shard_size:
+            for name in [n for n, ids in groups.items() if len(ids) > max_shard_size]:
+                ids = np.asarray(groups.pop(name))
+                labels = kmeans(vectors[ids], int(np.ceil(len(ids) / max_shard_size)))
+                for label in np.unique(labels):
+                    groups[f"{name}/{label}"] = ids[labels == label].tolist()
+
+        shards = []
+        for name, ids in sorted(groups.items()):
+            ids_arr = np.asarray(ids, dtype=np.int64)
+            # Cột của ma trận BM25 toàn cục: giữ nguyên IDF/avgdl nên điểm so sánh được giữa các shard
+            shard_bm25 = SparseBM25Index(
+                bm25_index.term_doc[:, ids_arr].tocsr(), bm25_index.vocab, len(ids_arr),
+                k1=bm25_index.k1, b=bm25_index.b, tokenizer=bm25_index.tokenizer,
+            )
+            shards.append(Shard(name, ids_arr, np.ascontiguousarray(vectors[ids_arr]), shard_bm25))
+        sizes = [len(shard) for shard in shards]
+        print(
+            f"-> ShardedIndex: {len(shards)} shard theo '{by}' (nhỏ nhất {min(sizes)}, lớn nhất {max(sizes)} chunks, "
+            f"top_m={top_m}) trong {time.perf_counter() - t0:.2f}s."
+        )
+        return cls(shards, top_m=top_m, max_workers=max_workers)
+
+    def route(self, query_vector: np.ndarray, top_m: Optional[int] = None) -> List[int]:
+        """ Chỉ số các shard có centroid gần query nhất; top_m None/<=0 -> mọi shard (exhaustive). """
+        top_m = self.top_m if top_m is None else top_m
+        if top_m <= 0 or top_m >= len(self.shards):
+            return list(range(len(self.shards)))
+        sims = self.centroids @ query_vector
+        return np.argsort(-sims)[:top_m].tolist()
+
+    def search(
+        self,
+        query: str,
+        query_vector: Sequence[float],
+        bm25_k: int,
+        vector_k: int,
+        top_m: Optional[int] = None,
+    ) -> Tuple[List[int], List[int], List[str]]:
+        """ (bm25 ids, vector ids, tên các shard đã tìm); ids là vị trí toàn cục, điểm giảm dần. """
+        query_vector = _normalize_rows(np.asarray(query_vector, dtype=np.float32))
+        selected = self.route(query_vector, top_m)
+        if len(selected) == 1:
+            results = [self.shards[selected[0]].search(query, query_vector, bm25_k, vector_k)]
+        else:
+            results = list(self._pool.map(
+                lambda s: self.shards[s].search(query, query_vector, bm25_k, vector_k), selected
+            ))
+        bm25_ids = self._merge([(r[0], r[1]) for r in results], bm25_k)
+        vector_ids = self._merge([(r[2], r[3]) for r in results], vector_k)
+        return bm25_ids, vector_ids, [self.shards[s].name for s in selected]
+
+    def search_bm25(
+        self, query: str, query_vector: Sequence[float], k: int, top_m: Optional[int] = None
+    ) -> Tuple[List[int], List[float], List[int]]:
+        """
+        Bước 1 của tìm kiếm hai pha (dùng cho chính sách thích ứng): BM25 trên các shard được router chọn.
+        Trả về (ids, điểm giảm dần, chỉ số shard đã chọn) để quyết định có cần / sâu bao nhiêu cho nhánh vector.
+        """
+        query_vector = _normalize_rows(np.asarray(query_vector, dtype=np.float32))
+        selected = self.route(query_vector, top_m)
+        results = self._map(lambda s: self.shards[s].search_bm25(query, k), selected)
+        ids, scores = self._merge_scored(results, k)
+        return ids, scores, selected
+
+    def search_vectors(self, query_vector: Sequence[float], k: int, selected: Sequence[int]) -> List[int]:
+        """ Bước 2: vector search trên đúng các shard của bước 1. """
+        query_vector = _normalize_rows(np.asarray(query_vector, dtype=np.float32))
+        return self._merge(self._map(lambda s: self.shards[s].search_vectors(query_vector, k), selected), k)
+
+    def _map(self, fn, selected: Sequence[int]) -> list:
+        if len(selected) == 1:
+            return [fn(selected[0])]
+        return list(self._pool.map(fn, selected))
+
+    @staticmethod
+    def _merge(results: List[Tuple[np.ndarray, np.ndarray]], k: int) -> List[int]:
+        return ShardedIndex._merge_scored(results, k)[0]
+
+    @staticmethod
+    def _merge_scored(results: List[Tuple[np.ndarray, np.ndarray]], k: int) -> Tuple[List[int], List[float]]:
+        if not results:
+            return [], []
+        ids = np.concatenate([r[0] for r in results])
+        scores = np.concatenate([r[1] for r in results])
+        order = np.argsort(-scores, kind="stable")[:k]
+        return ids[order].tolist(), scores[order].tolist()
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "num_shards": len(self.shards),
+            "top_m": self.top_m,
+            "sizes": {shard.name: len(shard) for shard in self.shards},
+        }
@@ -0,0 +1,234 @@
+"""
+Snapshot index có phiên bản: mỗi lần index lại tạo một thư mục mới cạnh các bản cũ
+
+    <root>/
+      CURRENT                      # tên phiên bản đang phục vụ (ghi nguyên tử)
+      20250101-120000/
+        manifest.json              # phiên bản, thời điểm, model embedding, số chunk, ...
+        chroma_db/                 # Chroma (vector + documents)
+        artifacts/                 # (tùy chọn) vector/BM25/chunk mmap cho chế độ multi-worker
+        chunk_store.sqlite
+        citation_index.json
+        diacritics.json
+        projection.npz             # (tùy chọn) phép chiếu giảm chiều embedding
+
+Bản mới được build trong `<root>/.staging-<version>` rồi đổi tên, sau đó CURRENT mới trỏ sang,
+nên API đang chạy không bao giờ đọc phải bản dở dang. API (src/serving/index_manager.py) phát hiện
+CURRENT đổi và nạp bản mới ở background rồi hoán đổi, không cần restart.
+
+    python -m src.indexing.snapshot build [--export-artifacts]
+    python -m src.indexing.snapshot list
+    python -m src.indexing.snapshot activate <version>    # rollback / chọn lại bản cũ
+    python -m src.indexing.snapshot --profile ./data/profiles/build.collapsed build  # flamegraph của lần index
+"""
+import os
+import copy
+import glob
+import json
+import time
+import shutil
+import argparse
+from typing import Any, Dict, List, Optional, Tuple
+
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+STAGING_PREFIX = ".staging-"
+
+
+def snapshot_root(cfg: Dict[str, Any]) -> str:
+    return cfg.get('snapshots', {}).get('root', "./data/legal_documents/snapshots")
+
+
+def snapshot_config(cfg: Dict[str, Any], snapshot_dir: str) -> Dict[str, Any]:
+    """ Bản sao config với mọi đường dẫn index trỏ vào thư mục snapshot. """
+    cfg = copy.deepcopy(cfg)
+    cfg.setdefault('data', {})['persist_directory'] = os.path.join(snapshot_dir, "chroma_db")
+    cfg.setdefault('chunk_store', {})['path'] = os.path.join(snapshot_dir, "chunk_store.sqlite")
+    qp_cfg = cfg.setdefault('query_preprocessing', {})
+    qp_cfg['citation_index_path'] = os.path.join(snapshot_dir, "citation_index.json")
+    qp_cfg['diacritics_path'] = os.path.join(snapshot_dir, "diacritics.json")
+    cfg.setdefault('artifacts', {})['directory'] = os.path.join(snapshot_dir, "artifacts")
+    if cfg.get('embedding', {}).get('projection'):
+        cfg['embedding']['projection']['path'] = os.path.join(snapshot_dir, "projection.npz")
+    return cfg
+
+
+def current_version(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def read_manifest(root: str, version: str) -> Dict[str, Any]:
+    with open(os.path.join(root, version, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def list_versions(root: str) -> List[str]:
+    """ Các phiên bản đã publish (có manifest), cũ -> mới. """
+    return sorted(
+        os.path.basename(os.path.dirname(path))
+        for path in glob.glob(os.path.join(root, "*", MANIFEST_FILE))
+        if not os.path.basename(os.path.dirname(path)).startswith(STAGING_PREFIX)
+    )
+
+
+def set_current(root: str, version: str):
+    """ Trỏ CURRENT sang `version` (ghi file tạm rồi os.replace: reader luôn thấy bản cũ hoặc bản mới). """
+    if not os.path.exists(os.path.join(root, version, MANIFEST_FILE)):
+        raise FileNotFoundError(f"Không có snapshot '{version}' trong {root}.")
+    tmp_path = os.path.join(root, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+
+
+def resolve_config(cfg: Dict[str, Any], version: Optional[str] = None) -> Tuple[Dict[str, Any], Optional[str]]:
+    """
+    Config để nạp index: nếu bật snapshots thì trỏ vào `version` (mặc định: CURRENT),
+    nếu không thì giữ nguyên đường dẫn cũ. Trả về (config, phiên bản hoặc None).
+    """
+    if not cfg.get('snapshots', {}).get('enabled', False):
+        return cfg, None
+    root = snapshot_root(cfg)
+    version = version or current_version(root)
+    if version is None:
+        raise FileNotFoundError(f"Chưa có snapshot nào trong {root}. Chạy: python -m src.indexing.snapshot build")
+    return snapshot_config(cfg, os.path.join(root, version)), version
+
+
+def prune(root: str, keep: int):
+    """ Xóa các bản cũ, giữ `keep` bản mới nhất và luôn giữ bản CURRENT. """
+    current = current_version(root)
+    versions = list_versions(root)
+    for version in versions[: max(0, len(versions) - keep)]:
+        if version != current:
+            shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+            print(f"-> Đã xóa snapshot cũ {version}.")
+
+
+class SnapshotBuilder:
+    """ Build một snapshot trong thư mục staging; `publish()` đổi tên + cập nhật CURRENT. """
+    def __init__(self, root: str, version: Optional[str] = None):
+        self.root = root
+        self.version = version or time.strftime("%Y%m%d-%H%M%S")
+        self.staging_dir = os.path.join(root, STAGING_PREFIX + self.version)
+        if os.path.exists(os.path.join(root, self.version)):
+            raise FileExistsError(f"Snapshot '{self.version}' đã tồn tại trong {root}.")
+        if os.path.exists(self.staging_dir):
+            shutil.rmtree(self.staging_dir)
+        os.makedirs(self.staging_dir)
+
+    def config_for(self, cfg: Dict[str, Any]) -> Dict[str, Any]:
+        return snapshot_config(cfg, self.staging_dir)
+
+    def publish(self, manifest: Dict[str, Any], activate: bool = True) -> str:
+        manifest = {"version": self.version, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"), **manifest}
+        with open(os.path.join(self.staging_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        final_dir = os.path.join(self.root, self.version)
+        os.replace(self.staging_dir, final_dir)
+        if activate:
+            set_current(self.root, self.version)
+        print(f"-> Snapshot {self.version} -> {final_dir}{' (CURRENT)' if activate else ''}")
+        return self.version
+
+    def abort(self):
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+
+def _keywords_from_raw(raw_dir: str, prefix: str = "metadata_law_") -> List[str]:
+    """ 'metadata_law_khám_chữa_bệnh.json' -> 'khám chữa bệnh' (đúng định dạng DocumentIndexer.run). """
+    names = sorted(os.path.basename(p) for p in glob.glob(os.path.join(raw_dir, f"{prefix}*.json")))
+    return [name[len(prefix):-len(".json")].replace("_", " ") for name in names]
+
+
+def build_snapshot(
+    cfg: Dict[str, Any],
+    keywords: Optional[List[str]] = None,
+    raw_dir: str = "./data/legal_documents/raw",
+    export_artifacts: bool = False,
+    activate: bool = True,
+) -> str:
+    """ Chạy DocumentIndexer vào một snapshot mới (+ artifacts mmap nếu cần), publish và dọn bản cũ. """
+    from src.indexing.index_legal_documents import DocumentIndexer
+
+    root = snapshot_root(cfg)
+    os.makedirs(root, exist_ok=True)
+    keywords = keywords or _keywords_from_raw(raw_dir)
+    builder = SnapshotBuilder(root)
+    try:
+        scfg = builder.config_for(cfg)
+        num_chunks = DocumentIndexer(scfg).run(keywords, base_pre_path=os.path.join(raw_dir, "metadata_law_"))
+        if not num_chunks:
+            raise ValueError("Không có chunk nào được index, bỏ snapshot.")
+        manifest: Dict[str, Any] = {
+            "num_chunks": num_chunks,
+            "keywords": keywords,
+            "embedding_model": cfg['embedding']['model_name'],
+            "collection_name": cfg['data']['collection_name'],
+        }
+        if scfg['embedding'].get('projection', {}).get('enabled', False):
+            from src.indexing.projection import build_projected_collection
+            manifest["projection"] = build_projected_collection(scfg)
+        if export_artifacts:
+            from src.indexing.artifacts import export_from_chroma
+            manifest["artifacts"] = export_from_chroma(scfg)
+        version = builder.publish(manifest, activate=activate)
+    except Exception:
+        builder.abort()
+        raise
+    prune(root, cfg.get('snapshots', {}).get('keep', 3))
+    return version
+
+
+def main():
+    from src.serving.profiling import PROFILE_MODES, profile_to
+
+    parser = argparse.ArgumentParser(description="Quản lý snapshot index có phiên bản.")
+    parser.add_argument("--config", type=str, default="configs/indexing_pipeline.yml")
+    parser.add_argument("--profile", type=str, default=None, help="Profile lệnh và ghi ra file (vd: ./data/profiles/build.collapsed)")
+    parser.add_argument("--profile-mode", choices=PROFILE_MODES, default="sample", help="sample: collapsed stacks (flamegraph) | cprofile: .prof")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Index lại toàn bộ vào một snapshot mới")
+    build.add_argument("--raw-dir", type=str, default="./data/legal_documents/raw")
+    build.add_argument("--keywords", nargs="*", default=None, help="Mặc định: mọi file metadata_law_*.json trong raw-dir")
+    build.add_argument("--export-artifacts", action="store_true", help="Ghi thêm artifacts mmap (artifacts.use_mmap)")
+    build.add_argument("--no-activate", action="store_true", help="Không trỏ CURRENT sang bản mới")
+    sub.add_parser("list", help="Liệt kê các snapshot")
+    activate = sub.add_parser("activate", help="Trỏ CURRENT sang một snapshot đã có")
+    activate.add_argument("version")
+    args = parser.parse_args()
+
+    if args.profile:
+        with profile_to(args.profile, args.profile_mode) as result:
+            _run_command(args)
+        print(f"-> Profile ({result.mode}, {result.samples} mẫu, {result.seconds:.1f}s) -> {result.path}")
+    else:
+        _run_command(args)
+
+
+def _run_command(args: argparse.Namespace):
+    from src.utils import extract_config
+
+    cfg = extract_config(args.config)
+    root = snapshot_root(cfg)
+    if args.command == "build":
+        build_snapshot(cfg, args.keywords, args.raw_dir, args.export_artifacts, activate=not args.no_activate)
+    elif args.command == "list":
+        current = current_version(root)
+        for version in list_versions(root):
+            manifest = read_manifest(root, version)
+            marker = "*" if version == current else " "
+            print(f"{marker} {version}  {manifest.get('num_chunks', '?')} chunks  {manifest.get('embedding_model', '')}")
+    else:
+        set_current(root, args.version)
+        print(f"-> CURRENT = {args.version}")
+
+
+if __name__ == "__main__":
+    main()
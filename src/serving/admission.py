@@ -0,0 +1,215 @@
+"""
+Admission control cho /chat: giới hạn số pipeline chạy đồng thời, gộp câu hỏi trùng, giới hạn tần suất.
+
+- `AdmissionController`: tối đa `max_in_flight` pipeline chạy cùng lúc; request dư xếp hàng
+  (tối đa `max_queue`) và chờ tối đa `queue_timeout_seconds`. Khi hàng đợi đầy, hoặc thời gian
+  chờ ước lượng (độ dài hàng đợi x thời gian xử lý trung bình) đã vượt deadline, request bị từ chối
+  ngay (load shedding) thay vì treo rồi timeout.
+- `SingleFlight`: các câu hỏi giống hệt nhau đến đồng thời dùng chung MỘT lần chạy pipeline.
+- `RateLimiter`: token bucket theo địa chỉ client (không theo session_id do client tự đặt). Sau reverse
+  proxy cần chạy uvicorn với --proxy-headers để địa chỉ client là IP thật thay vì IP của proxy.
+
+Request bị từ chối nhận `AdmissionRejected` (429 cho rate limit, 503 cho quá tải) kèm Retry-After.
+"""
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from src.serving.observability import REGISTRY, Counter, Gauge, Histogram
+from src.serving.deadline import current_deadline
+
+IN_FLIGHT = REGISTRY.register(Gauge("rag_admission_in_flight", "Số pipeline /chat đang chạy."))
+QUEUED = REGISTRY.register(Gauge("rag_admission_queued", "Số request /chat đang chờ trong hàng đợi."))
+REJECTED = REGISTRY.register(Counter(
+    "rag_admission_rejected_total", "Số request bị từ chối bởi admission control.", ("reason",)
+))
+COALESCED = REGISTRY.register(Counter(
+    "rag_admission_coalesced_total", "Số request dùng chung kết quả của một request giống hệt đang chạy."
+))
+ADMISSION_WAIT = REGISTRY.register(Histogram(
+    "rag_admission_wait_seconds", "Thời gian chờ trong hàng đợi trước khi được chạy."
+))
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, status_code: int, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """ `rate` token/giây, tối đa `capacity` token (cho phép burst). """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def try_acquire(self, cost: float = 1.0) -> Tuple[bool, float]:
+        """ (được phép?, số giây cần chờ nếu không). """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True, 0.0
+        return False, (cost - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+
+class RateLimiter:
+    """ Token bucket theo từng client; giữ tối đa `max_clients` bucket (LRU). """
+    def __init__(self, requests_per_second: float = 1.0, burst: float = 5.0, max_clients: int = 10000):
+        self.rate = requests_per_second
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, rate_cfg: Dict[str, Any]) -> 'RateLimiter':
+        return cls(
+            requests_per_second=rate_cfg.get('requests_per_second', 5.0),
+            burst=rate_cfg.get('burst', 20),
+            max_clients=rate_cfg.get('max_clients', 10000),
+        )
+
+    def check(self, client: Hashable, cost: float = 1.0):
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+            allowed, retry_after = bucket.try_acquire(cost)
+        if not allowed:
+            REJECTED.inc(reason="rate_limited")
+            raise AdmissionRejected("rate_limited", 429, retry_after)
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight: int = 16, max_queue: int = 64, queue_timeout_seconds: float = 10.0):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout_seconds
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # Thời gian xử lý trung bình (EWMA) để ước lượng thời gian chờ khi quyết định shed
+        self._avg_service: Optional[float] = None
+
+    @classmethod
+    def from_config(cls, admission_cfg: Dict[str, Any]) -> 'AdmissionController':
+        return cls(
+            max_in_flight=admission_cfg.get('max_in_flight', 16),
+            max_queue=admission_cfg.get('max_queue', 64),
+            queue_timeout_seconds=admission_cfg.get('queue_timeout_seconds', 10.0),
+        )
+
+    def estimated_wait(self) -> float:
+        """ Thời gian chờ ước lượng của request kế tiếp: số request phía trước / max_in_flight x thời gian xử lý TB. """
+        if self._avg_service is None:
+            return 0.0
+        ahead = max(0, self.in_flight + self.waiting - self.max_in_flight + 1)
+        return ahead * self._avg_service / self.max_in_flight
+
+    @asynccontextmanager
+    async def slot(self):
+        """ Giữ một chỗ chạy pipeline trong suốt khối `async with`; từ chối ngay nếu quá tải. """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        # Không chờ lâu hơn phần deadline còn lại của request (nếu có)
+        deadline = current_deadline()
+        queue_timeout = deadline.timeout(cap=self.queue_timeout) if deadline is not None else self.queue_timeout
+        # in_flight + waiting gồm cả request đã được nhận nhưng chưa kịp giữ semaphore
+        if self.in_flight + self.waiting >= self.max_in_flight:
+            if self.in_flight + self.waiting >= self.max_in_flight + self.max_queue:
+                REJECTED.inc(reason="queue_full")
+                raise AdmissionRejected("queue_full", 503, self.estimated_wait() or 1.0)
+            if self.estimated_wait() > queue_timeout:
+                REJECTED.inc(reason="shed")
+                raise AdmissionRejected("shed", 503, self.estimated_wait())
+
+        t0 = time.perf_counter()
+        self.waiting += 1
+        QUEUED.set(max(0, self.in_flight + self.waiting - self.max_in_flight))
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=queue_timeout)
+        except asyncio.TimeoutError:
+            REJECTED.inc(reason="queue_timeout")
+            raise AdmissionRejected("queue_timeout", 503, self.estimated_wait() or 1.0)
+        finally:
+            self.waiting -= 1
+        ADMISSION_WAIT.observe(time.perf_counter() - t0)
+
+        self.in_flight += 1
+        IN_FLIGHT.set(self.in_flight)
+        QUEUED.set(max(0, self.in_flight + self.waiting - self.max_in_flight))
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t_start
+            self._avg_service = elapsed if self._avg_service is None else 0.8 * self._avg_service + 0.2 * elapsed
+            self.in_flight -= 1
+            IN_FLIGHT.set(self.in_flight)
+            self._semaphore.release()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "queued": max(0, self.in_flight + self.waiting - self.max_in_flight),
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "avg_service_seconds": round(self._avg_service, 3) if self._avg_service is not None else None,
+        }
+
+
+class SingleFlight:
+    """
+    Gộp các lời gọi cùng key đang chạy đồng thời: lời gọi đầu tiên chạy `fn`, các lời gọi sau
+    chờ cùng kết quả (hoặc cùng exception). Task dùng chung được shield nên một client ngắt kết nối
+    không hủy kết quả của các client khác; chỉ khi người chờ CUỐI CÙNG rời đi thì task mới bị hủy
+    (không tốn thêm LLM / retrieval cho kết quả không ai nhận).
+    """
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """ Trả về (kết quả, có phải dùng chung với lời gọi khác không). """
+        task = self._inflight.get(key)
+        shared = task is not None
+        if shared:
+            COALESCED.inc()
+        else:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task), shared
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+                if not task.done():
+                    # Người chờ cuối cùng đã bị hủy (client ngắt kết nối / hết deadline)
+                    if self._inflight.get(key) is task:
+                        del self._inflight[key]
+                    task.cancel()
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # Tránh cảnh báo "exception was never retrieved" khi mọi caller đã ngắt kết nối
+
+    def __len__(self) -> int:
+        return len(self._inflight)
@@ -0,0 +1,127 @@
+"""
+Micro-batching động cho các lời gọi model trong một process (embedding query, reranker).
+
+Mỗi request `await batcher.submit(item)`; một task nền gom các item đang chờ thành một batch
+(tối đa `max_batch_size`, chờ thêm tối đa `max_wait_ms` sau item đầu tiên), chạy MỘT lần
+forward trong thread riêng rồi trả kết quả về future của từng caller.
+
+Khi tải thấp, item đến lúc model đang rảnh được chạy gần như ngay (chỉ chờ `max_wait_ms`,
+mặc định vài ms), nên p50 không bị ảnh hưởng. Khi tải cao, các item đến trong lúc một batch
+đang chạy sẽ dồn lại và được xử lý chung ở batch kế tiếp -> throughput tăng theo kích thước batch.
+"""
+import time
+import asyncio
+import logging
+from typing import Callable, Generic, List, Optional, Tuple, TypeVar
+
+from src.serving.observability import REGISTRY, Histogram
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+BATCH_SIZE = REGISTRY.register(Histogram(
+    "rag_microbatch_size", "Kích thước các batch được gom bởi MicroBatcher.", ("batcher",),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+))
+QUEUE_WAIT = REGISTRY.register(Histogram(
+    "rag_microbatch_wait_seconds", "Thời gian một item chờ trong hàng đợi trước khi được chạy.", ("batcher",),
+))
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Gom các lời gọi đơn lẻ thành batch. `batch_fn` nhận List[T] và trả về List[R] cùng thứ tự,
+    được chạy bằng `asyncio.to_thread` nên không chặn event loop.
+    """
+    def __init__(
+        self,
+        batch_fn: Callable[[List[T]], List[R]],
+        name: str = "batcher",
+        max_batch_size: int = 32,
+        max_wait_ms: float = 2.0,
+    ):
+        self.batch_fn = batch_fn
+        self.name = name
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def from_config(cls, batch_fn: Callable[[List[T]], List[R]], name: str, batch_cfg: dict) -> 'MicroBatcher':
+        return cls(
+            batch_fn,
+            name=name,
+            max_batch_size=batch_cfg.get('max_batch_size', 32),
+            max_wait_ms=batch_cfg.get('max_wait_ms', 2.0),
+        )
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        # Task nền gắn với event loop hiện tại (tạo lười, tạo lại nếu loop đổi, vd: trong test)
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def submit(self, item: T) -> R:
+        self._ensure_worker()
+        future = self._loop.create_future()
+        self._queue.put_nowait((item, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> List[Tuple[T, asyncio.Future, float]]:
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Lấy ngay những gì đã có trong hàng đợi, sau đó mới chờ thêm trong cửa sổ max_wait
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            # Bỏ các caller đã hủy (vd: client ngắt kết nối) trước khi tốn công chạy model
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                continue
+            now = time.perf_counter()
+            for _, _, enqueued in batch:
+                QUEUE_WAIT.observe(now - enqueued, batcher=self.name)
+            BATCH_SIZE.observe(len(batch), batcher=self.name)
+
+            items = [item for item, _, _ in batch]
+            try:
+                results = await asyncio.to_thread(self.batch_fn, items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"{self.name}: batch_fn trả về {len(results)} kết quả cho {len(items)} item.")
+            except Exception as e:
+                logger.warning(f"{self.name}: batch of {len(items)} failed: {e}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._worker = None
@@ -0,0 +1,188 @@
+"""
+Ngân sách thời gian (deadline) end-to-end cho mỗi request /chat.
+
+`deadline_scope(budget)` đặt một `Deadline` vào contextvar (giống trace của observability), các bước
+của pipeline đọc thời gian còn lại qua `current_deadline()` và `DeadlinePolicy` quyết định cách xuống cấp:
+
+- classify / condense : timeout = min(trần của bước, thời gian còn lại); quá hạn -> mặc định an toàn
+- retrieve            : còn ít thời gian -> bỏ reranker, giảm k
+- generate            : max_tokens theo thời gian còn lại x tốc độ sinh ước lượng; không đủ cho
+                        một câu trả lời tối thiểu (hoặc LLM quá hạn) -> câu trả lời trích xuất từ top chunk
+- admission           : thời gian chờ trong hàng đợi không vượt quá deadline
+
+`run_until_disconnected` hủy pipeline khi client ngắt kết nối: việc hủy lan tới các lời gọi
+httpx / LLMGateway đang chờ nên không tốn thêm token cho câu trả lời không ai nhận.
+
+Nhờ vậy p99 của /chat bị chặn bởi `budget_seconds` (+ phần trích xuất rất nhỏ) theo thiết kế.
+"""
+import time
+import asyncio
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+from src.serving.observability import REGISTRY, Counter, current_trace
+
+DEGRADATIONS = REGISTRY.register(Counter(
+    "rag_deadline_degradations_total", "Số lần một bước bị xuống cấp / cắt ngắn vì deadline.", ("stage", "action")
+))
+CLIENT_DISCONNECTS = REGISTRY.register(Counter(
+    "rag_client_disconnects_total", "Số request bị hủy giữa chừng vì client ngắt kết nối."
+))
+
+DISCONNECT_POLL_SECONDS = 0.25
+
+T = TypeVar("T")
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, budget_seconds: float):
+        self.budget = budget_seconds
+        self.start = time.monotonic()
+        self.expires = self.start + budget_seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
+
+    def timeout(self, cap: Optional[float] = None, reserve: float = 0.0) -> float:
+        """ Timeout cho một bước: thời gian còn lại trừ phần để dành, không vượt `cap`. """
+        remaining = max(0.0, self.remaining() - reserve)
+        return remaining if cap is None else min(cap, remaining)
+
+
+_current_deadline: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("rag_deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+@contextmanager
+def deadline_scope(budget_seconds: float) -> Iterator[Deadline]:
+    deadline = Deadline(budget_seconds)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def record_degradation(stage: str, action: str):
+    """ Đếm trong metrics và ghi vào trace hiện tại (log request + Server-Timing). """
+    DEGRADATIONS.inc(stage=stage, action=action)
+    trace = current_trace()
+    if trace is not None:
+        trace.attributes.setdefault("degraded", []).append(f"{stage}:{action}")
+
+
+async def run_until_disconnected(
+    coro: Awaitable[T],
+    is_disconnected: Callable[[], Awaitable[bool]],
+    poll_interval: float = DISCONNECT_POLL_SECONDS,
+) -> T:
+    """ Chạy `coro` như một task, kiểm tra kết nối mỗi `poll_interval` giây; client đi mất -> hủy task. """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result()
+            if await is_disconnected():
+                CLIENT_DISCONNECTS.inc()
+                raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+class DeadlinePolicy:
+    def __init__(
+        self,
+        budget_seconds: float = 20.0,
+        max_budget_seconds: float = 60.0,
+        classify_timeout_seconds: float = 3.0,
+        condense_timeout_seconds: float = 3.0,
+        general_timeout_seconds: float = 8.0,
+        rerank_min_remaining_seconds: float = 8.0,
+        reduced_k_below_seconds: float = 5.0,
+        reduced_k: int = 3,
+        generation_reserve_seconds: float = 0.5,
+        min_generation_seconds: float = 2.0,
+        tokens_per_second: float = 60.0,
+        min_max_tokens: int = 128,
+        disconnect_poll_seconds: float = DISCONNECT_POLL_SECONDS,
+    ):
+        self.budget_seconds = budget_seconds
+        self.max_budget_seconds = max_budget_seconds
+        self.classify_timeout = classify_timeout_seconds
+        self.condense_timeout = condense_timeout_seconds
+        self.general_timeout = general_timeout_seconds
+        self.rerank_min_remaining = rerank_min_remaining_seconds
+        self.reduced_k_below = reduced_k_below_seconds
+        self.reduced_k = reduced_k
+        self.generation_reserve = generation_reserve_seconds
+        self.min_generation = min_generation_seconds
+        self.tokens_per_second = tokens_per_second
+        self.min_max_tokens = min_max_tokens
+        self.disconnect_poll = disconnect_poll_seconds
+
+    @classmethod
+    def from_config(cls, deadline_cfg: Dict[str, Any]) -> 'DeadlinePolicy':
+        return cls(
+            budget_seconds=deadline_cfg.get('budget_seconds', 20.0),
+            max_budget_seconds=deadline_cfg.get('max_budget_seconds', 60.0),
+            classify_timeout_seconds=deadline_cfg.get('classify_timeout_seconds', 3.0),
+            condense_timeout_seconds=deadline_cfg.get('condense_timeout_seconds', 3.0),
+            general_timeout_seconds=deadline_cfg.get('general_timeout_seconds', 8.0),
+            rerank_min_remaining_seconds=deadline_cfg.get('rerank_min_remaining_seconds', 8.0),
+            reduced_k_below_seconds=deadline_cfg.get('reduced_k_below_seconds', 5.0),
+            reduced_k=deadline_cfg.get('reduced_k', 3),
+            generation_reserve_seconds=deadline_cfg.get('generation_reserve_seconds', 0.5),
+            min_generation_seconds=deadline_cfg.get('min_generation_seconds', 2.0),
+            tokens_per_second=deadline_cfg.get('tokens_per_second', 60.0),
+            min_max_tokens=deadline_cfg.get('min_max_tokens', 128),
+            disconnect_poll_seconds=deadline_cfg.get('disconnect_poll_seconds', DISCONNECT_POLL_SECONDS),
+        )
+
+    def budget_for(self, requested_ms: Optional[str]) -> float:
+        """ Ngân sách của request: header X-Request-Budget-Ms (nếu hợp lệ) nhưng không quá max_budget_seconds. """
+        try:
+            requested = float(requested_ms) / 1000 if requested_ms else None
+        except ValueError:
+            requested = None
+        budget = requested if requested and requested > 0 else self.budget_seconds
+        return min(budget, self.max_budget_seconds)
+
+    def retrieval_plan(self, deadline: Deadline, k: int) -> Tuple[int, bool]:
+        """ (k, có chạy reranker không) theo thời gian còn lại. """
+        remaining = deadline.remaining()
+        rerank = remaining >= self.rerank_min_remaining
+        if not rerank:
+            record_degradation("retrieve", "skip_rerank")
+        if remaining < self.reduced_k_below and k > self.reduced_k:
+            record_degradation("retrieve", "reduce_k")
+            k = self.reduced_k
+        return k, rerank
+
+    def generation_plan(self, deadline: Deadline, max_tokens: int) -> Optional[Tuple[int, float]]:
+        """ (max_tokens, timeout) cho LLM, hoặc None nếu không đủ thời gian -> trả lời trích xuất. """
+        timeout = deadline.timeout(reserve=self.generation_reserve)
+        if timeout < self.min_generation:
+            record_degradation("generate", "extractive")
+            return None
+        budget_tokens = int(timeout * self.tokens_per_second)
+        if budget_tokens < max_tokens:
+            record_degradation("generate", "reduce_max_tokens")
+            max_tokens = max(self.min_max_tokens, budget_tokens)
+        return max_tokens, timeout
@@ -0,0 +1,205 @@
+"""
+Embedding worker dùng chung cho nhiều API worker trên cùng một máy.
+
+Thay vì mỗi process của `uvicorn main_api:app --workers N` tự nạp vietnamese-bi-encoder
+(vài trăm MB RAM/VRAM mỗi bản), một process duy nhất giữ model và phục vụ các worker
+qua IPC cục bộ (Unix socket, `multiprocessing.connection`).
+
+Chạy worker:
+    python -m src.serving.embedding_service --config configs/indexing_pipeline.yml --address /tmp/legal_rag_embedding.sock
+
+Rồi đặt `embedding.service_address` trong config trỏ tới cùng địa chỉ; DatabaseRetriever
+sẽ dùng RemoteEmbeddings thay cho HuggingFaceEmbeddings.
+
+Bảo mật: `multiprocessing.connection` unpickle mọi message, nên ai kết nối được và biết authkey là
+chạy được code trong worker. Vì vậy:
+- Bắt buộc đặt biến môi trường EMBEDDING_SERVICE_AUTHKEY (chuỗi bí mật, giống nhau ở worker và API).
+- Unix socket là chế độ khuyến nghị (file socket được tạo với quyền 0600).
+- "host:port" (TCP, cho Windows) chỉ chấp nhận địa chỉ loopback (127.x.x.x, localhost).
+"""
+import os
+import time
+import ipaddress
+import logging
+import argparse
+import threading
+from multiprocessing.connection import Listener, Client
+from typing import List, Optional, Any
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+LOOPBACK_HOSTS = {"localhost"}
+
+
+def _authkey() -> bytes:
+    """ Authkey dùng chung giữa worker và client; không có giá trị mặc định (mặc định công khai = không bảo vệ). """
+    key = os.getenv("EMBEDDING_SERVICE_AUTHKEY", "")
+    if not key:
+        raise RuntimeError(
+            "Chưa đặt EMBEDDING_SERVICE_AUTHKEY: embedding service unpickle mọi message nên bắt buộc có authkey bí mật."
+        )
+    return key.encode()
+
+
+def _family(address: str) -> str:
+    # "host:port" -> TCP cục bộ (Windows), còn lại là đường dẫn Unix socket
+    return "AF_INET" if ":" in address and not address.startswith("/") else "AF_UNIX"
+
+
+def _parse_address(address: str):
+    if _family(address) == "AF_INET":
+        host, port = address.rsplit(":", 1)
+        try:
+            # multiprocessing.connection chỉ hỗ trợ TCP qua IPv4 (AF_INET)
+            loopback = host in LOOPBACK_HOSTS or ipaddress.IPv4Address(host).is_loopback
+        except ValueError:
+            loopback = False
+        if not loopback:
+            raise ValueError(f"Embedding service qua TCP chỉ được dùng địa chỉ loopback, nhận được: '{host}'.")
+        return (host, int(port))
+    return address
+
+
+class EmbeddingServer:
+    """
+    Nhận yêu cầu ("embed", texts) / ("info",) từ nhiều client, mỗi kết nối một thread.
+    Lời gọi model được tuần tự hóa bằng lock (một model, một thiết bị).
+    """
+    def __init__(self, embedding_model: Embeddings, address: str, model_name: str = ""):
+        self.embedding_model = embedding_model
+        self.address = address
+        self.model_name = model_name
+        self._model_lock = threading.Lock()
+        self._listener: Optional[Listener] = None
+
+    def serve_forever(self):
+        if _family(self.address) == "AF_UNIX" and os.path.exists(self.address):
+            os.remove(self.address)  # socket cũ từ lần chạy trước
+        authkey = _authkey()
+        # Socket tạo ra chỉ chủ sở hữu đọc/ghi được (umask áp dụng lúc bind)
+        old_umask = os.umask(0o177) if _family(self.address) == "AF_UNIX" else None
+        try:
+            self._listener = Listener(_parse_address(self.address), family=_family(self.address), authkey=authkey)
+        finally:
+            if old_umask is not None:
+                os.umask(old_umask)
+        print(f"-> EmbeddingServer lắng nghe tại {self.address} (model: {self.model_name}).")
+        try:
+            while True:
+                conn = self._listener.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self.close()
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send(self._dispatch(message))
+                except (EOFError, OSError):
+                    return
+
+    def _dispatch(self, message: Any):
+        kind = message[0]
+        if kind == "embed":
+            texts = message[1]
+            try:
+                with self._model_lock:
+                    vectors = self.embedding_model.embed_documents(texts)
+                # Mảng float32 pickle gọn và nhanh hơn list lồng nhau
+                return ("ok", np.asarray(vectors, dtype=np.float32))
+            except Exception as e:
+                logger.exception("Embedding failed")
+                return ("error", str(e))
+        if kind == "info":
+            return ("ok", {"model_name": self.model_name, "pid": os.getpid()})
+        return ("error", f"Unknown request: {kind}")
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        if _family(self.address) == "AF_UNIX" and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+class RemoteEmbeddings(Embeddings):
+    """
+    Client của EmbeddingServer, dùng như một `Embeddings` bình thường.
+    Mỗi thread giữ một kết nối riêng (retrieve_batch chạy trong thread pool);
+    kết nối hỏng sẽ được mở lại một lần trước khi báo lỗi.
+    """
+    def __init__(self, address: str, connect_timeout: float = 30.0):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self._local = threading.local()
+        info = self._request(("info",))
+        self.model_name = f"{info['model_name']} (remote @ {address})"
+        print(f"-> Kết nối EmbeddingServer tại {address} (model: {info['model_name']}, pid {info['pid']}).")
+
+    def _connect(self):
+        # Worker API có thể khởi động trước embedding worker: chờ tối đa connect_timeout giây
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            try:
+                return Client(_parse_address(self.address), family=_family(self.address), authkey=_authkey())
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise ConnectionError(f"Không kết nối được EmbeddingServer tại {self.address}.")
+                time.sleep(0.5)
+
+    def _request(self, message: Any):
+        for attempt in range(2):
+            conn = getattr(self._local, "conn", None)
+            if conn is None:
+                conn = self._local.conn = self._connect()
+            try:
+                conn.send(message)
+                status, payload = conn.recv()
+                break
+            except (EOFError, OSError):
+                self._local.conn = None
+                if attempt == 1:
+                    raise
+        if status != "ok":
+            raise RuntimeError(f"EmbeddingServer lỗi: {payload}")
+        return payload
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._request(("embed", list(texts))).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def main():
+    from src.utils import extract_config
+    from src.agents.database_retriever import DatabaseRetriever
+
+    parser = argparse.ArgumentParser(description="Embedding worker dùng chung qua IPC cục bộ.")
+    parser.add_argument("--config", type=str, default="configs/indexing_pipeline.yml")
+    parser.add_argument("--address", type=str, default=None, help="Mặc định: embedding.service_address trong config")
+    args = parser.parse_args()
+
+    emb_cfg = dict(extract_config(args.config)['embedding'])
+    address = args.address or emb_cfg.get('service_address')
+    if not address:
+        raise SystemExit("Cần --address hoặc embedding.service_address trong config.")
+    # Worker luôn nạp model thật, kể cả khi config đang trỏ tới service
+    emb_cfg['service_address'] = None
+    embedding_model = DatabaseRetriever._load_embedding_model(emb_cfg)
+    embedding_model.embed_query("khởi động hệ thống")
+    EmbeddingServer(embedding_model, address, model_name=emb_cfg['model_name']).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
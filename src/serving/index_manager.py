@@ -0,0 +1,189 @@
+"""
+Hot swap index trong API đang chạy.
+
+- Bản index mới (snapshot, xem src/indexing/snapshot.py) được nạp + warm-up trong thread nền
+  trong khi bản cũ vẫn phục vụ; embedding model / reranker cùng config được dùng lại nên không
+  có cold start thứ hai.
+- Hoán đổi là một phép gán trên event loop: request mới thấy bản mới ngay lập tức.
+- Mỗi request giữ bản index qua `acquire()` (đếm tham chiếu); bản cũ chỉ được đóng khi request
+  cuối cùng đang dùng nó kết thúc.
+"""
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from src.agents.database_retriever import DatabaseRetriever
+from src.indexing.snapshot import current_version, snapshot_root
+from src.serving.observability import REGISTRY, Counter, Gauge
+from src.utils import extract_config
+
+logger = logging.getLogger(__name__)
+
+INDEX_SWAPS = REGISTRY.register(Counter(
+    "rag_index_swaps_total", "Số lần nạp bản index mới.", ("outcome",)
+))
+INDEX_RETIRED = REGISTRY.register(Gauge(
+    "rag_index_retired", "Số bản index cũ còn request đang dùng (chưa đóng)."
+))
+
+
+class IndexHandle:
+    """ Một bản index đã nạp + số request đang dùng nó. """
+    def __init__(self, retriever: DatabaseRetriever, load_seconds: float):
+        self.retriever = retriever
+        self.version = retriever.index_version
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.refs = 0
+        self.retired = False
+        self.closed = False
+
+
+class IndexManager:
+    def __init__(
+        self,
+        config_path: str = "configs/indexing_pipeline.yml",
+        poll_interval_seconds: float = 0.0,
+        on_swap: Optional[Callable[[DatabaseRetriever], None]] = None,
+    ):
+        self.config_path = config_path
+        self.poll_interval = poll_interval_seconds
+        self.on_swap = on_swap
+        self.current: Optional[IndexHandle] = None
+        self._retired: List[IndexHandle] = []
+        self._reload_lock: Optional[asyncio.Lock] = None
+        self._watch_task: Optional[asyncio.Task] = None
+        self.last_error: Optional[str] = None
+
+    @classmethod
+    def from_config(cls, config_path: str, on_swap: Optional[Callable[[DatabaseRetriever], None]] = None) -> 'IndexManager':
+        snap_cfg = extract_config(config_path).get('snapshots', {})
+        poll = snap_cfg.get('poll_interval_seconds', 30) if snap_cfg.get('enabled', False) else 0
+        return cls(config_path=config_path, poll_interval_seconds=poll, on_swap=on_swap)
+
+    @asynccontextmanager
+    async def acquire(self):
+        """ Giữ bản index hiện tại trong suốt khối `async with` (kể cả khi có swap ở giữa). """
+        handle = self.current
+        if handle is None:
+            yield None
+            return
+        handle.refs += 1
+        try:
+            yield handle.retriever
+        finally:
+            handle.refs -= 1
+            if handle.retired and handle.refs == 0:
+                await self._close(handle)
+
+    async def reload(self, version: Optional[str] = None, force: bool = False) -> Dict[str, Any]:
+        """
+        Nạp `version` (mặc định: CURRENT) ở background rồi hoán đổi. Không làm gì nếu bản đó
+        đang phục vụ (trừ khi force). Lỗi nạp giữ nguyên bản cũ và được ném ra cho caller.
+        """
+        if self._reload_lock is None:
+            self._reload_lock = asyncio.Lock()
+        async with self._reload_lock:
+            old = self.current
+            if old is not None and not force:
+                target = version or self._current_version_on_disk()
+                if target is not None and target == old.version:
+                    return {"swapped": False, "version": old.version}
+
+            t0 = time.perf_counter()
+            reuse = old.retriever if old is not None else None
+            try:
+                retriever = await asyncio.to_thread(
+                    DatabaseRetriever.from_config, config_path=self.config_path, version=version, reuse=reuse
+                )
+                await asyncio.to_thread(retriever.warm_up)
+            except Exception as e:
+                INDEX_SWAPS.inc(outcome="failed")
+                self.last_error = str(e)
+                raise
+            handle = IndexHandle(retriever, round(time.perf_counter() - t0, 2))
+
+            # Hoán đổi: không có await giữa hai lệnh gán nên mọi request thấy bản cũ hoặc bản mới
+            self.current = handle
+            if self.on_swap is not None:
+                self.on_swap(retriever)
+            INDEX_SWAPS.inc(outcome="swapped")
+            self.last_error = None
+            logger.info(
+                f"Index {old.version if old else None} -> {handle.version} (nạp trong {handle.load_seconds}s)."
+            )
+
+            if old is not None:
+                old.retired = True
+                if old.refs == 0:
+                    await self._close(old)
+                else:
+                    self._retired.append(old)
+                    INDEX_RETIRED.set(len(self._retired))
+            return {"swapped": True, "version": handle.version, "previous": old.version if old else None,
+                    "load_seconds": handle.load_seconds}
+
+    async def _close(self, handle: IndexHandle):
+        if handle in self._retired:
+            self._retired.remove(handle)
+            INDEX_RETIRED.set(len(self._retired))
+        if handle.closed:
+            return
+        handle.closed = True
+        try:
+            await handle.retriever.aclose()
+        except Exception as e:
+            logger.warning(f"Lỗi khi đóng index {handle.version}: {e}")
+        logger.info(f"Đã đóng index cũ {handle.version}.")
+
+    def _current_version_on_disk(self) -> Optional[str]:
+        cfg = extract_config(self.config_path)
+        if not cfg.get('snapshots', {}).get('enabled', False):
+            return None
+        return current_version(snapshot_root(cfg))
+
+    def start_watching(self):
+        """ Tự nạp bản mới khi CURRENT đổi (poll_interval_seconds > 0). """
+        if self.poll_interval > 0 and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch())
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self.current is None:
+                continue
+            try:
+                version = await asyncio.to_thread(self._current_version_on_disk)
+                if version is not None and version != self.current.version:
+                    await self.reload(version)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Không nạp được index mới: {e}")
+
+    async def close(self):
+        """ Tắt hệ thống: dừng theo dõi CURRENT, đóng bản đang phục vụ và mọi bản cũ còn chờ đóng. """
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+        handles = list(self._retired)
+        if self.current is not None:
+            handles.append(self.current)
+            self.current.retired = True
+            self.current = None
+        for handle in handles:
+            await self._close(handle)
+
+    def status(self) -> Dict[str, Any]:
+        current = self.current
+        return {
+            "version": current.version if current else None,
+            "loaded_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(current.loaded_at)) if current else None,
+            "load_seconds": current.load_seconds if current else None,
+            "in_use": current.refs if current else 0,
+            "retired": [{"version": h.version, "in_use": h.refs} for h in self._retired],
+            "poll_interval_seconds": self.poll_interval,
+            "last_error": self.last_error,
+        }
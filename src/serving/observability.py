@@ -0,0 +1,216 @@
+"""
+Tracing theo từng bước (span) và metrics dạng Prometheus cho pipeline RAG.
+
+- `trace_request(name)`: mở một trace cho một request (lưu trong contextvar, an toàn với asyncio).
+- `span(stage)`: đo thời gian một bước, ghi vào histogram `rag_stage_duration_seconds`
+  và vào trace hiện tại (nếu có).
+- `REGISTRY.render()`: xuất toàn bộ metrics theo text format của Prometheus cho `/metrics`.
+
+Chi phí mỗi span chỉ gồm hai lần perf_counter, một lần bisect và một lock ngắn,
+đủ nhẹ để bật thường trực trên production.
+"""
+import json
+import time
+import uuid
+import bisect
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple, Iterator
+
+trace_logger = logging.getLogger("rag.trace")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_str(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(str(labels.get(n, "")) for n in self.labelnames), 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_str(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels: str):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1.0, **labels: str):
+        self.inc(-amount, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        lines[1] = f"# TYPE {self.name} gauge"
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # key -> [counts theo bucket (không cộng dồn) + bucket +Inf, sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, c in zip(self.buckets, counts):
+                    cumulative += c
+                    le = 'le="%s"' % bound
+                    lines.append(f"{self.name}_bucket{_label_str(self.labelnames, key, le)} {cumulative}")
+                le = 'le="+Inf"'
+                lines.append(f"{self.name}_bucket{_label_str(self.labelnames, key, le)} {count}")
+                lines.append(f"{self.name}_sum{_label_str(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_label_str(self.labelnames, key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_LATENCY = REGISTRY.register(Histogram(
+    "rag_stage_duration_seconds", "Thời gian xử lý của từng bước trong pipeline RAG.", ("stage",)
+))
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    "rag_request_duration_seconds", "Thời gian xử lý end-to-end của một request.", ("endpoint", "intent")
+))
+REQUESTS = REGISTRY.register(Counter(
+    "rag_requests_total", "Số request theo endpoint và intent.", ("endpoint", "intent")
+))
+CACHE_HITS = REGISTRY.register(Counter("rag_cache_hits_total", "Số lần cache hit.", ("cache",)))
+CACHE_MISSES = REGISTRY.register(Counter("rag_cache_misses_total", "Số lần cache miss.", ("cache",)))
+FALLBACKS = REGISTRY.register(Counter("rag_fallbacks_total", "Số lần pipeline phải dùng nhánh dự phòng.", ("kind",)))
+ERRORS = REGISTRY.register(Counter("rag_errors_total", "Số lỗi theo từng bước.", ("stage",)))
+
+
+class Trace:
+    """ Danh sách các span của một request, được log ra dưới dạng JSON khi kết thúc. """
+    def __init__(self, name: str, request_id: Optional[str] = None):
+        self.name = name
+        self.request_id = request_id or uuid.uuid4().hex[:12]
+        self.start = time.perf_counter()
+        self.spans: List[Tuple[str, float, str]] = []
+        self.attributes: Dict[str, object] = {}
+
+    def add(self, stage: str, duration_ms: float, status: str = "ok"):
+        self.spans.append((stage, duration_ms, status))
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000
+
+    def server_timing(self) -> str:
+        """ Header Server-Timing: mỗi span một mục, cộng thêm 'total'. """
+        items = [f"{stage};dur={ms:.1f}" for stage, ms, _ in self.spans]
+        items.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(items)
+
+    def to_dict(self) -> Dict[str, object]:
+        return {
+            "trace": self.name,
+            "request_id": self.request_id,
+            "total_ms": round(self.elapsed_ms(), 2),
+            "spans": [{"stage": s, "ms": round(ms, 2), "status": st} for s, ms, st in self.spans],
+            **self.attributes,
+        }
+
+
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("rag_trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_request(name: str, request_id: Optional[str] = None) -> Iterator[Trace]:
+    trace = Trace(name, request_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        intent = str(trace.attributes.get("intent", "unknown"))
+        REQUEST_LATENCY.observe(trace.elapsed_ms() / 1000, endpoint=name, intent=intent)
+        REQUESTS.inc(endpoint=name, intent=intent)
+        if trace_logger.isEnabledFor(logging.INFO):
+            trace_logger.info(json.dumps(trace.to_dict(), ensure_ascii=False))
+
+
+@contextmanager
+def span(stage: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+    """
+    Đo thời gian một bước. Nếu truyền `timings`, thời gian (ms) cũng được ghi vào dict đó
+    (giữ tương thích với tham số `timings` của DatabaseRetriever.retrieve).
+    """
+    t0 = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        ERRORS.inc(stage=stage)
+        raise
+    finally:
+        duration = time.perf_counter() - t0
+        STAGE_LATENCY.observe(duration, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, duration * 1000, status)
+        if timings is not None:
+            timings[stage] = duration * 1000
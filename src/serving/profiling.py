@@ -0,0 +1,178 @@
+"""
+Profiling theo yêu cầu cho API và pipeline index (chỉ dùng thư viện chuẩn).
+
+- `StackSampler`: thread nền lấy mẫu stack của MỌI thread (sys._current_frames) mỗi `interval` giây,
+  ghi ra định dạng "collapsed stacks" (`thread;frame;frame ... <số mẫu>`) — đầu vào trực tiếp của
+  flamegraph.pl, speedscope, inferno. Thấy được cả thời gian trong thread phụ (asyncio.to_thread,
+  MicroBatcher, ThreadPoolExecutor của shard) mà cProfile không thấy.
+- cProfile: ghi file .prof (pstats) cho snakeviz / flameprof / tuna; chỉ đo thread gọi nó.
+- `Profiler`: mỗi lúc chỉ một phiên (sampler / cProfile đều là theo process), file ghi vào `output_dir`.
+  Dùng cho header `X-Profile: sample|cprofile` của /chat và POST /admin/profile (lấy mẫu N giây).
+- `profile_to(path, mode)`: bọc một lệnh CLI (vd: `python -m src.indexing.snapshot --profile out.collapsed build`).
+
+Khi tắt (profiling.enabled: false, không truyền --profile) không có thread hay hook nào được tạo.
+Lưu ý: trong API mọi request chạy chung event loop, nên profile của một request gồm cả các request
+chạy đồng thời với nó.
+"""
+import os
+import sys
+import time
+import cProfile
+import pstats
+import asyncio
+import logging
+import threading
+from collections import Counter as Tally
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, Optional
+
+from src.serving.observability import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILES = REGISTRY.register(Counter(
+    "rag_profiles_total", "Số phiên profiling đã ghi ra file.", ("kind", "mode")
+))
+
+PROFILE_MODES = ("sample", "cprofile")
+# Hàm lá của thread đang chờ (I/O, khóa, hàng đợi): bỏ khỏi profile trừ khi include_idle
+IDLE_FUNCTIONS = {"select", "poll", "epoll", "wait", "acquire", "_wait_for_tstate_lock", "get", "accept", "sleep"}
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _frame_name(code) -> str:
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    def __init__(self, interval: float = 0.005, include_idle: bool = False, max_depth: int = 128):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.max_depth = max_depth
+        self.counts: Tally = Tally()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'StackSampler':
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> 'StackSampler':
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for tid, frame in sys._current_frames().items():
+                if tid == own:
+                    continue
+                if not self.include_idle and frame.f_code.co_name in IDLE_FUNCTIONS:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(tid, f"thread-{tid}"))
+                self.counts[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+    def write(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+
+
+@dataclass
+class ProfileResult:
+    mode: str
+    path: str
+    samples: int = 0        # số mẫu stack (sample) hoặc số lời gọi hàm (cprofile)
+    seconds: float = 0.0
+
+
+@contextmanager
+def profile_to(path: str, mode: str = "sample", interval: float = 0.005, include_idle: bool = False) -> Iterator[ProfileResult]:
+    """ Profile khối lệnh và ghi ra `path` (collapsed stacks nếu mode="sample", pstats .prof nếu "cprofile"). """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"mode phải là một trong {PROFILE_MODES}, nhận được: '{mode}'")
+    result = ProfileResult(mode, path)
+    t0 = time.perf_counter()
+    if mode == "sample":
+        sampler = StackSampler(interval, include_idle).start()
+        try:
+            yield result
+        finally:
+            sampler.stop()
+            sampler.write(path)
+            result.samples = sampler.samples
+            result.seconds = time.perf_counter() - t0
+    else:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield result
+        finally:
+            profile.disable()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            profile.dump_stats(path)
+            result.samples = pstats.Stats(profile).total_calls
+            result.seconds = time.perf_counter() - t0
+
+
+class Profiler:
+    def __init__(self, output_dir: str = "./data/profiles", interval: float = 0.005, max_seconds: float = 60.0, include_idle: bool = False):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.include_idle = include_idle
+        self._lock = threading.Lock()
+        print(f"-> Profiler bật (ghi vào {output_dir}, lấy mẫu mỗi {interval * 1000:.1f}ms).")
+
+    @classmethod
+    def from_config(cls, profiling_cfg: Dict[str, Any]) -> 'Profiler':
+        return cls(
+            output_dir=profiling_cfg.get('output_dir', "./data/profiles"),
+            interval=profiling_cfg.get('interval_ms', 5) / 1000,
+            max_seconds=profiling_cfg.get('max_seconds', 60.0),
+            include_idle=profiling_cfg.get('include_idle', False),
+        )
+
+    def _path(self, name: str, mode: str) -> str:
+        now = time.time()
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now)) + f"-{int(now * 1000) % 1000:03d}"
+        return os.path.join(self.output_dir, f"{name}-{stamp}.{'collapsed' if mode == 'sample' else 'prof'}")
+
+    @contextmanager
+    def capture(self, name: str, mode: str = "sample", include_idle: Optional[bool] = None) -> Iterator[ProfileResult]:
+        """ Một phiên profile; đang có phiên khác -> ProfilerBusy (sampler / cProfile là theo process). """
+        if not self._lock.acquire(blocking=False):
+            raise ProfilerBusy("Đang có một phiên profiling khác.")
+        try:
+            include_idle = self.include_idle if include_idle is None else include_idle
+            with profile_to(self._path(name, mode), mode, self.interval, include_idle) as result:
+                yield result
+            PROFILES.inc(kind=name.split("-", 1)[0], mode=mode)
+            logger.info(f"[PROFILE] {result.mode} {result.seconds:.2f}s, {result.samples} mẫu -> {result.path}")
+        finally:
+            self._lock.release()
+
+    async def sample_for(self, seconds: float, include_idle: Optional[bool] = None) -> ProfileResult:
+        """ Lấy mẫu toàn process trong `seconds` giây (tối đa max_seconds). """
+        seconds = max(0.1, min(seconds, self.max_seconds))
+        with self.capture("process", "sample", include_idle) as result:
+            await asyncio.sleep(seconds)
+        return result